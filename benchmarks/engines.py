@@ -0,0 +1,113 @@
+import gc
+import time
+import json
+import asyncio
+import contextlib
+import logging
+import resource
+import threading
+import tracemalloc
+
+import click
+from openai import OpenAI, AsyncOpenAI
+
+from typing import Any, Dict, List, Optional
+
+from src.algorithms.scheduler import Scheduler
+from src.algorithms.strategies import llm_map_reduce, allm_map_reduce
+from src.algorithms.backends import FakeLLM, AsyncFakeLLM
+from benchmarks.stub_server import StubServer
+
+def build_backend(backend:str, base_url:Optional[str], latency:float, asynchronous:bool) -> Any:
+    # the fake runs in-process : no sockets, no server, only the engine is measured
+    if backend == 'fake':
+        return AsyncFakeLLM(latency=latency) if asynchronous else FakeLLM(latency=latency)
+    if asynchronous:
+        return AsyncOpenAI(api_key='stub', base_url=base_url, max_retries=0)
+    return OpenAI(api_key='stub', base_url=base_url, max_retries=0)
+
+def run_thread_engine(backend:str, base_url:Optional[str], latency:float, pages:List[str], context_size:int, concurrency:int) -> Dict[str, Any]:
+    llm = build_backend(backend, base_url, latency, asynchronous=False)
+    with Scheduler(max_workers=concurrency) as scheduler:
+        start = time.perf_counter()
+        response = llm_map_reduce('benchmark', 'gpt-4o-mini', llm, context_size, pages, scheduler)
+        duration = time.perf_counter() - start
+    llm.close()
+    return {'response': response, 'duration': duration}
+
+def run_async_engine(backend:str, base_url:Optional[str], latency:float, pages:List[str], context_size:int, concurrency:int) -> Dict[str, Any]:
+    async def main() -> Dict[str, Any]:
+        llm = build_backend(backend, base_url, latency, asynchronous=True)
+        start = time.perf_counter()
+        response = await allm_map_reduce('benchmark', 'gpt-4o-mini', llm, context_size, pages, asyncio.Semaphore(concurrency))
+        duration = time.perf_counter() - start
+        await llm.close()
+        return {'response': response, 'duration': duration}
+    return asyncio.run(main())
+
+ENGINES = {
+    'thread': run_thread_engine,
+    'async': run_async_engine
+}
+
+class ThreadSampler(threading.Thread):
+    def __init__(self, interval:float=0.005):
+        super(ThreadSampler, self).__init__(daemon=True)
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.peak_threads = 0
+
+    def sample(self) -> None:
+        # the sampler itself is not part of the measured engine
+        self.peak_threads = max(self.peak_threads, threading.active_count() - 1)
+
+    def run(self) -> None:
+        while not self.stop_event.is_set():
+            self.sample()
+            time.sleep(self.interval)
+
+    def stop(self) -> int:
+        self.stop_event.set()
+        self.join()
+        return self.peak_threads
+
+def measure(engine:str, backend:str, base_url:Optional[str], latency:float, pages:List[str], context_size:int, concurrency:int) -> Dict[str, Any]:
+    gc.collect()
+    sampler = ThreadSampler()
+    sampler.start()
+    tracemalloc.start()
+    out = ENGINES[engine](backend, base_url, latency, pages, context_size, concurrency)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    peak_threads = sampler.stop()
+    return {
+        'engine': engine,
+        'backend': backend,
+        'nb_pages': len(pages),
+        'duration': round(out['duration'], 4),
+        'peak_threads': peak_threads,
+        'peak_traced_memory_kb': peak_memory // 1024,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'response': out['response']
+    }
+
+@click.command()
+@click.option('--nb_pages', '-n', multiple=True, type=int, default=[16, 64, 256, 1024])
+@click.option('--context_size', '-s', default=4)
+@click.option('--concurrency', '-c', default=256, help='thread pool size or semaphore value')
+@click.option('--latency', default=0.05, help='simulated latency of the backend in seconds')
+@click.option('--backend', type=click.Choice(choices=['stub', 'fake']), default='stub', help='stub http server or in-process fake llm')
+def main(nb_pages:List[int], context_size:int, concurrency:int, latency:float, backend:str):
+    logging.disable(logging.INFO)
+    with contextlib.ExitStack() as stack:
+        base_url = stack.enter_context(StubServer(latency=latency)).base_url if backend == 'stub' else None
+        for counter in nb_pages:
+            pages = [ f'content of page {index}' for index in range(counter) ]
+            results = [ measure(engine, backend, base_url, latency, pages, context_size, concurrency) for engine in ENGINES ]
+            assert len({ result['response'] for result in results }) == 1, 'engines returned different results'
+            for result in results:
+                result.pop('response')
+                print(json.dumps(result))
+
+if __name__ == '__main__':
+    main()
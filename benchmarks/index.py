@@ -0,0 +1,58 @@
+import time
+import json
+import logging
+
+import click
+from openai import OpenAI
+
+from typing import Any, Dict, List
+
+from src.algorithms.scheduler import Scheduler
+from src.algorithms.strategies import llm_map_reduce, llm_index, llm_index_reduce
+from benchmarks.stub_server import StubServer
+
+def run(mode:str, base_url:str, pages:List[str], context_size:int, concurrency:int, queries:List[str]) -> Dict[str, Any]:
+    llm = OpenAI(api_key='stub', base_url=base_url, max_retries=0)
+    with Scheduler(max_workers=concurrency) as scheduler:
+        start = time.perf_counter()
+        segments = pages
+        if mode != 'none':
+            segments = llm_index('gpt-4o-mini', llm, pages, scheduler)
+        load_duration = time.perf_counter() - start
+
+        durations = []
+        for query in queries:
+            start = time.perf_counter()
+            if mode == 'reduce':
+                llm_index_reduce(query, 'gpt-4o-mini', llm, context_size, segments, scheduler)
+            else:
+                llm_map_reduce(query, 'gpt-4o-mini', llm, context_size, segments, scheduler)
+            durations.append(time.perf_counter() - start)
+    llm.close()
+    return {
+        'index_mode': mode,
+        'nb_pages': len(pages),
+        'load_duration': round(load_duration, 4),
+        'time_to_first_answer': round(durations[0], 4),
+        'mean_time_to_answer': round(sum(durations) / len(durations), 4)
+    }
+
+@click.command()
+@click.option('--nb_pages', '-n', multiple=True, type=int, default=[16, 128])
+@click.option('--nb_queries', '-q', default=3)
+@click.option('--context_size', '-s', default=4)
+@click.option('--concurrency', '-c', default=32)
+@click.option('--page_size', default=4000, help='number of characters per page')
+@click.option('--latency', default=0.05, help='simulated latency of the stub server in seconds')
+@click.option('--latency_per_token', default=0.0002, help='simulated prefill cost per prompt token in seconds')
+def main(nb_pages:List[int], nb_queries:int, context_size:int, concurrency:int, page_size:int, latency:float, latency_per_token:float):
+    logging.disable(logging.INFO)
+    queries = [ f'question number {index}' for index in range(nb_queries) ]
+    with StubServer(latency=latency, latency_per_token=latency_per_token) as server:
+        for counter in nb_pages:
+            pages = [ f'content of page {index} ' * (page_size // 20) for index in range(counter) ]
+            for mode in ['none', 'map', 'reduce']:
+                print(json.dumps(run(mode, server.base_url, pages, context_size, concurrency, queries)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+import json
+import time
+import uuid
+import socket
+import asyncio
+import multiprocessing
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+def stub_completion(payload:Dict[str, Any]) -> Dict[str, Any]:
+    content = payload['messages'][-1]['content']
+    prompt_tokens = sum(len(message['content']) for message in payload['messages']) // 4
+    return {
+        'id': f'chatcmpl-{uuid.uuid4().hex}',
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': payload['model'],
+        'choices': [
+            {
+                'index': 0,
+                'message': {'role': 'assistant', 'content': f'stub answer ({len(content)} chars)'},
+                'finish_reason': 'stop'
+            }
+        ],
+        'usage': {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': 8,
+            'total_tokens': prompt_tokens + 8
+        }
+    }
+
+def parse_multipart(body:bytes, content_type:str) -> Dict[str, bytes]:
+    # minimal multipart/form-data reader, enough for the file uploads of the openai client
+    boundary = content_type.split('boundary=')[-1].strip('"').encode('utf-8')
+    fields:Dict[str, bytes] = {}
+    for part in body.split(b'--' + boundary):
+        if b'\r\n\r\n' not in part:
+            continue
+        headers, value = part.split(b'\r\n\r\n', 1)
+        for header in headers.decode('utf-8').split('\r\n'):
+            if header.lower().startswith('content-disposition') and 'name="' in header:
+                name = header.split('name="')[1].split('"')[0]
+                fields[name] = value[:-2] if value.endswith(b'\r\n') else value
+    return fields
+
+def create_app(latency:float=0.05, latency_per_token:float=0.0, max_in_flight:Optional[int]=None) -> FastAPI:
+    app = FastAPI()
+    # requests beyond max_in_flight get a 429, the way a provider answers a client above its rate limit
+    state = {'in_flight': 0}
+    # files and batches are kept in memory, a batch completes on its first poll
+    files:Dict[str, Dict[str, Any]] = {}
+    batches:Dict[str, Dict[str, Any]] = {}
+
+    def store_file(content:bytes, filename:str, purpose:str) -> Dict[str, Any]:
+        file_id = f'file-{uuid.uuid4().hex}'
+        files[file_id] = {
+            'id': file_id,
+            'object': 'file',
+            'bytes': len(content),
+            'created_at': int(time.time()),
+            'filename': filename,
+            'purpose': purpose,
+            'status': 'processed',
+            'content': content
+        }
+        return files[file_id]
+
+    def file_object(file:Dict[str, Any]) -> Dict[str, Any]:
+        return { key: value for key, value in file.items() if key != 'content' }
+
+    def run_batch(batch:Dict[str, Any]) -> None:
+        outputs:List[str] = []
+        for line in files[batch['input_file_id']]['content'].decode('utf-8').splitlines():
+            if len(line.strip()) == 0:
+                continue
+            request = json.loads(line)
+            outputs.append(json.dumps({
+                'id': f'batch_req_{uuid.uuid4().hex}',
+                'custom_id': request['custom_id'],
+                'response': {'status_code': 200, 'request_id': uuid.uuid4().hex, 'body': stub_completion(request['body'])},
+                'error': None
+            }))
+        output_file = store_file(('\n'.join(outputs) + '\n').encode('utf-8'), f"{batch['id']}_output.jsonl", 'batch_output')
+        batch.update({
+            'status': 'completed',
+            'output_file_id': output_file['id'],
+            'completed_at': int(time.time()),
+            'request_counts': {'total': len(outputs), 'completed': len(outputs), 'failed': 0}
+        })
+
+    @app.post('/v1/files')
+    async def create_file(request:Request) -> Dict[str, Any]:
+        fields = parse_multipart(await request.body(), request.headers['content-type'])
+        return file_object(store_file(fields['file'], 'upload.jsonl', fields.get('purpose', b'batch').decode('utf-8')))
+
+    @app.get('/v1/files/{file_id}/content')
+    async def file_content(file_id:str) -> PlainTextResponse:
+        return PlainTextResponse(files[file_id]['content'].decode('utf-8'))
+
+    @app.post('/v1/batches')
+    async def create_batch(request:Request) -> Dict[str, Any]:
+        payload = await request.json()
+        batch_id = f'batch_{uuid.uuid4().hex}'
+        batches[batch_id] = {
+            'id': batch_id,
+            'object': 'batch',
+            'endpoint': payload['endpoint'],
+            'input_file_id': payload['input_file_id'],
+            'completion_window': payload['completion_window'],
+            'status': 'validating',
+            'created_at': int(time.time())
+        }
+        return batches[batch_id]
+
+    @app.get('/v1/batches/{batch_id}')
+    async def retrieve_batch(batch_id:str) -> Dict[str, Any]:
+        batch = batches[batch_id]
+        if batch['status'] == 'validating':
+            run_batch(batch)
+        return batch
+
+    @app.post('/v1/chat/completions')
+    async def chat_completions(request:Request) -> Any:
+        payload = await request.json()
+        content = payload['messages'][-1]['content']
+        prompt_tokens = sum(len(message['content']) for message in payload['messages']) // 4
+        if max_in_flight is not None and state['in_flight'] >= max_in_flight:
+            return JSONResponse(
+                status_code=429,
+                content={'error': {'message': 'rate limit reached', 'type': 'requests', 'code': 'rate_limit_exceeded'}},
+                headers={'retry-after-ms': str(int(latency * 1000))}
+            )
+        state['in_flight'] += 1
+        try:
+            await asyncio.sleep(latency + prompt_tokens * latency_per_token)
+        finally:
+            state['in_flight'] -= 1
+        if payload.get('stream', False):
+            return StreamingResponse(stream_chunks(payload['model'], f'stub answer ({len(content)} chars)'), media_type='text/event-stream')
+        return stub_completion(payload)
+
+    async def stream_chunks(model:str, answer:str) -> AsyncIterator[str]:
+        completion_id = f'chatcmpl-{uuid.uuid4().hex}'
+        for token in answer.split(' '):
+            chunk = {
+                'id': completion_id,
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': model,
+                'choices': [ {'index': 0, 'delta': {'content': token + ' '}, 'finish_reason': None} ]
+            }
+            yield f'data: {json.dumps(chunk)}\n\n'
+        yield 'data: [DONE]\n\n'
+
+    return app
+
+def serve(host:str, port:int, latency:float, latency_per_token:float, max_in_flight:Optional[int]) -> None:
+    uvicorn.run(create_app(latency=latency, latency_per_token=latency_per_token, max_in_flight=max_in_flight), host=host, port=port, log_level='warning', backlog=4096)
+
+class StubServer:
+    # runs in a separate process so that the server does not compete with the measured engine for the GIL
+    def __init__(self, latency:float=0.05, latency_per_token:float=0.0, host:str='127.0.0.1', port:int=0, max_in_flight:Optional[int]=None):
+        if port == 0:
+            with socket.socket() as sock:
+                sock.bind((host, 0))
+                port = sock.getsockname()[1]
+        self.host = host
+        self.port = port
+        self.process = multiprocessing.Process(target=serve, args=(host, port, latency, latency_per_token, max_in_flight), daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return f'http://{self.host}:{self.port}/v1'
+
+    def __enter__(self) -> 'StubServer':
+        self.process.start()
+        while True:
+            try:
+                with socket.create_connection((self.host, self.port), timeout=0.1):
+                    break
+            except OSError:
+                time.sleep(0.05)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.process.terminate()
+        self.process.join()
@@ -0,0 +1,182 @@
+import os
+import sys
+import json
+import time
+import logging
+import platform
+import resource
+import tempfile
+import itertools
+
+import click
+
+from typing import Any, Dict, List, Optional, Tuple
+
+from src.algorithms.scheduler import Scheduler
+from src.algorithms.backends import FakeLLM
+from src.algorithms.strategies import llm_map_reduce, llm_map_reduce_stream
+from src.extraction import PageStream, iter_pages
+from benchmarks.engines import ThreadSampler
+
+# the fields identifying a case, two results with the same key are compared
+CASE_KEY = ('kind', 'nb_pages', 'context_size', 'concurrency')
+
+def current_rss_kb() -> int:
+    # resident memory right now, ru_maxrss only ever grows and would hide the peak of later cases
+    try:
+        with open('/proc/self/statm') as fp:
+            return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+class ResourceSampler(ThreadSampler):
+    def __init__(self, interval:float=0.005):
+        super(ResourceSampler, self).__init__(interval)
+        self.peak_rss_kb = current_rss_kb()
+
+    def sample(self) -> None:
+        super(ResourceSampler, self).sample()
+        self.peak_rss_kb = max(self.peak_rss_kb, current_rss_kb())
+
+def write_pdf(path2file:str, nb_pages:int, page_size:int) -> str:
+    # minimal pdf, one Helvetica line of about 80 characters per row, page_size characters per page
+    objects = [ "<< /Type /Catalog /Pages 2 0 R >>" ]
+    kids = " ".join(f"{4 + 2 * index} 0 R" for index in range(nb_pages))
+    objects.append(f"<< /Type /Pages /Kids [{kids}] /Count {nb_pages} >>")
+    objects.append("<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    for index in range(nb_pages):
+        text = f'content of page {index} ' * (page_size // 20 + 1)
+        rows = [ text[cursor:cursor+80] for cursor in range(0, page_size, 80) ]
+        stream = "BT /F1 8 Tf 36 760 Td 10 TL " + " ".join(f"({row}) '" for row in rows) + " ET"
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R >> >> /Contents {5 + 2 * index} 0 R >>")
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n{body}\nendobj\n".encode("latin-1")
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("latin-1")
+    for offset in offsets:
+        out += f"{offset:010d} 00000 n \n".encode("latin-1")
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode("latin-1")
+
+    with open(path2file, "wb") as fp:
+        fp.write(out)
+    return path2file
+
+def run_case(kind:str, nb_pages:int, context_size:int, concurrency:int, page_size:int, latency:float, latency_per_token:float, extraction_workers:Optional[int], path2dir:str) -> Dict[str, Any]:
+    llm = FakeLLM(latency=latency, latency_per_token=latency_per_token)
+    path2file = None
+    if kind == 'pdf':
+        # the file is written before the measure, only the extraction and the llm calls are timed
+        path2file = write_pdf(os.path.join(path2dir, f'benchmark_{nb_pages}.pdf'), nb_pages, page_size)
+
+    sampler = ResourceSampler()
+    sampler.start()
+    start = time.perf_counter()
+    with Scheduler(max_workers=concurrency) as scheduler:
+        if kind == 'pdf':
+            page_stream = PageStream(iter_pages(path2file, max_workers=extraction_workers))
+            answer = llm_map_reduce_stream('benchmark', 'gpt-4o-mini', llm, context_size, page_stream, scheduler)
+        else:
+            pages = [ (f'content of page {index} ' * (page_size // 20 + 1))[:page_size] for index in range(nb_pages) ]
+            answer = llm_map_reduce('benchmark', 'gpt-4o-mini', llm, context_size, pages, scheduler)
+    duration = time.perf_counter() - start
+    sampler.stop()
+
+    stats = llm.stats()
+    return {
+        'kind': kind,
+        'nb_pages': nb_pages,
+        'context_size': context_size,
+        'concurrency': concurrency,
+        'duration': round(duration, 4),
+        'nb_api_calls': stats['nb_calls'],
+        'nb_calls_per_kind': stats['nb_calls_per_kind'],
+        'prompt_tokens': stats['prompt_tokens'],
+        'completion_tokens': stats['completion_tokens'],
+        'peak_in_flight': stats['peak_in_flight'],
+        'peak_threads': sampler.peak_threads,
+        'peak_rss_kb': sampler.peak_rss_kb,
+        'answer': answer
+    }
+
+def case_key(result:Dict[str, Any]) -> Tuple:
+    return tuple(result[field] for field in CASE_KEY)
+
+def compare(results:List[Dict[str, Any]], baseline:List[Dict[str, Any]], tolerance:float) -> List[Dict[str, Any]]:
+    # the fake is deterministic : api calls and tokens must match exactly, the duration within the tolerance
+    references = { case_key(result): result for result in baseline }
+    rows = []
+    for result in results:
+        reference = references.get(case_key(result))
+        if reference is None:
+            continue
+        regressions = [
+            metric for metric in ['nb_api_calls', 'prompt_tokens']
+            if result[metric] > reference[metric]
+        ]
+        if result['duration'] > reference['duration'] * (1 + tolerance):
+            regressions.append('duration')
+        rows.append({
+            **{ field: result[field] for field in CASE_KEY },
+            'duration_ratio': round(result['duration'] / reference['duration'], 3) if reference['duration'] > 0 else None,
+            'nb_api_calls_delta': result['nb_api_calls'] - reference['nb_api_calls'],
+            'prompt_tokens_delta': result['prompt_tokens'] - reference['prompt_tokens'],
+            'peak_rss_kb_delta': result['peak_rss_kb'] - reference['peak_rss_kb'],
+            'answer_changed': result['answer'] != reference['answer'],
+            'regressions': regressions
+        })
+    return rows
+
+@click.command()
+@click.option('--nb_pages', '-n', multiple=True, type=int, default=[10, 100, 1000, 5000], help='page counts of the in-memory cases')
+@click.option('--pdf_pages', '-p', multiple=True, type=int, default=[100, 1000], help='page counts of the cases extracting a generated pdf')
+@click.option('--context_size', '-s', multiple=True, type=int, default=[4, 16])
+@click.option('--concurrency', '-c', multiple=True, type=int, default=[8, 64], help='size of the shared scheduler')
+@click.option('--page_size', default=2000, help='number of characters per page')
+@click.option('--latency', default=0.02, help='simulated latency of a call in seconds')
+@click.option('--latency_per_token', default=0.0, help='simulated prefill cost per prompt token in seconds')
+@click.option('--extraction_workers', type=int, default=None, help='processes extracting the pdf text (default: number of CPUs)')
+@click.option('--path2output', '-o', type=click.Path(dir_okay=False), default='benchmark.json', help='json file receiving the results')
+@click.option('--baseline', '-b', type=click.Path(exists=True, dir_okay=False), default=None, help='results of a previous run to compare with')
+@click.option('--tolerance', default=0.1, help='relative slowdown above which a duration counts as a regression')
+def main(nb_pages:List[int], pdf_pages:List[int], context_size:List[int], concurrency:List[int], page_size:int, latency:float, latency_per_token:float, extraction_workers:Optional[int], path2output:str, baseline:Optional[str], tolerance:float):
+    logging.disable(logging.INFO)
+    cases = [ ('memory', counter) for counter in nb_pages ] + [ ('pdf', counter) for counter in pdf_pages ]
+    results = []
+    with tempfile.TemporaryDirectory() as path2dir:
+        for (kind, counter), size, workers in itertools.product(cases, context_size, concurrency):
+            result = run_case(kind, counter, size, workers, page_size, latency, latency_per_token, extraction_workers, path2dir)
+            print(json.dumps({ key: value for key, value in result.items() if key not in ['answer', 'nb_calls_per_kind'] }))
+            results.append(result)
+
+    report = {
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'page_size': page_size,
+            'latency': latency,
+            'latency_per_token': latency_per_token
+        },
+        'results': results
+    }
+    with open(path2output, 'w') as fp:
+        json.dump(report, fp, indent=2)
+
+    if baseline is None:
+        return
+    with open(baseline) as fp:
+        rows = compare(results, json.load(fp)['results'], tolerance)
+    for row in rows:
+        print(json.dumps(row))
+    regressions = [ row for row in rows if len(row['regressions']) > 0 ]
+    print(f'{len(rows)} cases compared, {len(regressions)} regressions')
+    if len(regressions) > 0:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,35 @@
+import os
+import sys
+import glob
+import json
+import time
 import click 
+import uvicorn
 from dotenv import load_dotenv
 
 from src.log import logger 
 from src.settings import Credentials
 
 from typing import List, Tuple, Dict, Optional  
-from openai import OpenAI
+import asyncio
 
 from PyPDF2 import PdfReader
-from src.algorithms.strategies import llm_map_reduce
+from src.algorithms.strategies import MAX_TOKENS, fit_budget, llm_map_reduce, allm_map_reduce, llm_multi_map_reduce, allm_multi_map_reduce, llm_map_reduce_stream, llm_map_reduce_incremental, allm_map_reduce_incremental, llm_index, llm_index_reduce, allm_index_reduce
+from src.algorithms.scheduler import Scheduler
+from src.algorithms.cache import Cache, DEFAULT_CACHE_PATH
+from src.algorithms.partitioning import default_token_budget
+from src.algorithms.rate_limiter import ModelRateLimiters, RateLimitedOpenAI, AsyncRateLimitedOpenAI
+from src.algorithms.backends import openai_backend, async_openai_backend
+from src.algorithms.resilience import RetryPolicy, ResilientOpenAI, AsyncResilientOpenAI
+from src.algorithms.distributed import DistributedScheduler, Worker, DEFAULT_BROKER_ADDRESS
+from src.algorithms.corpus import llm_corpus_map_reduce
+from src.algorithms.batch import batch_map_reduce, build_map_batch, write_batch_file, DEFAULT_BATCH_DIR
+from src.algorithms.tracing import Tracer, span, annotate, summarize, format_summary
+from src.algorithms.retrieval import BM25Index, select_pages
+from src.algorithms.semantic_cache import SemanticCache
+from src.algorithms.budget import Budget, BudgetedOpenAI, AsyncBudgetedOpenAI, BudgetExceededError
+from src.server import create_app, DEFAULT_UPLOAD_DIR
+from src.extraction import PageStream, iter_pages, parse_page_ranges, file_hash, DEFAULT_EXTRACTION_CACHE_PATH
 
 from dotenv import load_dotenv
 
@@ -21,44 +42,742 @@ def handler(ctx:click.core.Context):
         'credentials': Credentials()
     } 
 
+def parse_map_max_tokens(ctx:click.core.Context, param:click.Parameter, value:str) -> Optional[int]:
+    # auto sizes the answer of every map call from its partition
+    if value == 'auto':
+        return None
+    try:
+        max_tokens = int(value)
+    except ValueError:
+        raise click.BadParameter(f'{value} is neither a number of tokens nor auto')
+    if max_tokens < 1:
+        raise click.BadParameter('max tokens must be greater than 0')
+    return max_tokens
+
+def read_queries(path2queries:str) -> List[str]:
+    with open(path2queries, mode='r', encoding='utf-8') as fp:
+        return [ line.strip() for line in fp if len(line.strip()) > 0 ]
+
+def read_query_group() -> List[str]:
+    # several query: lines, an empty line sends them together
+    queries:List[str] = []
+    while True:
+        query = input('query:').strip()
+        if len(query) > 0:
+            queries.append(query)
+        elif len(queries) > 0:
+            return queries
+
+def build_clients(credentials:Credentials, max_workers:int, engine:str, rate_limit:bool, requests_per_minute:Optional[int], tokens_per_minute:Optional[int], max_retries:int, request_timeout:float, hedge:bool, base_url:Optional[str]=None) -> Tuple[ResilientOpenAI, Optional[AsyncResilientOpenAI], Optional[ModelRateLimiters]]:
+    # the retry policy and the limiter own the retries, the client must surface every error
+    llm = openai_backend(credentials.openai_api_key, base_url)
+    allm = async_openai_backend(credentials.openai_api_key, base_url) if engine == 'async' else None
+    rate_limiter:Optional[ModelRateLimiters] = None
+    if rate_limit:
+        # one limiter per model name, the map calls of --map_model are paced on the limits of their own model
+        rate_limiter = ModelRateLimiters(requests_per_minute, tokens_per_minute, max_concurrency=max_workers)
+        llm = RateLimitedOpenAI(llm, rate_limiter)
+        allm = AsyncRateLimitedOpenAI(allm, rate_limiter) if allm is not None else None
+    # the limiter retries the 429s itself and adapts the concurrency, retrying them here too would multiply the attempts
+    retry_policy = RetryPolicy(max_retries=max_retries, timeout=request_timeout, hedge_quantile=0.95 if hedge else None, retry_rate_limits=not rate_limit)
+    llm = ResilientOpenAI(llm, retry_policy, max_workers=2 * max_workers)
+    allm = AsyncResilientOpenAI(allm, retry_policy) if allm is not None else None
+    return llm, allm, rate_limiter
+
 @handler.command()
 @click.option('--path2file', '-p', type=click.Path(exists=True, dir_okay=False), required=True)
 @click.option('--model', '-m', type=click.Choice(choices=['gpt-4o-mini', 'gpt-4o']), default='gpt-4o-mini')
 @click.option('--context_size', '-s', default=4, help='number of page for the map phase')
-@click.option('--limit', '-l', default=32)
+@click.option('--limit', '-l', default=32, help='max number of non empty pages, the extraction stops once they are collected')
+@click.option('--pages', 'page_ranges', type=str, default=None, help='1-based page ranges to read, e.g. 10-80,120-')
+@click.option('--max_workers', '-w', type=click.IntRange(min=1), default=8, help='max number of concurrent llm requests')
+@click.option('--engine', '-e', type=click.Choice(choices=['thread', 'async']), default='thread', help='thread pool or asyncio event loop')
+@click.option('--rate_limit/--no_rate_limit', default=True, help='pace the requests under the rpm/tpm budgets and adapt the concurrency to 429s')
+@click.option('--requests_per_minute', '--rpm', type=click.IntRange(min=1), default=None, help='requests per minute budget (default: follows the provider headers)')
+@click.option('--tokens_per_minute', '--tpm', type=click.IntRange(min=1), default=None, help='tokens per minute budget (default: follows the provider headers)')
+@click.option('--max_retries', type=click.IntRange(min=0), default=3, help='retries of a failed llm call, with jittered exponential backoff')
+@click.option('--request_timeout', type=click.FloatRange(min=0, min_open=True), default=60.0, help='timeout of a single llm call in seconds')
+@click.option('--hedge/--no_hedge', default=False, help='duplicate the calls slower than the p95 latency and keep the first answer')
+@click.option('--base_url', type=str, default=None, help='url of an openai compatible server (default: the openai api)')
+@click.option('--failure_tolerance', type=click.FloatRange(min=0, max=1), default=0.0, help='share of map calls allowed to fail, the reduce then runs on the partitions that succeeded')
+@click.option('--broker', type=str, default=None, help='zmq address to bind, e.g. tcp://*:5555, map and reduce calls then run on remote workers')
+@click.option('--cache/--no_cache', default=True, help='reuse map and reduce outputs across queries and sessions')
+@click.option('--path2cache', type=click.Path(dir_okay=False), default=DEFAULT_CACHE_PATH)
+@click.option('--cache_max_size', type=click.IntRange(min=1), default=256, help='max size of the cache in MB')
+@click.option('--index_mode', '-i', type=click.Choice(choices=['none', 'map', 'reduce']), default='none', help='digest every page once at load time, then map over the digests or reduce them directly')
+@click.option('--partitioning', type=click.Choice(choices=['pages', 'tokens']), default='pages', help='batch pages by count or pack them by token count')
+@click.option('--token_budget', '-t', type=click.IntRange(min=1), default=None, help='max tokens per map call when partitioning by tokens (default depends on the model)')
+@click.option('--fan_in', type=click.IntRange(min=2), default=None, help='max number of segments per reduce call (default: context_size)')
+@click.option('--reduce_token_budget', type=click.IntRange(min=1), default=None, help='max tokens of segments per reduce call (default depends on the model)')
+@click.option('--incremental', is_flag=True, default=False, help='merge map results in completion order instead of waiting for a whole level')
+@click.option('--stream/--no_stream', default=True, help='print the tokens of the final reduce as they arrive')
+@click.option('--path2pages_cache', type=click.Path(dir_okay=False), default=DEFAULT_EXTRACTION_CACHE_PATH, help='extracted page text keyed by file hash and page number')
+@click.option('--extraction_workers', type=click.IntRange(min=1), default=None, help='number of processes for the pdf text extraction (default: number of cpus)')
+@click.option('--path2trace', type=click.Path(dir_okay=False), default=None, help='json file receiving the span tree of every query')
+@click.option('--max_tokens_per_query', type=click.IntRange(min=1), default=None, help='max prompt and completion tokens spent by one query')
+@click.option('--max_cost_per_query', type=click.FloatRange(min=0, min_open=True), default=None, help='max dollars spent by one query')
+@click.option('--map_model', type=click.Choice(choices=['gpt-4o-mini', 'gpt-4o']), default=None, help='model of the map calls, the reduce calls keep --model (default: --model)')
+@click.option('--map_max_tokens', type=str, default=str(MAX_TOKENS), callback=parse_map_max_tokens, help='max tokens of a map answer, auto sizes it from the partition')
+@click.option('--reduce_max_tokens', type=click.IntRange(min=1), default=MAX_TOKENS, help='max tokens of a reduce answer')
+@click.option('--top_k', type=click.IntRange(min=1), default=None, help='map only the k pages closest to the query, scored with bm25 before any llm call')
+@click.option('--min_score', type=click.FloatRange(min=0, min_open=True), default=None, help='map only the pages whose bm25 score reaches this threshold')
+@click.option('--path2queries', type=click.Path(exists=True, dir_okay=False), default=None, help='text file with one query per line, answered together with one map pass before exiting')
+@click.option('--multi_query', is_flag=True, default=False, help='collect several query: lines, an empty line answers them together with one map pass')
+@click.option('--semantic_threshold', type=click.FloatRange(min=0, max=1, min_open=True), default=None, help='answer a query from a previous answer whose query is at least this similar (default: disabled)')
+@click.option('--semantic_ttl', type=click.FloatRange(min=0, min_open=True), default=3600.0, help='seconds an answer stays in the semantic cache')
+@click.option('--semantic_max_entries', type=click.IntRange(min=1), default=256, help='max answers in the semantic cache, least recently used first out')
 @click.pass_context
-def map_reduce(ctx:click.core.Context, path2file:str, model:str, context_size:int, limit:int):
+def map_reduce(ctx:click.core.Context, path2file:str, model:str, context_size:int, limit:int, page_ranges:Optional[str], max_workers:int, engine:str, rate_limit:bool, requests_per_minute:Optional[int], tokens_per_minute:Optional[int], max_retries:int, request_timeout:float, hedge:bool, base_url:Optional[str], failure_tolerance:float, broker:Optional[str], cache:bool, path2cache:str, cache_max_size:int, index_mode:str, partitioning:str, token_budget:Optional[int], fan_in:Optional[int], reduce_token_budget:Optional[int], incremental:bool, stream:bool, path2pages_cache:str, extraction_workers:Optional[int], path2trace:Optional[str], max_tokens_per_query:Optional[int], max_cost_per_query:Optional[float], map_model:Optional[str], map_max_tokens:Optional[int], reduce_max_tokens:int, top_k:Optional[int], min_score:Optional[float], path2queries:Optional[str], multi_query:bool, semantic_threshold:Optional[float], semantic_ttl:float, semantic_max_entries:int):
+    if broker is not None and engine == 'async':
+        raise click.BadParameter('remote workers are driven by the thread engine', param_hint='--broker')
+    budgeted = max_tokens_per_query is not None or max_cost_per_query is not None
+    if budgeted and (incremental or index_mode == 'reduce' or broker is not None):
+        # the budget is planned on a fixed tree whose map calls go through the local client
+        raise click.BadParameter('a query budget needs a fixed map phase run locally, without --incremental, --index_mode reduce or --broker', param_hint='--max_tokens_per_query/--max_cost_per_query')
+    if budgeted and hedge:
+        # a hedged duplicate is sent below the budget wrapper, it would be billed without being charged to its query
+        raise click.BadParameter('a query budget can not be combined with hedged duplicates', param_hint='--hedge')
+    grouped = path2queries is not None or multi_query
+    if grouped and (budgeted or incremental or index_mode == 'reduce' or top_k is not None or min_score is not None or semantic_threshold is not None or broker is not None):
+        # the queries of a group share every map call, nothing may depend on a single query before the reduce
+        # the grouped map call is not a task of the workers, it would run on the local client behind the broker
+        raise click.BadParameter('grouped queries share one fixed map pass run locally, without a query budget, --incremental, --index_mode reduce, --top_k, --min_score, --semantic_threshold or --broker', param_hint='--path2queries/--multi_query')
     credentials:Credentials = ctx.obj['settings']['credentials']
-    llm = OpenAI(api_key=credentials.openai_api_key)
+    llm, allm, rate_limiter = build_clients(credentials, max_workers, engine, rate_limit, requests_per_minute, tokens_per_minute, max_retries, request_timeout, hedge, base_url)
 
     pdf_reader = PdfReader(stream=path2file)
-    pages:List[str] = [ page.extract_text() for page in pdf_reader.pages ]
-    pages = [ page for page in pages if len(page) > 0]
-    
-    if len(pages) == 0:
+    page_numbers:Optional[List[int]] = None
+    if page_ranges is not None:
+        try:
+            page_numbers = parse_page_ranges(page_ranges, len(pdf_reader.pages))
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint='--pages')
+
+    pages_cache = Cache(path2cache=path2pages_cache) if cache else None
+    # the streamed map phase plans its leaves on this count, empty pages make it an upper bound
+    nb_expected_pages = len(page_numbers) if page_numbers is not None else len(pdf_reader.pages)
+    if limit is not None:
+        nb_expected_pages = min(nb_expected_pages, limit)
+    page_stream = PageStream(
+        iter_pages(path2file, max_workers=extraction_workers, cache=pages_cache, nb_pages=len(pdf_reader.pages), page_numbers=page_numbers),
+        limit=limit
+    )
+
+    if page_stream.is_empty():
         logger.warning('pdf file must contains at least one plain text page')
         exit(0)
-    pages = pages[:limit]
+    pages:List[str] = page_stream
 
+    if partitioning == 'tokens' and token_budget is None:
+        token_budget = default_token_budget(model)
+    if partitioning == 'pages':
+        token_budget = None
+
+    # with a broker, llm calls run on the workers and their rate budgets, the local pool only runs the continuations
+    scheduler = DistributedScheduler(broker, max_workers=max_workers) if broker is not None else Scheduler(max_workers=max_workers)
+    completion_cache = Cache(path2cache=path2cache, max_size=cache_max_size * 1024 * 1024) if cache else None
+    loop = asyncio.new_event_loop() if engine == 'async' else None
+
+    if index_mode != 'none':
+        start = time.perf_counter()
+        pages = page_stream.wait()
+        # the digests are the fan-out of the index, they run on the map model
+        pages = llm_index(
+            model=map_model or model,
+            llm=llm,
+            pages=pages,
+            scheduler=scheduler,
+            cache=completion_cache,
+            failure_tolerance=failure_tolerance
+        )
+        pages = [ page for page in pages if page is not None ]
+        logger.info(f'index of {len(pages)} page digests built in {time.perf_counter() - start:.2f}s')
+
+    page_index:Optional[BM25Index] = None
+    if top_k is not None or min_score is not None:
+        # built once per document, every query is then scored locally before the map phase
+        start = time.perf_counter()
+        if pages is page_stream:
+            pages = page_stream.wait()
+        page_index = BM25Index(pages)
+        logger.info(f'bm25 index of {len(pages)} pages built in {time.perf_counter() - start:.2f}s')
+
+    nb_streamed_tokens = 0
+    def on_token(token:str) -> None:
+        nonlocal nb_streamed_tokens
+        nb_streamed_tokens += 1
+        sys.stdout.write(token)
+        sys.stdout.flush()
+
+    # rephrased queries of the session are answered from memory, the answers are only shared within the same file
+    semantic_cache = SemanticCache(semantic_threshold, semantic_ttl, semantic_max_entries) if semantic_threshold is not None else None
+    document_key = file_hash(path2file) if semantic_cache is not None else None
+
+    pending_queries:Optional[List[str]] = read_queries(path2queries) if path2queries is not None else None
+    tracer = Tracer()
     while True:
         try:
+            if grouped:
+                if pending_queries is not None:
+                    # the queries of the file are answered once, then the command exits
+                    queries, pending_queries = pending_queries, []
+                    if len(queries) == 0:
+                        break
+                else:
+                    queries = read_query_group()
+                start = time.perf_counter()
+                with tracer.trace('queries', nb_queries=len(queries), engine=engine, index_mode=index_mode) as trace:
+                    if pages is page_stream:
+                        pages = page_stream.wait()
+                    if engine == 'async':
+                        answers:List[Optional[str]] = loop.run_until_complete(allm_multi_map_reduce(
+                            queries=queries,
+                            model=model,
+                            llm=allm,
+                            pages=pages,
+                            context_size=context_size,
+                            semaphore=asyncio.Semaphore(max_workers),
+                            cache=completion_cache,
+                            token_budget=token_budget,
+                            fan_in=fan_in,
+                            reduce_token_budget=reduce_token_budget,
+                            failure_tolerance=failure_tolerance,
+                            map_model=map_model,
+                            map_max_tokens=map_max_tokens,
+                            reduce_max_tokens=reduce_max_tokens
+                        ))
+                    else:
+                        scheduler.reset()
+                        answers:List[Optional[str]] = llm_multi_map_reduce(
+                            queries=queries,
+                            model=model,
+                            llm=llm,
+                            pages=pages,
+                            context_size=context_size,
+                            scheduler=scheduler,
+                            cache=completion_cache,
+                            token_budget=token_budget,
+                            fan_in=fan_in,
+                            reduce_token_budget=reduce_token_budget,
+                            failure_tolerance=failure_tolerance,
+                            map_model=map_model,
+                            map_max_tokens=map_max_tokens,
+                            reduce_max_tokens=reduce_max_tokens
+                        )
+                logger.info(f'time to answer {len(queries)} queries: {time.perf_counter() - start:.2f}s')
+                logger.info(f'trace: {format_summary(summarize(trace))}')
+                if path2trace is not None:
+                    tracer.write(path2trace)
+                for query, answer in zip(queries, answers):
+                    print(f'query: {query}')
+                    print(answer if answer is not None else 'none value was found during the map_reduce phase')
+                continue
             query = input('query:')
-            response:Optional[str] = llm_map_reduce(
-                query=query,
-                model=model,
-                llm=llm,
-                pages=pages,
-                context_size=context_size
-            )
+            start = time.perf_counter()
+            if semantic_cache is not None:
+                cached_answer = semantic_cache.get(document_key, query)
+                if cached_answer is not None:
+                    stats = semantic_cache.stats()
+                    logger.info(f"semantic cache hit in {(time.perf_counter() - start) * 1000:.2f}ms | hit rate: {stats['hit_rate']:.0%} | entries: {stats['nb_entries']}")
+                    print(cached_answer)
+                    continue
+            nb_streamed_tokens = 0
+            # every call of the query is a span under this root, grouped by level of the tree
+            with tracer.trace('query', query=query, engine=engine, index_mode=index_mode) as trace:
+                if pages is page_stream and (engine == 'async' or token_budget is not None or budgeted):
+                    pages = page_stream.wait()
+                budget:Optional[Budget] = None
+                query_llm, query_allm, query_pages, query_context_size, query_token_budget, query_map_model = llm, allm, pages, context_size, token_budget, map_model
+                if page_index is not None:
+                    with span('retrieval', nb_pages=len(pages)):
+                        query_pages = select_pages(page_index, pages, query, top_k, min_score)
+                        annotate(nb_selected=len(query_pages))
+                    logger.info(f'{len(query_pages)}/{len(pages)} pages selected for the query')
+                if budgeted:
+                    # the plan is degraded until its estimate fits, the budget then refuses the calls beyond it
+                    plan = fit_budget(
+                        query, query_pages, model, context_size, max_tokens_per_query, max_cost_per_query, token_budget,
+                        fan_in=fan_in, reduce_token_budget=reduce_token_budget, map_model=map_model, map_max_tokens=map_max_tokens, reduce_max_tokens=reduce_max_tokens
+                    )
+                    budget = Budget(max_tokens_per_query, max_cost_per_query)
+                    budget.reserve(plan.estimate)
+                    logger.info(f"estimate: {plan.estimate.nb_map_calls} map calls | {plan.estimate.nb_reduce_calls} reduce calls | {plan.estimate.tokens} tokens | ${plan.estimate.cost or 0.0:.4f}")
+                    if len(plan.degradations) > 0:
+                        logger.warning(f"plan degraded to fit the budget: {', '.join(plan.degradations)}")
+                    query_llm = BudgetedOpenAI(llm, budget)
+                    query_allm = AsyncBudgetedOpenAI(allm, budget) if allm is not None else None
+                    query_pages, query_context_size, query_token_budget, query_map_model = plan.pages, plan.context_size, plan.token_budget, plan.map_model
+                if engine == 'async':
+                    if index_mode == 'reduce':
+                        coroutine = allm_index_reduce(
+                            query=query,
+                            model=model,
+                            llm=allm,
+                            digests=query_pages,
+                            context_size=context_size,
+                            semaphore=asyncio.Semaphore(max_workers),
+                            cache=completion_cache,
+                            fan_in=fan_in,
+                            reduce_token_budget=reduce_token_budget,
+                            on_token=on_token if stream else None,
+                            max_tokens=reduce_max_tokens
+                        )
+                    elif incremental:
+                        coroutine = allm_map_reduce_incremental(
+                            query=query,
+                            model=model,
+                            llm=allm,
+                            pages=query_pages,
+                            context_size=context_size,
+                            semaphore=asyncio.Semaphore(max_workers),
+                            cache=completion_cache,
+                            token_budget=token_budget,
+                            fan_in=fan_in,
+                            reduce_token_budget=reduce_token_budget,
+                            on_token=on_token if stream else None,
+                            failure_tolerance=failure_tolerance,
+                            map_model=map_model,
+                            map_max_tokens=map_max_tokens,
+                            reduce_max_tokens=reduce_max_tokens
+                        )
+                    else:
+                        coroutine = allm_map_reduce(
+                            query=query,
+                            model=model,
+                            llm=query_allm,
+                            pages=query_pages,
+                            context_size=query_context_size,
+                            semaphore=asyncio.Semaphore(max_workers),
+                            cache=completion_cache,
+                            token_budget=query_token_budget,
+                            fan_in=fan_in,
+                            reduce_token_budget=reduce_token_budget,
+                            on_token=on_token if stream else None,
+                            failure_tolerance=failure_tolerance,
+                            map_model=query_map_model,
+                            map_max_tokens=map_max_tokens,
+                            reduce_max_tokens=reduce_max_tokens
+                        )
+                    response:Optional[str] = loop.run_until_complete(coroutine)
+                else:
+                    scheduler.reset()
+                    if incremental and index_mode != 'reduce':
+                        # completion order merges trade the cache hits of a fixed plan for a lower latency
+                        response:Optional[str] = llm_map_reduce_incremental(
+                            query=query,
+                            model=model,
+                            llm=llm,
+                            pages=query_pages,
+                            context_size=context_size,
+                            scheduler=scheduler,
+                            cache=completion_cache,
+                            token_budget=token_budget,
+                            fan_in=fan_in,
+                            reduce_token_budget=reduce_token_budget,
+                            on_token=on_token if stream else None,
+                            failure_tolerance=failure_tolerance,
+                            map_model=map_model,
+                            map_max_tokens=map_max_tokens,
+                            reduce_max_tokens=reduce_max_tokens
+                        )
+                    elif pages is page_stream:
+                        # map calls start while the last pages are still being extracted, the plan does not
+                        # depend on the extraction progress so that repeated queries hit the cache
+                        response:Optional[str] = llm_map_reduce_stream(
+                            query=query,
+                            model=model,
+                            llm=llm,
+                            pages=page_stream,
+                            nb_pages=len(page_stream.wait()) if page_stream.is_complete() else nb_expected_pages,
+                            context_size=context_size,
+                            scheduler=scheduler,
+                            cache=completion_cache,
+                            fan_in=fan_in,
+                            reduce_token_budget=reduce_token_budget,
+                            on_token=on_token if stream else None,
+                            failure_tolerance=failure_tolerance,
+                            map_model=map_model,
+                            map_max_tokens=map_max_tokens,
+                            reduce_max_tokens=reduce_max_tokens
+                        )
+                    elif index_mode == 'reduce':
+                        response:Optional[str] = llm_index_reduce(
+                            query=query,
+                            model=model,
+                            llm=llm,
+                            digests=query_pages,
+                            context_size=context_size,
+                            scheduler=scheduler,
+                            cache=completion_cache,
+                            fan_in=fan_in,
+                            reduce_token_budget=reduce_token_budget,
+                            on_token=on_token if stream else None,
+                            max_tokens=reduce_max_tokens
+                        )
+                    else:
+                        response:Optional[str] = llm_map_reduce(
+                            query=query,
+                            model=model,
+                            llm=query_llm,
+                            pages=query_pages,
+                            context_size=query_context_size,
+                            scheduler=scheduler,
+                            cache=completion_cache,
+                            token_budget=query_token_budget,
+                            fan_in=fan_in,
+                            reduce_token_budget=reduce_token_budget,
+                            on_token=on_token if stream else None,
+                            failure_tolerance=failure_tolerance,
+                            map_model=query_map_model,
+                            map_max_tokens=map_max_tokens,
+                            reduce_max_tokens=reduce_max_tokens
+                        )
+                    stats = scheduler.stats()
+                    logger.info(f"peak threads: {stats['peak_threads']} | peak in-flight requests: {stats['peak_in_flight']} | requests: {stats['nb_tasks']}")
+            logger.info(f'time to answer ({index_mode=}): {time.perf_counter() - start:.2f}s')
+            logger.info(f'trace: {format_summary(summarize(trace))}')
+            if budget is not None:
+                stats = budget.stats()
+                logger.info(f"spent: {stats['tokens']} tokens ({stats['cached_tokens']} cached) | ${stats['cost']:.4f} | refused calls: {stats['nb_refused']}")
+            if path2trace is not None:
+                tracer.write(path2trace)
+            if rate_limiter is not None:
+                stats = rate_limiter.stats()
+                logger.info(f"rate limited: {stats['nb_rate_limited']} | concurrency: {stats['concurrency']}")
+            if completion_cache is not None:
+                stats = completion_cache.stats()
+                logger.info(f"cache hits: {stats['hits']} | cache misses: {stats['misses']} | cache entries: {stats['nb_entries']}")
+            if semantic_cache is not None:
+                if response is not None:
+                    semantic_cache.put(document_key, query, response)
+                stats = semantic_cache.stats()
+                logger.info(f"semantic cache hit rate: {stats['hit_rate']:.0%} | entries: {stats['nb_entries']} | evictions: {stats['nb_evictions']}")
             if response is None:
                 logger.warning('none value was found during the map_reduce phase')
                 continue
+            if nb_streamed_tokens > 0:
+                print()
+                continue
             print(response)
         except KeyboardInterrupt:
             break 
+        except BudgetExceededError as e:
+            # only this query ran out of budget, the next one gets a budget of its own
+            if nb_streamed_tokens > 0:
+                print()
+                logger.warning(f'the answer above is partial, the query budget was spent: {e}')
+            else:
+                logger.warning(f'no answer within the query budget: {e}')
+            if budget is not None:
+                stats = budget.stats()
+                logger.info(f"spent: {stats['tokens']} tokens ({stats['cached_tokens']} cached) | ${stats['cost']:.4f} | refused calls: {stats['nb_refused']}")
+            continue
         except Exception as e:
             logger.error(e)
             break 
+    scheduler.shutdown()
+    if completion_cache is not None:
+        completion_cache.close()
+    if pages_cache is not None:
+        page_stream.wait()
+        pages_cache.close()
+    if loop is not None:
+        loop.run_until_complete(allm.close())
+        loop.close()
+
+def collect_pdf_files(paths:Tuple[str, ...]) -> List[str]:
+    path2files:List[str] = []
+    for path in paths:
+        if glob.has_magic(path):
+            path2files.extend(sorted(path2file for path2file in glob.glob(path) if path2file.lower().endswith('.pdf')))
+        elif os.path.isdir(path):
+            path2files.extend(sorted(
+                os.path.join(path, filename) for filename in os.listdir(path) if filename.lower().endswith('.pdf')
+            ))
+        else:
+            path2files.append(path)
+    return path2files
+
+def extract_documents(path2files:List[str], pages_cache:Optional[Cache], extraction_workers:Optional[int]) -> Tuple[Dict[str, List[str]], Dict[str, str]]:
+    # pages and file of every document id
+    documents:Dict[str, List[str]] = {}
+    document_paths:Dict[str, str] = {}
+    for counter, path2file in enumerate(path2files):
+        pages = [ text for _, text in iter_pages(path2file, max_workers=extraction_workers, cache=pages_cache) if len(text) > 0 ]
+        if len(pages) == 0:
+            logger.warning(f'{path2file} does not contain any plain text page')
+            continue
+        document_id = f'doc{counter}'
+        documents[document_id] = pages
+        document_paths[document_id] = path2file
+    return documents, document_paths
+
+@handler.command()
+@click.option('--path2file', '-p', 'paths', type=str, multiple=True, required=True, help='pdf file, directory or glob of pdf files, can be repeated')
+@click.option('--query', '-q', 'queries', type=str, multiple=True, help='query asked on every file, can be repeated')
+@click.option('--path2queries', type=click.Path(exists=True, dir_okay=False), default=None, help='json file mapping a pdf path to its list of queries')
+@click.option('--model', '-m', type=click.Choice(choices=['gpt-4o-mini', 'gpt-4o']), default='gpt-4o-mini')
+@click.option('--context_size', '-s', default=4, help='number of page for the map phase')
+@click.option('--max_workers', '-w', type=click.IntRange(min=1), default=8, help='max number of concurrent llm requests, shared by every document')
+@click.option('--rate_limit/--no_rate_limit', default=True, help='pace the requests under the rpm/tpm budgets and adapt the concurrency to 429s')
+@click.option('--requests_per_minute', '--rpm', type=click.IntRange(min=1), default=None, help='requests per minute budget (default: follows the provider headers)')
+@click.option('--tokens_per_minute', '--tpm', type=click.IntRange(min=1), default=None, help='tokens per minute budget (default: follows the provider headers)')
+@click.option('--max_retries', type=click.IntRange(min=0), default=3, help='retries of a failed llm call, with jittered exponential backoff')
+@click.option('--request_timeout', type=click.FloatRange(min=0, min_open=True), default=60.0, help='timeout of a single llm call in seconds')
+@click.option('--hedge/--no_hedge', default=False, help='duplicate the calls slower than the p95 latency and keep the first answer')
+@click.option('--base_url', type=str, default=None, help='url of an openai compatible server (default: the openai api)')
+@click.option('--failure_tolerance', type=click.FloatRange(min=0, max=1), default=0.0, help='share of map calls of a document allowed to fail')
+@click.option('--broker', type=str, default=None, help='zmq address to bind, e.g. tcp://*:5555, map and reduce calls then run on remote workers')
+@click.option('--cache/--no_cache', default=True, help='reuse map and reduce outputs across runs')
+@click.option('--path2cache', type=click.Path(dir_okay=False), default=DEFAULT_CACHE_PATH)
+@click.option('--cache_max_size', type=click.IntRange(min=1), default=256, help='max size of the cache in MB, least recently used entries are evicted first')
+@click.option('--partitioning', type=click.Choice(choices=['pages', 'tokens']), default='pages', help='batch pages by count or pack them by token count')
+@click.option('--token_budget', '-t', type=click.IntRange(min=1), default=None, help='max tokens per map call when partitioning by tokens (default depends on the model)')
+@click.option('--fan_in', type=click.IntRange(min=2), default=None, help='max number of segments per reduce call (default: context_size)')
+@click.option('--reduce_token_budget', type=click.IntRange(min=1), default=None, help='max tokens of segments per reduce call (default depends on the model)')
+@click.option('--path2output', type=click.Path(dir_okay=False), default=None, help='jsonl file of the answers (default: stdout)')
+@click.option('--path2pages_cache', type=click.Path(dir_okay=False), default=DEFAULT_EXTRACTION_CACHE_PATH, help='extracted page text keyed by file hash and page number')
+@click.option('--extraction_workers', type=click.IntRange(min=1), default=None, help='number of processes for the pdf text extraction (default: number of cpus)')
+@click.pass_context
+def corpus(ctx:click.core.Context, paths:Tuple[str, ...], queries:Tuple[str, ...], path2queries:Optional[str], model:str, context_size:int, max_workers:int, rate_limit:bool, requests_per_minute:Optional[int], tokens_per_minute:Optional[int], max_retries:int, request_timeout:float, hedge:bool, base_url:Optional[str], failure_tolerance:float, broker:Optional[str], cache:bool, path2cache:str, cache_max_size:int, partitioning:str, token_budget:Optional[int], fan_in:Optional[int], reduce_token_budget:Optional[int], path2output:Optional[str], path2pages_cache:str, extraction_workers:Optional[int]):
+    if len(queries) == 0 and path2queries is None:
+        raise click.UsageError('at least one --query or a --path2queries file is required')
+    queries_per_file:Dict[str, List[str]] = {}
+    if path2queries is not None:
+        with open(path2queries, mode='r', encoding='utf-8') as fp:
+            queries_per_file = { os.path.abspath(path2file): file_queries for path2file, file_queries in json.load(fp).items() }
+
+    credentials:Credentials = ctx.obj['settings']['credentials']
+    llm, _, rate_limiter = build_clients(credentials, max_workers, 'thread', rate_limit, requests_per_minute, tokens_per_minute, max_retries, request_timeout, hedge, base_url)
+
+    path2files = collect_pdf_files(paths)
+    if len(path2files) == 0:
+        logger.warning('no pdf file matches the given paths')
+        return
+
+    start = time.perf_counter()
+    pages_cache = Cache(path2cache=path2pages_cache) if cache else None
+    documents, document_paths = extract_documents(path2files, pages_cache, extraction_workers)
+    if pages_cache is not None:
+        pages_cache.close()
+    nb_pages = sum(len(pages) for pages in documents.values())
+    logger.info(f'{nb_pages} pages extracted from {len(documents)} documents in {time.perf_counter() - start:.2f}s')
+
+    # one job per document and query, every job of the corpus shares the same pool
+    jobs:Dict[str, Tuple[str, List[str]]] = {}
+    job_infos:Dict[str, Tuple[str, str]] = {}
+    for document_id, pages in documents.items():
+        path2file = document_paths[document_id]
+        for counter, query in enumerate(list(queries) + queries_per_file.get(os.path.abspath(path2file), [])):
+            job_id = f'{document_id}/q{counter}'
+            jobs[job_id] = (query, pages)
+            job_infos[job_id] = (path2file, query)
+
+    if partitioning == 'tokens' and token_budget is None:
+        token_budget = default_token_budget(model)
+    if partitioning == 'pages':
+        token_budget = None
+
+    fp = sys.stdout if path2output is None else open(path2output, mode='w', encoding='utf-8')
+    def on_result(job_id:str, answer:Optional[str], error:Optional[Exception]) -> None:
+        # answers are written as soon as a document is done, not in the order of the files
+        path2file, query = job_infos[job_id]
+        line = {'path2file': path2file, 'query': query, 'answer': answer}
+        if error is not None:
+            line['error'] = str(error)
+        fp.write(json.dumps(line, ensure_ascii=False) + '\n')
+        fp.flush()
+
+    completion_cache = Cache(path2cache=path2cache, max_size=cache_max_size * 1024 * 1024) if cache else None
+    scheduler = DistributedScheduler(broker, max_workers=max_workers) if broker is not None else Scheduler(max_workers=max_workers)
+    start = time.perf_counter()
+    try:
+        llm_corpus_map_reduce(
+            jobs=jobs,
+            model=model,
+            llm=llm,
+            context_size=context_size,
+            scheduler=scheduler,
+            cache=completion_cache,
+            token_budget=token_budget,
+            fan_in=fan_in,
+            reduce_token_budget=reduce_token_budget,
+            failure_tolerance=failure_tolerance,
+            on_result=on_result
+        )
+    finally:
+        duration = time.perf_counter() - start
+        scheduler.shutdown()
+        if path2output is not None:
+            fp.close()
+
+    # cache hits run as tasks on the pool but never reach the api
+    nb_calls = scheduler.stats()['nb_tasks']
+    if completion_cache is not None:
+        nb_calls -= completion_cache.stats()['hits']
+        completion_cache.close()
+    # a page asked two queries is processed twice
+    nb_job_pages = sum(len(pages) for _, pages in jobs.values())
+    logger.info(f'{len(jobs)} jobs on {nb_job_pages} pages in {duration:.2f}s | {nb_job_pages / duration:.2f} pages/s | {nb_calls} api calls | {nb_calls / duration:.2f} calls/s')
+    if rate_limiter is not None:
+        stats = rate_limiter.stats()
+        logger.info(f"rate limited: {stats['nb_rate_limited']} | concurrency: {stats['concurrency']}")
+
+@handler.command()
+@click.option('--path2file', '-p', 'paths', type=click.Path(exists=True), multiple=True, required=True, help='pdf file or directory of pdf files, can be repeated')
+@click.option('--query', '-q', type=str, required=True)
+@click.option('--model', '-m', type=click.Choice(choices=['gpt-4o-mini', 'gpt-4o']), default='gpt-4o-mini')
+@click.option('--context_size', '-s', default=4, help='number of page for the map phase')
+@click.option('--partitioning', type=click.Choice(choices=['pages', 'tokens']), default='pages', help='batch pages by count or pack them by token count')
+@click.option('--token_budget', '-t', type=click.IntRange(min=1), default=None, help='max tokens per map call when partitioning by tokens (default depends on the model)')
+@click.option('--fan_in', type=click.IntRange(min=2), default=None, help='max number of segments per reduce call (default: context_size)')
+@click.option('--reduce_token_budget', type=click.IntRange(min=1), default=None, help='max tokens of segments per reduce call (default depends on the model)')
+@click.option('--path2batch_dir', type=click.Path(file_okay=False), default=DEFAULT_BATCH_DIR, help='where the batch input files are written')
+@click.option('--poll_interval', type=click.FloatRange(min=0), default=30.0, help='seconds between two status checks of a batch')
+@click.option('--submit/--no_submit', default=True, help='submit the batches, or only write the map batch file to hand it off')
+@click.option('--path2output', type=click.Path(dir_okay=False), default=None, help='jsonl file of the answers (default: stdout)')
+@click.option('--cache/--no_cache', default=True, help='reuse map and reduce outputs across runs')
+@click.option('--path2cache', type=click.Path(dir_okay=False), default=DEFAULT_CACHE_PATH)
+@click.option('--path2pages_cache', type=click.Path(dir_okay=False), default=DEFAULT_EXTRACTION_CACHE_PATH, help='extracted page text keyed by file hash and page number')
+@click.option('--extraction_workers', type=click.IntRange(min=1), default=None, help='number of processes for the pdf text extraction (default: number of cpus)')
+@click.option('--base_url', type=str, default=None, help='url of an openai compatible server exposing the batch api (default: the openai api)')
+@click.pass_context
+def map_reduce_batch(ctx:click.core.Context, paths:Tuple[str, ...], query:str, model:str, context_size:int, partitioning:str, token_budget:Optional[int], fan_in:Optional[int], reduce_token_budget:Optional[int], path2batch_dir:str, poll_interval:float, submit:bool, path2output:Optional[str], cache:bool, path2cache:str, path2pages_cache:str, extraction_workers:Optional[int], base_url:Optional[str]):
+    credentials:Credentials = ctx.obj['settings']['credentials']
+    # no retry wrapper on the batch path, the client keeps the retries of the openai sdk for the file and batch calls
+    llm = openai_backend(credentials.openai_api_key, base_url, max_retries=2)
+
+    path2files = collect_pdf_files(paths)
+    pages_cache = Cache(path2cache=path2pages_cache) if cache else None
+    documents, document_paths = extract_documents(path2files, pages_cache, extraction_workers)
+    if pages_cache is not None:
+        pages_cache.close()
+    logger.info(f'{sum(len(pages) for pages in documents.values())} pages extracted from {len(documents)} documents')
+
+    if partitioning == 'tokens' and token_budget is None:
+        token_budget = default_token_budget(model)
+    if partitioning == 'pages':
+        token_budget = None
+
+    if not submit:
+        requests, _ = build_map_batch(query, model, documents, context_size, token_budget)
+        path2batch = write_batch_file(os.path.join(path2batch_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-map.jsonl"), model, requests)
+        logger.info(f'{len(requests)} map requests written to {path2batch}')
+        return
+
+    completion_cache = Cache(path2cache=path2cache) if cache else None
+    try:
+        answers = batch_map_reduce(
+            query=query,
+            model=model,
+            llm=llm,
+            context_size=context_size,
+            documents=documents,
+            path2batch_dir=path2batch_dir,
+            poll_interval=poll_interval,
+            cache=completion_cache,
+            token_budget=token_budget,
+            fan_in=fan_in,
+            reduce_token_budget=reduce_token_budget
+        )
+    finally:
+        if completion_cache is not None:
+            completion_cache.close()
+
+    lines = [
+        json.dumps({'path2file': document_paths[document_id], 'answer': answer}, ensure_ascii=False)
+        for document_id, answer in answers.items()
+    ]
+    if path2output is None:
+        print('\n'.join(lines))
+        return
+    with open(path2output, mode='w', encoding='utf-8') as fp:
+        fp.write('\n'.join(lines) + '\n')
+    logger.info(f'{len(lines)} answers written to {path2output}')
+
+
+@handler.command()
+@click.option('--path2file', '-p', 'paths', type=str, multiple=True, help='pdf file, directory or glob of pdf files loaded at startup, can be repeated')
+@click.option('--host', type=str, default='127.0.0.1')
+@click.option('--port', type=int, default=8000)
+@click.option('--model', '-m', type=click.Choice(choices=['gpt-4o-mini', 'gpt-4o']), default='gpt-4o-mini')
+@click.option('--context_size', '-s', default=4, help='number of page for the map phase')
+@click.option('--max_workers', '-w', type=click.IntRange(min=1), default=8, help='max number of concurrent llm requests, shared by every query')
+@click.option('--rate_limit/--no_rate_limit', default=True, help='pace the requests under the rpm/tpm budgets and adapt the concurrency to 429s')
+@click.option('--requests_per_minute', '--rpm', type=click.IntRange(min=1), default=None, help='requests per minute budget (default: follows the provider headers)')
+@click.option('--tokens_per_minute', '--tpm', type=click.IntRange(min=1), default=None, help='tokens per minute budget (default: follows the provider headers)')
+@click.option('--max_retries', type=click.IntRange(min=0), default=3, help='retries of a failed llm call, with jittered exponential backoff')
+@click.option('--request_timeout', type=click.FloatRange(min=0, min_open=True), default=60.0, help='timeout of a single llm call in seconds')
+@click.option('--hedge/--no_hedge', default=False, help='duplicate the calls slower than the p95 latency and keep the first answer')
+@click.option('--base_url', type=str, default=None, help='url of an openai compatible server (default: the openai api)')
+@click.option('--failure_tolerance', type=click.FloatRange(min=0, max=1), default=0.0, help='share of map calls allowed to fail, the reduce then runs on the partitions that succeeded')
+@click.option('--cache/--no_cache', default=True, help='reuse map and reduce outputs across queries and restarts')
+@click.option('--path2cache', type=click.Path(dir_okay=False), default=DEFAULT_CACHE_PATH)
+@click.option('--cache_max_size', type=click.IntRange(min=1), default=256, help='max size of the cache in MB, least recently used entries are evicted first')
+@click.option('--partitioning', type=click.Choice(choices=['pages', 'tokens']), default='pages', help='batch pages by count or pack them by token count')
+@click.option('--token_budget', '-t', type=click.IntRange(min=1), default=None, help='max tokens per map call when partitioning by tokens (default depends on the model)')
+@click.option('--fan_in', type=click.IntRange(min=2), default=None, help='max number of segments per reduce call (default: context_size)')
+@click.option('--reduce_token_budget', type=click.IntRange(min=1), default=None, help='max tokens of segments per reduce call (default depends on the model)')
+@click.option('--path2upload_dir', type=click.Path(file_okay=False), default=DEFAULT_UPLOAD_DIR, help='where the uploaded pdf files are stored')
+@click.option('--path2pages_cache', type=click.Path(dir_okay=False), default=DEFAULT_EXTRACTION_CACHE_PATH, help='extracted page text keyed by file hash and page number')
+@click.option('--extraction_workers', type=click.IntRange(min=1), default=None, help='number of processes for the pdf text extraction (default: number of cpus)')
+@click.pass_context
+def serve(ctx:click.core.Context, paths:Tuple[str, ...], host:str, port:int, model:str, context_size:int, max_workers:int, rate_limit:bool, requests_per_minute:Optional[int], tokens_per_minute:Optional[int], max_retries:int, request_timeout:float, hedge:bool, base_url:Optional[str], failure_tolerance:float, cache:bool, path2cache:str, cache_max_size:int, partitioning:str, token_budget:Optional[int], fan_in:Optional[int], reduce_token_budget:Optional[int], path2upload_dir:str, path2pages_cache:str, extraction_workers:Optional[int]):
+    credentials:Credentials = ctx.obj['settings']['credentials']
+    llm, _, _ = build_clients(credentials, max_workers, 'thread', rate_limit, requests_per_minute, tokens_per_minute, max_retries, request_timeout, hedge, base_url)
+
+    if partitioning == 'tokens' and token_budget is None:
+        token_budget = default_token_budget(model)
+    if partitioning == 'pages':
+        token_budget = None
+
+    scheduler = Scheduler(max_workers=max_workers)
+    completion_cache = Cache(path2cache=path2cache, max_size=cache_max_size * 1024 * 1024) if cache else None
+    pages_cache = Cache(path2cache=path2pages_cache) if cache else None
+    try:
+        app = create_app(
+            llm=llm,
+            model=model,
+            context_size=context_size,
+            scheduler=scheduler,
+            path2files=collect_pdf_files(paths),
+            cache=completion_cache,
+            pages_cache=pages_cache,
+            path2upload_dir=path2upload_dir,
+            token_budget=token_budget,
+            fan_in=fan_in,
+            reduce_token_budget=reduce_token_budget,
+            failure_tolerance=failure_tolerance,
+            extraction_workers=extraction_workers
+        )
+        uvicorn.run(app, host=host, port=port)
+    finally:
+        scheduler.shutdown()
+        if completion_cache is not None:
+            completion_cache.close()
+        if pages_cache is not None:
+            pages_cache.close()
+
+
+@handler.command()
+@click.option('--broker', type=str, default=DEFAULT_BROKER_ADDRESS, help='zmq address of the coordinator')
+@click.option('--model', '-m', type=click.Choice(choices=['gpt-4o-mini', 'gpt-4o']), default='gpt-4o-mini', help='model of the default rate budget')
+@click.option('--capacity', '-c', type=click.IntRange(min=1), default=8, help='max number of tasks run at once by this worker')
+@click.option('--rate_limit/--no_rate_limit', default=True, help='pace the requests under the rpm/tpm budgets and adapt the concurrency to 429s')
+@click.option('--requests_per_minute', '--rpm', type=click.IntRange(min=1), default=None, help='requests per minute budget of this worker (default: follows the provider headers)')
+@click.option('--tokens_per_minute', '--tpm', type=click.IntRange(min=1), default=None, help='tokens per minute budget of this worker (default: follows the provider headers)')
+@click.option('--max_retries', type=click.IntRange(min=0), default=3, help='retries of a failed llm call, with jittered exponential backoff')
+@click.option('--request_timeout', type=click.FloatRange(min=0, min_open=True), default=60.0, help='timeout of a single llm call in seconds')
+@click.option('--hedge/--no_hedge', default=False, help='duplicate the calls slower than the p95 latency and keep the first answer')
+@click.option('--base_url', type=str, default=None, help='url of an openai compatible server (default: the openai api)')
+@click.pass_context
+def worker(ctx:click.core.Context, broker:str, model:str, capacity:int, rate_limit:bool, requests_per_minute:Optional[int], tokens_per_minute:Optional[int], max_retries:int, request_timeout:float, hedge:bool, base_url:Optional[str]):
+    credentials:Credentials = ctx.obj['settings']['credentials']
+    llm, _, _ = build_clients(credentials, capacity, 'thread', rate_limit, requests_per_minute, tokens_per_minute, max_retries, request_timeout, hedge, base_url)
+    try:
+        Worker(llm, address=broker, capacity=capacity).run()
+    except KeyboardInterrupt:
+        pass
 
 
 if __name__ == '__main__':
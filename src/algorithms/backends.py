@@ -0,0 +1,238 @@
+import json
+import time
+import random
+import asyncio
+import hashlib
+import threading
+
+import httpx
+from types import SimpleNamespace
+from openai import OpenAI, AsyncOpenAI, APIConnectionError
+from openai.types import CompletionUsage
+from openai.types.completion_usage import PromptTokensDetails
+from openai.types.chat import ChatCompletion, ChatCompletionChunk, ChatCompletionMessage
+from openai.types.chat.chat_completion import Choice
+from openai.types.chat.chat_completion_chunk import Choice as ChunkChoice, ChoiceDelta
+
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Mapping, Optional, Protocol, Set, Tuple, Union
+
+from src.algorithms.prompts import map_system_prompt, multi_map_system_prompt, reduce_system_prompt, digest_system_prompt
+from src.algorithms.partitioning import estimate_tokens
+
+Messages = List[Dict[str, str]]
+
+# the strategies only need chat.completions.create with the openai arguments and return types
+# the openai clients, the rate limited and resilient wrappers and the fakes below all follow it
+class ChatCompletions(Protocol):
+    def create(self, **kwargs:Any) -> Any: ...
+
+class Chat(Protocol):
+    completions:ChatCompletions
+
+class LLMBackend(Protocol):
+    chat:Chat
+
+    def close(self) -> None: ...
+
+class AsyncChatCompletions(Protocol):
+    async def create(self, **kwargs:Any) -> Any: ...
+
+class AsyncChat(Protocol):
+    completions:AsyncChatCompletions
+
+class AsyncLLMBackend(Protocol):
+    chat:AsyncChat
+
+    async def close(self) -> None: ...
+
+def openai_backend(api_key:str, base_url:Optional[str]=None, max_retries:int=0) -> OpenAI:
+    # base_url points the client to any openai compatible server, vllm, llama.cpp, ollama...
+    return OpenAI(api_key=api_key, base_url=base_url, max_retries=max_retries)
+
+def async_openai_backend(api_key:str, base_url:Optional[str]=None, max_retries:int=0) -> AsyncOpenAI:
+    return AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=max_retries)
+
+# a map call serving several queries is still a map call for the rate budgets and the hedging
+KINDS = {map_system_prompt: 'map', multi_map_system_prompt: 'map', reduce_system_prompt: 'reduce', digest_system_prompt: 'digest'}
+
+def message_kind(messages:Messages) -> str:
+    return KINDS.get(messages[0]['content'], 'other') if len(messages) > 0 else 'other'
+
+# providers cache the prompts of at least 1024 tokens and serve the longest seen prefix in steps of 128 tokens
+PROMPT_CACHE_MIN_TOKENS = 1024
+PROMPT_CACHE_STEP_TOKENS = 128
+
+def fake_answer(messages:Messages) -> str:
+    # the same prompt always gets the same answer, so runs can be compared and cached
+    digest = hashlib.sha256(json.dumps(messages, ensure_ascii=False).encode('utf-8')).hexdigest()[:12]
+    return f'{message_kind(messages)} answer {digest}'
+
+def fake_error() -> Exception:
+    return APIConnectionError(request=httpx.Request('POST', 'http://fake/v1/chat/completions'))
+
+class FakeRawResponse:
+    # the shape read by the rate limiter : headers, then the parsed completion
+    def __init__(self, completion:Any, headers:Optional[Mapping[str, str]]=None):
+        self.completion = completion
+        self.headers = headers or {}
+
+    def parse(self) -> Any:
+        return self.completion
+
+class FakeBackend:
+    # in-process stand-in for an openai compatible server : simulated latency, failures and token counts
+    def __init__(self, latency:float=0.0, latency_per_token:float=0.0, failure_rate:float=0.0, fail_when:Optional[Callable[[Messages], bool]]=None, respond:Callable[[Messages], str]=fake_answer, error:Callable[[], Exception]=fake_error, seed:int=0):
+        if latency < 0 or latency_per_token < 0:
+            raise ValueError('latency must be greater than or equal to 0')
+        if not 0 <= failure_rate <= 1:
+            raise ValueError('failure_rate must be between 0 and 1')
+        self.latency = latency
+        self.latency_per_token = latency_per_token
+        self.failure_rate = failure_rate
+        self.fail_when = fail_when
+        self.respond = respond
+        self.error = error
+        self.random = random.Random(seed)
+        self.mutex = threading.Lock()
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.nb_calls = 0
+        self.nb_failures = 0
+        self.nb_calls_per_kind:Dict[str, int] = {}
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        self.prompt_prefixes:Set[str] = set()
+
+    def _cached_tokens(self, messages:Messages) -> int:
+        # hashes of the prompt prefixes at every cache step, a prefix seen by a previous call is served from the cache
+        prompt = ''.join(message['content'] for message in messages)
+        digest = hashlib.sha256()
+        cached_tokens = 0
+        start = 0
+        for end in range(4 * PROMPT_CACHE_MIN_TOKENS, len(prompt) + 1, 4 * PROMPT_CACHE_STEP_TOKENS):
+            digest.update(prompt[start:end].encode('utf-8'))
+            start = end
+            prefix = digest.hexdigest()
+            if prefix in self.prompt_prefixes:
+                cached_tokens = end // 4
+            self.prompt_prefixes.add(prefix)
+        return cached_tokens
+
+    def _start(self, kwargs:Dict[str, Any]) -> Tuple[float, Optional[Exception], int]:
+        messages:Messages = kwargs['messages']
+        prompt_tokens = sum(estimate_tokens(message['content']) for message in messages)
+        # the predicate runs outside the mutex, it may read the stats of this backend
+        failed = self.fail_when is not None and self.fail_when(messages)
+        with self.mutex:
+            self.nb_calls += 1
+            kind = message_kind(messages)
+            self.nb_calls_per_kind[kind] = self.nb_calls_per_kind.get(kind, 0) + 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            if self.fail_when is None:
+                failed = self.random.random() < self.failure_rate
+            if failed:
+                self.nb_failures += 1
+            cached_tokens = self._cached_tokens(messages) if not failed else 0
+        # the cached prefix is not processed again, only the rest of the prompt adds latency
+        return self.latency + self.latency_per_token * (prompt_tokens - cached_tokens), self.error() if failed else None, cached_tokens
+
+    def _finish(self) -> None:
+        with self.mutex:
+            self.in_flight -= 1
+
+    def _completion(self, kwargs:Dict[str, Any], cached_tokens:int=0) -> Union[ChatCompletion, List[ChatCompletionChunk]]:
+        messages:Messages = kwargs['messages']
+        answer = self.respond(messages)
+        prompt_tokens = sum(estimate_tokens(message['content']) for message in messages)
+        completion_tokens = estimate_tokens(answer)
+        with self.mutex:
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+            self.cached_tokens += cached_tokens
+        completion_id = f'chatcmpl-fake-{self.nb_calls}'
+        if kwargs.get('stream', False):
+            words = answer.split(' ')
+            tokens = [ word + ' ' for word in words[:-1] ] + [ words[-1] ]
+            return [
+                ChatCompletionChunk(
+                    id=completion_id, object='chat.completion.chunk', created=0, model=kwargs['model'],
+                    choices=[ ChunkChoice(index=0, delta=ChoiceDelta(content=token), finish_reason=None) ]
+                )
+                for token in tokens
+            ]
+        return ChatCompletion(
+            id=completion_id, object='chat.completion', created=0, model=kwargs['model'],
+            choices=[ Choice(index=0, finish_reason='stop', message=ChatCompletionMessage(role='assistant', content=answer)) ],
+            usage=CompletionUsage(
+                prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, total_tokens=prompt_tokens + completion_tokens,
+                prompt_tokens_details=PromptTokensDetails(cached_tokens=cached_tokens)
+            )
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        with self.mutex:
+            return {
+                'nb_calls': self.nb_calls,
+                'nb_failures': self.nb_failures,
+                'nb_calls_per_kind': dict(self.nb_calls_per_kind),
+                'peak_in_flight': self.peak_in_flight,
+                'prompt_tokens': self.prompt_tokens,
+                'completion_tokens': self.completion_tokens,
+                'cached_tokens': self.cached_tokens
+            }
+
+class FakeLLM(FakeBackend):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(
+            create=self._create,
+            with_raw_response=SimpleNamespace(create=lambda **kwargs: FakeRawResponse(self._create(**kwargs)))
+        ))
+
+    def _create(self, **kwargs) -> Union[ChatCompletion, Iterator[ChatCompletionChunk]]:
+        delay, error, cached_tokens = self._start(kwargs)
+        try:
+            time.sleep(delay)
+            if error is not None:
+                raise error
+            completion = self._completion(kwargs, cached_tokens)
+        finally:
+            self._finish()
+        return iter(completion) if isinstance(completion, list) else completion
+
+    def close(self) -> None:
+        pass
+
+class AsyncFakeLLM(FakeBackend):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+
+        async def create_raw(**kwargs) -> FakeRawResponse:
+            return FakeRawResponse(await self._create(**kwargs))
+
+        self.chat = SimpleNamespace(completions=SimpleNamespace(
+            create=self._create,
+            with_raw_response=SimpleNamespace(create=create_raw)
+        ))
+
+    async def _create(self, **kwargs) -> Union[ChatCompletion, AsyncIterator[ChatCompletionChunk]]:
+        delay, error, cached_tokens = self._start(kwargs)
+        try:
+            await asyncio.sleep(delay)
+            if error is not None:
+                raise error
+            completion = self._completion(kwargs, cached_tokens)
+        finally:
+            self._finish()
+        if isinstance(completion, list):
+            return self._stream(completion)
+        return completion
+
+    async def _stream(self, chunks:List[ChatCompletionChunk]) -> AsyncIterator[ChatCompletionChunk]:
+        for chunk in chunks:
+            yield chunk
+
+    async def close(self) -> None:
+        pass
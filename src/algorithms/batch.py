@@ -0,0 +1,160 @@
+import os
+import json
+import time
+
+from openai import OpenAI
+from openai.types import Batch
+
+from typing import Any, Dict, List, Optional, Tuple
+
+from src.algorithms.cache import Cache
+from src.algorithms.prompts import map_system_prompt
+from src.algorithms.partitioning import TokenCounter, get_token_counter
+from src.algorithms.strategies import (
+    MAX_TOKENS, MAP_RESPONSE_FORMAT, build_map_messages, build_reduce_messages, map_cache_key, reduce_cache_key, plan_leaves, plan_reduce, parse_map_result
+)
+from src.log import logger
+
+DEFAULT_BATCH_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'llm_map_reduce', 'batches')
+BATCH_ENDPOINT = '/v1/chat/completions'
+TERMINAL_STATUSES = ['completed', 'failed', 'expired', 'cancelled']
+
+# a batch request is identified by its custom_id, the messages of the request and the cache key of its answer
+BatchRequests = Dict[str, Tuple[List[Dict[str, str]], Optional[str]]]
+
+def build_batch_line(custom_id:str, model:str, messages:List[Dict[str, str]]) -> Dict[str, Any]:
+    return {
+        'custom_id': custom_id,
+        'method': 'POST',
+        'url': BATCH_ENDPOINT,
+        'body': {
+            'model': model,
+            'messages': messages,
+            'max_tokens': MAX_TOKENS,
+            **({'response_format': MAP_RESPONSE_FORMAT} if messages[0]['content'] == map_system_prompt else {})
+        }
+    }
+
+def write_batch_file(path2batch:str, model:str, requests:BatchRequests) -> str:
+    os.makedirs(os.path.dirname(os.path.abspath(path2batch)), exist_ok=True)
+    with open(path2batch, mode='w', encoding='utf-8') as fp:
+        for custom_id, (messages, _) in requests.items():
+            fp.write(json.dumps(build_batch_line(custom_id, model, messages), ensure_ascii=False) + '\n')
+    return path2batch
+
+def submit_batch(llm:OpenAI, path2batch:str) -> Batch:
+    with open(path2batch, mode='rb') as fp:
+        input_file = llm.files.create(file=fp, purpose='batch')
+    return llm.batches.create(input_file_id=input_file.id, endpoint=BATCH_ENDPOINT, completion_window='24h')
+
+def wait_batch(llm:OpenAI, batch:Batch, poll_interval:float=30.0) -> Batch:
+    while batch.status not in TERMINAL_STATUSES:
+        time.sleep(poll_interval)
+        batch = llm.batches.retrieve(batch.id)
+        logger.info(f'batch {batch.id} is {batch.status}')
+    if batch.status != 'completed':
+        raise RuntimeError(f'batch {batch.id} ended with status {batch.status}')
+    return batch
+
+def read_batch_results(llm:OpenAI, batch:Batch) -> Dict[str, Optional[str]]:
+    results:Dict[str, Optional[str]] = {}
+    if batch.output_file_id is not None:
+        for line in llm.files.content(batch.output_file_id).text.splitlines():
+            if len(line.strip()) == 0:
+                continue
+            item = json.loads(line)
+            response = item.get('response') or {}
+            if item.get('error') is not None or response.get('status_code') != 200:
+                results[item['custom_id']] = None
+                continue
+            results[item['custom_id']] = response['body']['choices'][0]['message']['content']
+    if batch.error_file_id is not None:
+        for line in llm.files.content(batch.error_file_id).text.splitlines():
+            if len(line.strip()) > 0:
+                item = json.loads(line)
+                logger.warning(f"batch request {item['custom_id']} failed : {item.get('error')}")
+                results.setdefault(item['custom_id'], None)
+    return results
+
+def run_batch(llm:OpenAI, model:str, requests:BatchRequests, path2batch:str, poll_interval:float=30.0, cache:Optional[Cache]=None) -> Dict[str, Optional[str]]:
+    # cached answers never leave the machine, only the missing requests are sent in the batch
+    results:Dict[str, Optional[str]] = {}
+    missing:BatchRequests = {}
+    for custom_id, (messages, key) in requests.items():
+        value = cache.get(key) if cache is not None and key is not None else None
+        if value is not None:
+            results[custom_id] = value
+        else:
+            missing[custom_id] = (messages, key)
+
+    if len(missing) == 0:
+        return results
+
+    write_batch_file(path2batch, model, missing)
+    batch = submit_batch(llm, path2batch)
+    logger.info(f'batch {batch.id} submitted with {len(missing)} requests')
+    batch = wait_batch(llm, batch, poll_interval)
+    for custom_id, value in read_batch_results(llm, batch).items():
+        if custom_id not in missing:
+            continue
+        results[custom_id] = value
+        key = missing[custom_id][1]
+        if cache is not None and key is not None and value is not None:
+            cache.put(key, value)
+    return results
+
+def build_map_batch(query:str, model:str, documents:Dict[str, List[str]], context_size:int, token_budget:Optional[int]=None, token_counter:Optional[TokenCounter]=None) -> Tuple[BatchRequests, Dict[str, List[str]]]:
+    # every map call of every document goes in the same batch, custom ids keep the leaf order of each document
+    requests:BatchRequests = {}
+    leaf_ids:Dict[str, List[str]] = {}
+    for document_id, pages in documents.items():
+        leaf_ids[document_id] = []
+        for counter, leaf in enumerate(plan_leaves(pages, model, context_size, token_budget, token_counter)):
+            custom_id = f'{document_id}/map/{counter}'
+            requests[custom_id] = (build_map_messages(page=leaf, query=query), map_cache_key(page=leaf, query=query, model=model))
+            leaf_ids[document_id].append(custom_id)
+    return requests, leaf_ids
+
+def batch_map_reduce(query:str, model:str, llm:OpenAI, context_size:int, documents:Dict[str, List[str]], path2batch_dir:str=DEFAULT_BATCH_DIR, poll_interval:float=30.0, cache:Optional[Cache]=None, token_budget:Optional[int]=None, token_counter:Optional[TokenCounter]=None, fan_in:Optional[int]=None, reduce_token_budget:Optional[int]=None) -> Dict[str, Optional[str]]:
+    # one batch for the map phase, then one batch per reduce level shared by every document
+    if token_counter is None:
+        token_counter = get_token_counter(model)
+
+    run_id = time.strftime('%Y%m%d-%H%M%S')
+    requests, leaf_ids = build_map_batch(query, model, documents, context_size, token_budget, token_counter)
+    results = run_batch(llm, model, requests, os.path.join(path2batch_dir, f'{run_id}-map.jsonl'), poll_interval, cache)
+
+    segments:Dict[str, List[str]] = {}
+    for document_id, custom_ids in leaf_ids.items():
+        # irrelevant partitions are dropped with the failed ones
+        answers = [ parse_map_result(results.get(custom_id)) for custom_id in custom_ids ]
+        segments[document_id] = [ answer for answer in answers if answer is not None ]
+
+    level = 0
+    while any(len(document_segments) > 1 for document_segments in segments.values()):
+        requests = {}
+        # each slot of the next level is either a promoted segment or the custom id of a reduce request
+        next_slots:Dict[str, List[Tuple[Optional[str], Optional[str]]]] = {}
+        for document_id, document_segments in segments.items():
+            if len(document_segments) <= 1:
+                continue
+            next_slots[document_id] = []
+            for counter, group in enumerate(plan_reduce(document_segments, model, fan_in or context_size, reduce_token_budget, token_counter)):
+                if len(group) == 1:
+                    # a lone segment is promoted as is instead of paying a reduce call
+                    next_slots[document_id].append((group[0], None))
+                    continue
+                custom_id = f'{document_id}/reduce/{level}/{counter}'
+                requests[custom_id] = (build_reduce_messages(accumulator=group, query=query), reduce_cache_key(accumulator=group, query=query, model=model))
+                next_slots[document_id].append((None, custom_id))
+
+        results = run_batch(llm, model, requests, os.path.join(path2batch_dir, f'{run_id}-reduce-{level}.jsonl'), poll_interval, cache)
+        for document_id, slots in next_slots.items():
+            next_segments = [ segment if custom_id is None else results.get(custom_id) for segment, custom_id in slots ]
+            segments[document_id] = [ segment for segment in next_segments if segment is not None ]
+        level += 1
+
+    return {
+        document_id: document_segments[0] if len(document_segments) > 0 else None
+        for document_id, document_segments in segments.items()
+    }
@@ -0,0 +1,212 @@
+import threading
+
+from types import SimpleNamespace
+
+from pydantic import BaseModel
+
+from typing import Any, AsyncIterator, Dict, Iterator, Optional, Tuple
+
+from src.algorithms.backends import LLMBackend, AsyncLLMBackend, message_kind
+from src.algorithms.partitioning import estimate_tokens
+from src.log import logger
+
+# dollars per million (prompt, completion) tokens
+MODEL_PRICES:Dict[str, Tuple[float, float]] = {
+    'gpt-4o-mini': (0.15, 0.60),
+    'gpt-4o': (2.50, 10.00)
+}
+
+# cached prompt tokens are billed at half the prompt price by openai
+CACHED_PROMPT_DISCOUNT = 0.5
+
+# the map model used when the configured one does not fit in a dollar budget
+CHEAPER_MODELS:Dict[str, str] = {
+    'gpt-4o': 'gpt-4o-mini'
+}
+
+class BudgetExceededError(Exception):
+    pass
+
+def model_price(model:str) -> Tuple[float, float]:
+    if model not in MODEL_PRICES:
+        raise ValueError(f'no price is known for {model}, use a token budget instead')
+    return MODEL_PRICES[model]
+
+def cost_of(model:str, prompt_tokens:int, completion_tokens:int, cached_tokens:int=0) -> float:
+    prompt_price, completion_price = model_price(model)
+    prompt_cost = (prompt_tokens - cached_tokens * CACHED_PROMPT_DISCOUNT) * prompt_price
+    return (prompt_cost + completion_tokens * completion_price) / 1_000_000
+
+class CostEstimate(BaseModel):
+    nb_map_calls:int = 0
+    nb_reduce_calls:int = 0
+    prompt_tokens:int = 0
+    completion_tokens:int = 0
+    reduce_tokens:int = 0
+    max_leaf_tokens:int = 0
+    cost:Optional[float] = None
+    reduce_cost:Optional[float] = None
+
+    @property
+    def tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+class Budget:
+    # spend of one query, in tokens and in dollars, shared by every call of the query
+    def __init__(self, max_tokens:Optional[int]=None, max_cost:Optional[float]=None):
+        if max_tokens is not None and max_tokens < 1:
+            raise ValueError('max_tokens must be greater than 0')
+        if max_cost is not None and max_cost <= 0:
+            raise ValueError('max_cost must be greater than 0')
+        self.max_tokens = max_tokens
+        self.max_cost = max_cost
+        self.mutex = threading.Lock()
+        self.tokens = 0
+        self.cached_tokens = 0
+        self.cost = 0.0
+        # prompt tokens and completion allowance of the calls in flight, charged before their usage is known
+        self.pending_tokens = 0
+        self.pending_cost = 0.0
+        # kept for the reduce calls, so that a query that ran out of budget in the map phase still gets an answer
+        self.reserved_tokens = 0
+        self.reserved_cost = 0.0
+        self.nb_calls = 0
+        self.nb_refused = 0
+
+    def reserve(self, estimate:CostEstimate) -> None:
+        with self.mutex:
+            self.reserved_tokens = estimate.reduce_tokens
+            self.reserved_cost = estimate.reduce_cost or 0.0
+
+    def acquire(self, model:str, prompt_tokens:int, kind:str, max_completion_tokens:int=0) -> Tuple[int, float]:
+        # the whole completion allowance is held until the usage is known, concurrent calls can not overshoot the cap together
+        tokens = prompt_tokens + max_completion_tokens
+        cost = cost_of(model, prompt_tokens, max_completion_tokens) if self.max_cost is not None else 0.0
+        with self.mutex:
+            reserved_tokens = self.reserved_tokens if kind != 'reduce' else 0
+            reserved_cost = self.reserved_cost if kind != 'reduce' else 0.0
+            over_tokens = self.max_tokens is not None and self.tokens + self.pending_tokens + tokens + reserved_tokens > self.max_tokens
+            over_cost = self.max_cost is not None and self.cost + self.pending_cost + cost + reserved_cost > self.max_cost
+            if over_tokens or over_cost:
+                self.nb_refused += 1
+                if self.nb_refused == 1:
+                    logger.warning(f'query budget spent ({self.tokens} tokens, ${self.cost:.4f}), the remaining {kind} calls are skipped')
+                raise BudgetExceededError(f'{kind} call refused, the query budget is spent')
+            self.pending_tokens += tokens
+            self.pending_cost += cost
+        return tokens, cost
+
+    def release(self, pending:Tuple[int, float]) -> None:
+        with self.mutex:
+            self.pending_tokens -= pending[0]
+            self.pending_cost -= pending[1]
+
+    def charge(self, pending:Tuple[int, float], model:str, prompt_tokens:int, completion_tokens:int, cached_tokens:int=0) -> None:
+        cost = cost_of(model, prompt_tokens, completion_tokens, cached_tokens) if self.max_cost is not None else 0.0
+        with self.mutex:
+            self.pending_tokens -= pending[0]
+            self.pending_cost -= pending[1]
+            self.tokens += prompt_tokens + completion_tokens
+            self.cached_tokens += cached_tokens
+            self.cost += cost
+            self.nb_calls += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self.mutex:
+            return {
+                'nb_calls': self.nb_calls,
+                'nb_refused': self.nb_refused,
+                'tokens': self.tokens,
+                'cached_tokens': self.cached_tokens,
+                'cost': round(self.cost, 6),
+                'max_tokens': self.max_tokens,
+                'max_cost': self.max_cost
+            }
+
+def prompt_tokens_of(kwargs:Dict[str, Any]) -> int:
+    return sum(estimate_tokens(message['content']) for message in kwargs['messages'])
+
+def usage_of(completion:Any, kwargs:Dict[str, Any], content:Optional[str]) -> Tuple[int, int, int]:
+    # the billed usage when the server reports it, the estimate otherwise
+    usage = getattr(completion, 'usage', None)
+    prompt_tokens = getattr(usage, 'prompt_tokens', None)
+    completion_tokens = getattr(usage, 'completion_tokens', None)
+    cached_tokens = getattr(getattr(usage, 'prompt_tokens_details', None), 'cached_tokens', None)
+    if isinstance(prompt_tokens, int) and isinstance(completion_tokens, int):
+        return prompt_tokens, completion_tokens, cached_tokens if isinstance(cached_tokens, int) else 0
+    return prompt_tokens_of(kwargs), estimate_tokens(content or ''), 0
+
+class BudgetedCompletions:
+    def __init__(self, completions:Any, budget:Budget):
+        self.completions = completions
+        self.budget = budget
+
+    def create(self, **kwargs) -> Any:
+        pending = self.budget.acquire(kwargs['model'], prompt_tokens_of(kwargs), message_kind(kwargs['messages']), kwargs.get('max_tokens') or 0)
+        try:
+            completion = self.completions.create(**kwargs)
+        except BaseException:
+            self.budget.release(pending)
+            raise
+        if kwargs.get('stream', False):
+            return self._stream(completion, kwargs, pending)
+        prompt_tokens, completion_tokens, cached_tokens = usage_of(completion, kwargs, completion.choices[0].message.content)
+        self.budget.charge(pending, kwargs['model'], prompt_tokens, completion_tokens, cached_tokens)
+        return completion
+
+    def _stream(self, chunks:Iterator[Any], kwargs:Dict[str, Any], pending:Tuple[int, float]) -> Iterator[Any]:
+        tokens = []
+        try:
+            for chunk in chunks:
+                if len(chunk.choices) > 0 and chunk.choices[0].delta.content is not None:
+                    tokens.append(chunk.choices[0].delta.content)
+                yield chunk
+        finally:
+            self.budget.charge(pending, kwargs['model'], prompt_tokens_of(kwargs), estimate_tokens("".join(tokens)))
+
+class AsyncBudgetedCompletions:
+    def __init__(self, completions:Any, budget:Budget):
+        self.completions = completions
+        self.budget = budget
+
+    async def create(self, **kwargs) -> Any:
+        pending = self.budget.acquire(kwargs['model'], prompt_tokens_of(kwargs), message_kind(kwargs['messages']), kwargs.get('max_tokens') or 0)
+        try:
+            completion = await self.completions.create(**kwargs)
+        except BaseException:
+            self.budget.release(pending)
+            raise
+        if kwargs.get('stream', False):
+            return self._stream(completion, kwargs, pending)
+        prompt_tokens, completion_tokens, cached_tokens = usage_of(completion, kwargs, completion.choices[0].message.content)
+        self.budget.charge(pending, kwargs['model'], prompt_tokens, completion_tokens, cached_tokens)
+        return completion
+
+    async def _stream(self, chunks:AsyncIterator[Any], kwargs:Dict[str, Any], pending:Tuple[int, float]) -> AsyncIterator[Any]:
+        tokens = []
+        try:
+            async for chunk in chunks:
+                if len(chunk.choices) > 0 and chunk.choices[0].delta.content is not None:
+                    tokens.append(chunk.choices[0].delta.content)
+                yield chunk
+        finally:
+            self.budget.charge(pending, kwargs['model'], prompt_tokens_of(kwargs), estimate_tokens("".join(tokens)))
+
+class BudgetedOpenAI:
+    # refuses the calls of a query once its budget is spent, outermost wrapper so that retries are not refused midway
+    def __init__(self, llm:LLMBackend, budget:Budget):
+        self.llm = llm
+        self.budget = budget
+        self.chat = SimpleNamespace(completions=BudgetedCompletions(llm.chat.completions, budget))
+
+    def close(self) -> None:
+        self.llm.close()
+
+class AsyncBudgetedOpenAI:
+    def __init__(self, llm:AsyncLLMBackend, budget:Budget):
+        self.llm = llm
+        self.budget = budget
+        self.chat = SimpleNamespace(completions=AsyncBudgetedCompletions(llm.chat.completions, budget))
+
+    async def close(self) -> None:
+        await self.llm.close()
@@ -0,0 +1,98 @@
+import os
+import time
+import json
+import sqlite3
+import hashlib
+import threading
+
+from typing import Any, Dict, Optional
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'llm_map_reduce', 'completions.db')
+
+class Cache:
+    def __init__(self, path2cache:str=DEFAULT_CACHE_PATH, max_size:int=256 * 1024 * 1024):
+        if path2cache != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path2cache)), exist_ok=True)
+        self.path2cache = path2cache
+        self.max_size = max_size
+        self.mutex = threading.Lock()
+        self.connection = sqlite3.connect(path2cache, check_same_thread=False)
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS completions (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            """
+        )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS completions_accessed_at ON completions(accessed_at)')
+        self.connection.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def __enter__(self) -> 'Cache':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def close(self) -> None:
+        with self.mutex:
+            self.connection.close()
+
+    @staticmethod
+    def make_key(*parts:Any) -> str:
+        serialized = json.dumps(parts, ensure_ascii=False)
+        return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+    def get(self, key:str) -> Optional[str]:
+        with self.mutex:
+            row = self.connection.execute('SELECT value FROM completions WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.connection.execute('UPDATE completions SET accessed_at = ? WHERE key = ?', (time.time(), key))
+            self.connection.commit()
+            return row[0]
+
+    def put(self, key:str, value:str) -> None:
+        size = len(value.encode('utf-8'))
+        with self.mutex:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO completions (key, value, size, accessed_at) VALUES (?, ?, ?, ?)',
+                (key, value, size, time.time())
+            )
+            self._evict()
+            self.connection.commit()
+
+    def _evict(self) -> None:
+        # least recently used entries go first until the cache fits in max_size
+        total_size = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM completions').fetchone()[0]
+        if total_size <= self.max_size:
+            return
+        rows = self.connection.execute('SELECT key, size FROM completions ORDER BY accessed_at ASC').fetchall()
+        for key, size in rows:
+            if total_size <= self.max_size:
+                break
+            self.connection.execute('DELETE FROM completions WHERE key = ?', (key,))
+            total_size -= size
+
+    def clear(self) -> None:
+        with self.mutex:
+            self.connection.execute('DELETE FROM completions')
+            self.connection.commit()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self.mutex:
+            nb_entries, size = self.connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completions').fetchone()
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'nb_entries': nb_entries,
+                'size': size
+            }
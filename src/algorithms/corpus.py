@@ -0,0 +1,113 @@
+import queue
+
+from itertools import zip_longest
+
+from typing import Callable, Dict, List, Optional, Tuple
+
+from concurrent.futures import Future
+
+from src.algorithms.cache import Cache
+from src.algorithms.backends import LLMBackend
+from src.algorithms.scheduler import Scheduler
+from src.algorithms.partitioning import TokenCounter, get_token_counter
+from src.algorithms.strategies import DEFAULT_MAX_WORKERS, llm_map, llm_reduce, plan_leaves, plan_reduce, gather_map_results
+from src.log import logger
+
+# a job answers one query on the pages of one document
+CorpusJobs = Dict[str, Tuple[str, List[str]]]
+ResultCallback = Callable[[str, Optional[str], Optional[Exception]], None]
+
+class JobState:
+    def __init__(self, query:str):
+        self.query = query
+        self.level = 0
+        self.features:List[Future] = []
+        self.nb_pending = 0
+
+def llm_corpus_map_reduce(jobs:CorpusJobs, model:str, llm:LLMBackend, context_size:int, scheduler:Optional[Scheduler]=None, cache:Optional[Cache]=None, token_budget:Optional[int]=None, token_counter:Optional[TokenCounter]=None, fan_in:Optional[int]=None, reduce_token_budget:Optional[int]=None, failure_tolerance:float=0.0, on_result:Optional[ResultCallback]=None) -> Dict[str, Optional[str]]:
+    # every job shares the same pool : map calls are interleaved across documents and the reduce levels
+    # of a job are submitted from this thread as soon as its previous level completes, no worker waits on another
+    if scheduler is None:
+        with Scheduler(max_workers=DEFAULT_MAX_WORKERS) as scheduler:
+            return llm_corpus_map_reduce(jobs, model, llm, context_size, scheduler, cache, token_budget, token_counter, fan_in, reduce_token_budget, failure_tolerance, on_result)
+
+    if token_counter is None:
+        token_counter = get_token_counter(model)
+    fan_in = fan_in or context_size
+
+    completed:queue.Queue = queue.Queue()
+    states:Dict[str, JobState] = {}
+    answers:Dict[str, Optional[str]] = {}
+
+    def watch(job_id:str, features:List[Future]) -> None:
+        states[job_id].features = features
+        states[job_id].nb_pending = len(features)
+        for future in features:
+            future.add_done_callback(lambda _, job_id=job_id: completed.put(job_id))
+
+    def finish(job_id:str, answer:Optional[str], error:Optional[Exception]=None) -> None:
+        del states[job_id]
+        answers[job_id] = answer
+        if error is not None:
+            logger.error(f'job {job_id} failed : {error}')
+        if on_result is not None:
+            on_result(job_id, answer, error)
+
+    def advance(job_id:str) -> None:
+        state = states[job_id]
+        try:
+            if state.level == 0:
+                segments = gather_map_results(state.features, failure_tolerance)
+            else:
+                segments = [ future.result() for future in state.features ]
+        except Exception as e:
+            finish(job_id, None, e)
+            return
+
+        segments = [ segment for segment in segments if segment is not None ]
+        if len(segments) <= 1:
+            finish(job_id, segments[0] if len(segments) > 0 else None)
+            return
+
+        features:List[Future] = []
+        for group in plan_reduce(segments, model, fan_in, reduce_token_budget, token_counter):
+            if len(group) == 1:
+                features.append(scheduler.done(group[0]))
+                continue
+            features.append(
+                scheduler.submit(llm_reduce, accumulator=group, model=model, llm=llm, query=state.query, cache=cache)
+            )
+        state.level += 1
+        watch(job_id, features)
+
+    leaves:Dict[str, List[str]] = {}
+    for job_id, (query, pages) in jobs.items():
+        if len(pages) == 0:
+            answers[job_id] = None
+            if on_result is not None:
+                on_result(job_id, None, None)
+            continue
+        states[job_id] = JobState(query)
+        leaves[job_id] = plan_leaves(pages, model, context_size, token_budget, token_counter)
+
+    # round robin over the jobs : the pool queue holds the first leaves of every document before the last leaves of any
+    features:Dict[str, List[Future]] = { job_id: [] for job_id in leaves }
+    for round_leaves in zip_longest(*[ [ (job_id, leaf) for leaf in job_leaves ] for job_id, job_leaves in leaves.items() ]):
+        for item in round_leaves:
+            if item is None:
+                continue
+            job_id, leaf = item
+            features[job_id].append(
+                scheduler.submit(llm_map, page=leaf, model=model, llm=llm, query=states[job_id].query, cache=cache)
+            )
+    for job_id, job_features in features.items():
+        watch(job_id, job_features)
+
+    while len(states) > 0:
+        job_id = completed.get()
+        state = states[job_id]
+        state.nb_pending -= 1
+        if state.nb_pending == 0:
+            advance(job_id)
+
+    return answers
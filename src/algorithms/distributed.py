@@ -0,0 +1,370 @@
+import json
+import time
+import uuid
+import queue
+import threading
+
+import zmq
+from collections import deque
+
+from typing import Any, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from src.algorithms.cache import Cache
+from src.algorithms.backends import LLMBackend
+from src.algorithms.scheduler import Scheduler
+from src.algorithms.tracing import start_span, finish_span
+from src.algorithms.strategies import (
+    TokenCallback, MapResult, llm_map, llm_reduce, llm_digest, map_cache_key, reduce_cache_key, digest_cache_key, parse_map_result
+)
+from src.log import logger
+
+DEFAULT_BROKER_ADDRESS = 'tcp://127.0.0.1:5555'
+HEARTBEAT_INTERVAL = 1.0
+HEARTBEAT_LIVENESS = 3
+
+# frames : [command, task_id, json payload], the router prepends the identity of the worker
+READY = b'READY'
+HEARTBEAT = b'HEARTBEAT'
+TASK = b'TASK'
+RESULT = b'RESULT'
+ERROR = b'ERROR'
+TOKEN = b'TOKEN'
+
+# only these calls leave the coordinator, workers run them with their own client
+TASKS:Dict[str, Tuple[Callable[..., Optional[str]], Callable[..., str]]] = {
+    'llm_map': (llm_map, map_cache_key),
+    'llm_reduce': (llm_reduce, reduce_cache_key),
+    'llm_digest': (llm_digest, digest_cache_key)
+}
+
+class RemoteTaskError(Exception):
+    def __init__(self, error_type:str, message:str):
+        super().__init__(f'{error_type}: {message}')
+        self.error_type = error_type
+
+class Mailbox:
+    # thread safe hand-off to the thread polling the sockets, the inproc pair only wakes the poller up
+    def __init__(self, context:zmq.Context):
+        address = f'inproc://mailbox-{uuid.uuid4().hex}'
+        self.receiver = context.socket(zmq.PULL)
+        self.receiver.bind(address)
+        self.sender = context.socket(zmq.PUSH)
+        self.sender.connect(address)
+        self.items:queue.Queue = queue.Queue()
+        self.mutex = threading.Lock()
+
+    def put(self, item:Any) -> None:
+        self.items.put(item)
+        with self.mutex:
+            try:
+                self.sender.send(b'', zmq.NOBLOCK)
+            except zmq.Again:
+                # the poller is already awake with a full pipe, the item is picked up anyway
+                pass
+
+    def drain(self) -> List[Any]:
+        while True:
+            try:
+                self.receiver.recv(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+        items:List[Any] = []
+        while True:
+            try:
+                items.append(self.items.get_nowait())
+            except queue.Empty:
+                return items
+
+    def close(self) -> None:
+        self.sender.close(linger=0)
+        self.receiver.close(linger=0)
+
+class RemoteTask:
+    def __init__(self, task_id:str, name:str, kwargs:Dict[str, Any], future:Future, cache:Optional[Cache], key:Optional[str], on_token:Optional[TokenCallback]):
+        self.task_id = task_id
+        self.name = name
+        self.kwargs = kwargs
+        self.future = future
+        self.cache = cache
+        self.key = key
+        self.on_token = on_token
+        self.worker:Optional[bytes] = None
+        self.nb_dispatches = 0
+        self.nb_tokens = 0
+
+class WorkerState:
+    def __init__(self, capacity:int):
+        self.capacity = capacity
+        self.tasks:Set[str] = set()
+        self.last_seen = time.monotonic()
+
+class DistributedScheduler(Scheduler):
+    # same interface as Scheduler : llm calls are pushed to remote workers, anything else runs on the local pool
+    def __init__(self, address:str=DEFAULT_BROKER_ADDRESS, max_workers:int=8, heartbeat_interval:float=HEARTBEAT_INTERVAL, heartbeat_liveness:int=HEARTBEAT_LIVENESS, max_dispatches:int=3):
+        super().__init__(max_workers=max_workers)
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_liveness = heartbeat_liveness
+        self.max_dispatches = max_dispatches
+        self.context = zmq.Context()
+        self.router = self.context.socket(zmq.ROUTER)
+        self.router.setsockopt(zmq.LINGER, 0)
+        self.router.bind(address)
+        self.address = self.router.getsockopt_string(zmq.LAST_ENDPOINT)
+        self.mailbox = Mailbox(self.context)
+        self.workers:Dict[bytes, WorkerState] = {}
+        self.tasks:Dict[str, RemoteTask] = {}
+        self.pending:Deque[RemoteTask] = deque()
+        self.nb_redispatched = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+        logger.info(f'broker listening on {self.address}')
+
+    def submit(self, fn:Callable[..., Any], *args, **kwargs) -> Future:
+        name = getattr(fn, '__name__', None)
+        if name not in TASKS or len(args) > 0:
+            return super().submit(fn, *args, **kwargs)
+
+        kwargs.pop('llm', None)
+        cache:Optional[Cache] = kwargs.pop('cache', None)
+        on_token:Optional[TokenCallback] = kwargs.pop('on_token', None)
+        # a cache hit is a task like on the local pool, nb_tasks minus the cache hits is the number of api calls
+        with self.mutex:
+            self.nb_tasks += 1
+        # the cache stays on the coordinator, workers never see it
+        key = TASKS[name][1](**kwargs) if cache is not None else None
+        if key is not None:
+            value = cache.get(key)
+            if value is not None:
+                finish_span(start_span(name.replace('llm_', ''), remote=True, cache_hit=True))
+                if name == 'llm_map':
+                    # a map answer cached by a local run is the raw json object
+                    value = parse_map_result(value)
+                if on_token is not None:
+                    on_token(value)
+                return self.done(value)
+
+        future:Future = Future()
+        # the span covers the dispatch and the remote call, the worker does not report the token usage
+        remote_span = start_span(name.replace('llm_', ''), remote=True)
+        if remote_span is not None:
+            future.add_done_callback(lambda future: finish_span(remote_span, future.exception()))
+        self.mailbox.put(RemoteTask(uuid.uuid4().hex, name, kwargs, future, cache, key, on_token))
+        return future
+
+    def shutdown(self) -> None:
+        self.stopped.set()
+        self.mailbox.put(None)
+        self.thread.join()
+        self.mailbox.close()
+        self.router.close(linger=0)
+        self.context.term()
+        super().shutdown()
+
+    def stats(self) -> Dict[str, int]:
+        stats = super().stats()
+        with self.mutex:
+            stats['nb_workers'] = len(self.workers)
+            stats['nb_redispatched'] = self.nb_redispatched
+        return stats
+
+    def _serve(self) -> None:
+        # every socket and every piece of broker state is owned by this thread
+        poller = zmq.Poller()
+        poller.register(self.router, zmq.POLLIN)
+        poller.register(self.mailbox.receiver, zmq.POLLIN)
+        next_heartbeat = time.monotonic() + self.heartbeat_interval
+        while not self.stopped.is_set():
+            events = dict(poller.poll(timeout=self.heartbeat_interval * 1000))
+            for task in self.mailbox.drain():
+                if task is not None:
+                    self.tasks[task.task_id] = task
+                    self.pending.append(task)
+            if self.router in events:
+                while True:
+                    try:
+                        frames = self.router.recv_multipart(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+                    self._handle(*frames)
+            now = time.monotonic()
+            if now >= next_heartbeat:
+                for identity in list(self.workers):
+                    self.router.send_multipart([identity, HEARTBEAT, b'', b'{}'])
+                self._check_workers(now)
+                next_heartbeat = now + self.heartbeat_interval
+            self._dispatch()
+
+        for task in self.mailbox.drain():
+            if task is not None:
+                self.tasks[task.task_id] = task
+        for task in self.tasks.values():
+            if not task.future.done():
+                task.future.set_exception(RuntimeError('scheduler was shut down'))
+
+    def _handle(self, identity:bytes, command:bytes, task_id:bytes, payload:bytes) -> None:
+        data = json.loads(payload)
+        worker = self.workers.get(identity)
+        if worker is None and command in (READY, HEARTBEAT):
+            # a worker declared dead by mistake registers again with its next heartbeat
+            worker = WorkerState(capacity=data['capacity'])
+            with self.mutex:
+                self.workers[identity] = worker
+            logger.info(f'worker {identity.hex()} joined with {worker.capacity} slots')
+        if worker is not None:
+            worker.last_seen = time.monotonic()
+
+        task = self.tasks.get(task_id.decode('utf-8'))
+        if command == TOKEN:
+            if task is not None and task.on_token is not None:
+                task.nb_tokens += 1
+                task.on_token(data['token'])
+            return
+        if command not in (RESULT, ERROR):
+            return
+        if worker is not None:
+            worker.tasks.discard(task_id.decode('utf-8'))
+        if task is None:
+            # the task was dispatched twice and the other worker answered first
+            return
+        self._release(task)
+        if command == ERROR:
+            task.future.set_exception(RemoteTaskError(data['type'], data['message']))
+            return
+        value = data['value']
+        if task.cache is not None and task.key is not None:
+            if value is not None:
+                task.cache.put(task.key, value)
+            elif task.name == 'llm_map':
+                # the worker parsed away an irrelevant partition, its verdict is cached so that the next run skips the call
+                task.cache.put(task.key, MapResult(relevant=False).model_dump_json())
+        task.future.set_result(value)
+
+    def _release(self, task:RemoteTask) -> None:
+        del self.tasks[task.task_id]
+        if task.worker is None:
+            # late answer of a worker declared dead, the task waits for another worker and is no longer in flight
+            self.pending.remove(task)
+            return
+        if task.worker in self.workers:
+            self.workers[task.worker].tasks.discard(task.task_id)
+        with self.mutex:
+            self.in_flight -= 1
+
+    def _dispatch(self) -> None:
+        while len(self.pending) > 0:
+            free = [ (worker.capacity - len(worker.tasks), identity) for identity, worker in self.workers.items() ]
+            free = [ item for item in free if item[0] > 0 ]
+            if len(free) == 0:
+                return
+            _, identity = max(free)
+            task = self.pending.popleft()
+            payload = {'name': task.name, 'kwargs': task.kwargs, 'stream': task.on_token is not None}
+            self.router.send_multipart([identity, TASK, task.task_id.encode('utf-8'), json.dumps(payload).encode('utf-8')])
+            task.worker = identity
+            task.nb_dispatches += 1
+            self.workers[identity].tasks.add(task.task_id)
+            with self.mutex:
+                self.in_flight += 1
+                self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def _check_workers(self, now:float) -> None:
+        for identity, worker in list(self.workers.items()):
+            if now - worker.last_seen <= self.heartbeat_interval * self.heartbeat_liveness:
+                continue
+            logger.warning(f'worker {identity.hex()} missed its heartbeats, {len(worker.tasks)} tasks are dispatched again')
+            with self.mutex:
+                del self.workers[identity]
+            for task_id in worker.tasks:
+                task = self.tasks.get(task_id)
+                if task is None:
+                    continue
+                with self.mutex:
+                    self.in_flight -= 1
+                    self.nb_redispatched += 1
+                if task.nb_tokens > 0:
+                    # tokens already printed can not be taken back, a second answer would be mixed with the first one
+                    del self.tasks[task_id]
+                    task.future.set_exception(RuntimeError(f'worker {identity.hex()} died while streaming'))
+                elif task.nb_dispatches >= self.max_dispatches:
+                    del self.tasks[task_id]
+                    task.future.set_exception(RuntimeError(f'task {task_id} was lost by {task.nb_dispatches} workers'))
+                else:
+                    task.worker = None
+                    self.pending.appendleft(task)
+
+class Worker:
+    # owns its client and its rate budget, runs up to capacity tasks of the broker at once
+    def __init__(self, llm:LLMBackend, address:str=DEFAULT_BROKER_ADDRESS, capacity:int=8, heartbeat_interval:float=HEARTBEAT_INTERVAL, heartbeat_liveness:int=HEARTBEAT_LIVENESS):
+        if capacity < 1:
+            raise ValueError('capacity must be greater than 0')
+        self.llm = llm
+        self.address = address
+        self.capacity = capacity
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_liveness = heartbeat_liveness
+
+    def _connect(self, context:zmq.Context) -> zmq.Socket:
+        dealer = context.socket(zmq.DEALER)
+        dealer.setsockopt(zmq.LINGER, 0)
+        dealer.connect(self.address)
+        dealer.send_multipart([READY, b'', json.dumps({'capacity': self.capacity}).encode('utf-8')])
+        return dealer
+
+    def _execute(self, mailbox:Mailbox, task_id:bytes, payload:Dict[str, Any]) -> None:
+        fn, _ = TASKS[payload['name']]
+        kwargs = dict(payload['kwargs'])
+        if payload['stream']:
+            kwargs['on_token'] = lambda token: mailbox.put((TOKEN, task_id, {'token': token}))
+        try:
+            value = fn(llm=self.llm, **kwargs)
+            mailbox.put((RESULT, task_id, {'value': value}))
+        except Exception as e:
+            logger.error(e)
+            mailbox.put((ERROR, task_id, {'type': type(e).__name__, 'message': str(e)}))
+
+    def run(self, stop:Optional[threading.Event]=None) -> None:
+        context = zmq.Context()
+        mailbox = Mailbox(context)
+        executor = ThreadPoolExecutor(max_workers=self.capacity)
+        dealer = self._connect(context)
+        poller = zmq.Poller()
+        poller.register(dealer, zmq.POLLIN)
+        poller.register(mailbox.receiver, zmq.POLLIN)
+        broker_seen = time.monotonic()
+        next_heartbeat = broker_seen + self.heartbeat_interval
+        logger.info(f'worker connected to {self.address} with {self.capacity} slots')
+        try:
+            while stop is None or not stop.is_set():
+                events = dict(poller.poll(timeout=self.heartbeat_interval * 1000))
+                if dealer in events:
+                    while True:
+                        try:
+                            command, task_id, payload = dealer.recv_multipart(zmq.NOBLOCK)
+                        except zmq.Again:
+                            break
+                        broker_seen = time.monotonic()
+                        if command == TASK:
+                            executor.submit(self._execute, mailbox, task_id, json.loads(payload))
+                for command, task_id, data in mailbox.drain():
+                    dealer.send_multipart([command, task_id, json.dumps(data).encode('utf-8')])
+
+                now = time.monotonic()
+                if now >= next_heartbeat:
+                    dealer.send_multipart([HEARTBEAT, b'', json.dumps({'capacity': self.capacity}).encode('utf-8')])
+                    next_heartbeat = now + self.heartbeat_interval
+                if now - broker_seen > self.heartbeat_interval * self.heartbeat_liveness:
+                    # the broker restarted or the network dropped, results of running tasks go to the new connection
+                    logger.warning(f'broker {self.address} is silent, reconnecting')
+                    poller.unregister(dealer)
+                    dealer.close(linger=0)
+                    dealer = self._connect(context)
+                    poller.register(dealer, zmq.POLLIN)
+                    broker_seen = now
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+            dealer.close(linger=0)
+            mailbox.close()
+            context.term()
@@ -0,0 +1,93 @@
+import math
+
+from typing import Callable, Dict, List
+
+TokenCounter = Callable[[str], int]
+
+MODEL_CONTEXT_WINDOWS:Dict[str, int] = {
+    'gpt-4o-mini': 128_000,
+    'gpt-4o': 128_000
+}
+
+DEFAULT_CONTEXT_WINDOW = 8_192
+DEFAULT_TOKEN_BUDGET = 16_000
+PROMPT_RESERVE = 2_048
+
+def estimate_tokens(text:str) -> int:
+    # english text averages ~4 characters per token for the gpt-4o family
+    return math.ceil(len(text) / 4)
+
+def get_token_counter(model:str) -> TokenCounter:
+    try:
+        import tiktoken
+    except ImportError:
+        return estimate_tokens
+
+    try:
+        encoding = tiktoken.encoding_for_model(model)
+    except KeyError:
+        encoding = tiktoken.get_encoding('o200k_base')
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+def default_token_budget(model:str) -> int:
+    context_window = MODEL_CONTEXT_WINDOWS.get(model, DEFAULT_CONTEXT_WINDOW)
+    return min(DEFAULT_TOKEN_BUDGET, context_window - PROMPT_RESERVE)
+
+def split_text(text:str, token_budget:int, token_counter:TokenCounter) -> List[str]:
+    pieces:List[str] = []
+    while token_counter(text) > token_budget:
+        nb_tokens = token_counter(text)
+        cursor = max(int(len(text) * token_budget / nb_tokens), 1)
+        while cursor > 1 and token_counter(text[:cursor]) > token_budget:
+            cursor = max(int(cursor * 0.9), 1)
+        # prefer cutting on a whitespace so that words are not broken in two
+        whitespace = text.rfind(' ', cursor // 2, cursor)
+        if whitespace > 0:
+            cursor = whitespace
+        pieces.append(text[:cursor])
+        text = text[cursor:]
+    if len(text) > 0:
+        pieces.append(text)
+    return pieces
+
+def pack_pages(pages:List[str], token_budget:int, token_counter:TokenCounter=estimate_tokens) -> List[str]:
+    if token_budget < 1:
+        raise ValueError('token_budget must be greater than 0')
+
+    chunks:List[str] = []
+    buffer:List[str] = []
+    buffer_size = 0
+    for page in pages:
+        for piece in split_text(page, token_budget, token_counter):
+            nb_tokens = token_counter(piece) + 1  # newline separator
+            if len(buffer) > 0 and buffer_size + nb_tokens > token_budget:
+                chunks.append("\n".join(buffer))
+                buffer = []
+                buffer_size = 0
+            buffer.append(piece)
+            buffer_size += nb_tokens
+    if len(buffer) > 0:
+        chunks.append("\n".join(buffer))
+    return chunks
+
+def pack_segments(segments:List[str], fan_in:int, token_budget:int, token_counter:TokenCounter=estimate_tokens) -> List[List[str]]:
+    # consecutive segments are grouped under both a max fan-in and a token budget per reduce call
+    fan_in = max(fan_in, 2)
+    groups:List[List[str]] = []
+    buffer:List[str] = []
+    buffer_size = 0
+    for segment in segments:
+        nb_tokens = token_counter(segment)
+        if len(buffer) > 0 and (len(buffer) >= fan_in or buffer_size + nb_tokens > token_budget):
+            groups.append(buffer)
+            buffer = []
+            buffer_size = 0
+        buffer.append(segment)
+        buffer_size += nb_tokens
+    if len(buffer) > 0:
+        groups.append(buffer)
+
+    if len(segments) > 1 and len(groups) == len(segments):
+        # every segment alone exceeds the budget, merging pairs is the only way to make progress
+        groups = [ segments[counter:counter+2] for counter in range(0, len(segments), 2) ]
+    return groups
@@ -5,8 +5,23 @@ Your task is to extract the key information from this page that would be relevan
 2. Important facts, figures, and quotations
 3. Context that helps understand the broader document
 
-Provide your response in a clear, structured format that will be easy to combine with other pages later.
-Respond only with the essential content - do not include meta-commentary or explanations about your process.
+Answer with a JSON object of the form {"relevant": true, "content": "..."}:
+- "relevant" is false when nothing on this page helps answer the query, "content" is then an empty string
+- "content" holds the extracted information in a clear, structured format that will be easy to combine with other pages later
+Respond only with the JSON object - do not include meta-commentary or explanations about your process.
+"""
+
+multi_map_system_prompt = """
+You are processing a single page of a larger document for several numbered queries at once.
+For every query, extract the key information from this page that would be relevant for it. Focus on:
+1. Main ideas and key points
+2. Important facts, figures, and quotations
+3. Context that helps understand the broader document
+
+Answer with a JSON object mapping the number of every query to an object of the form {"relevant": true, "content": "..."}:
+- "relevant" is false when nothing on this page helps answer that query, "content" is then an empty string
+- "content" holds the information extracted for that query only, in a clear, structured format that will be easy to combine with other pages later
+Respond only with the JSON object - do not include meta-commentary or explanations about your process.
 """
 
 reduce_system_prompt = """
@@ -17,4 +32,14 @@ You are combining two segments of processed text that are parts of a larger docu
 4. Ensure the combined result directly addresses the original query
 
 Focus on creating a cohesive synthesis that maintains accuracy and completeness.
-"""
\ No newline at end of file
+"""
+digest_system_prompt = """
+You are indexing a single page of a larger document before any question is asked about it.
+Your task is to write a compact, query-independent digest of this page that preserves:
+1. Main ideas, claims and conclusions
+2. Named entities, facts, figures, dates and definitions
+3. Section titles and any structure that locates the page in the document
+
+The digest will replace the page when answering future questions, so keep every detail that could matter and drop filler text.
+Respond only with the digest - do not include meta-commentary or explanations about your process.
+"""
@@ -0,0 +1,297 @@
+import re
+import time
+import asyncio
+import threading
+
+from types import SimpleNamespace
+
+from openai import OpenAI, AsyncOpenAI, RateLimitError
+
+from typing import Any, Awaitable, Callable, Dict, Mapping, Optional, Tuple, Union
+
+from src.algorithms.partitioning import estimate_tokens
+from src.log import logger
+
+# (requests per minute, tokens per minute) of the first usage tier, corrected by the rate limit headers
+MODEL_RATE_LIMITS:Dict[str, Tuple[int, int]] = {
+    'gpt-4o-mini': (500, 200_000),
+    'gpt-4o': (500, 30_000)
+}
+
+DEFAULT_RATE_LIMITS = (500, 30_000)
+DEFAULT_RETRY_AFTER = 1.0
+
+def parse_duration(duration:str) -> float:
+    # reset headers look like "1s", "6m0s", "20ms" or "1h2m3.5s"
+    seconds = 0.0
+    for value, unit in re.findall(r'(\d+(?:\.\d+)?)(ms|h|m|s)', duration):
+        seconds += float(value) * {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}[unit]
+    return seconds
+
+def retry_after(headers:Mapping[str, str]) -> float:
+    if 'retry-after-ms' in headers:
+        return float(headers['retry-after-ms']) / 1000
+    if 'retry-after' in headers:
+        try:
+            return float(headers['retry-after'])
+        except ValueError:
+            pass
+    return DEFAULT_RETRY_AFTER
+
+def request_tokens(kwargs:Dict[str, Any]) -> int:
+    # the completion budget is reserved upfront, unused tokens are given back once the usage is known
+    prompt_tokens = sum(estimate_tokens(message['content']) for message in kwargs.get('messages', []))
+    return prompt_tokens + kwargs.get('max_tokens', 0)
+
+def unused_tokens(completion:Any, nb_tokens:int) -> int:
+    usage = getattr(completion, 'usage', None)
+    total_tokens = getattr(usage, 'total_tokens', None)
+    if not isinstance(total_tokens, int):
+        return 0
+    return nb_tokens - total_tokens
+
+class TokenBucket:
+    def __init__(self, per_minute:int):
+        self.capacity = float(per_minute)
+        self.level = float(per_minute)
+        self.updated_at = time.monotonic()
+
+    def set_rate(self, per_minute:int) -> None:
+        self.refill()
+        self.capacity = float(per_minute)
+        self.level = min(self.level, self.capacity)
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.capacity / 60)
+        self.updated_at = now
+
+    def wait_time(self, amount:float) -> float:
+        self.refill()
+        # a request bigger than the bucket only waits for a full bucket
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) * 60 / self.capacity
+
+    def consume(self, amount:float) -> None:
+        self.level -= min(amount, self.capacity)
+
+    def give_back(self, amount:float) -> None:
+        self.level = min(self.capacity, self.level + amount)
+
+class RateLimiter:
+    # token buckets for the rpm/tpm budgets and an aimd window on the number of requests in flight
+    def __init__(self, requests_per_minute:int, tokens_per_minute:int, max_concurrency:int=8, min_concurrency:int=1, max_retries:int=8, follow_headers:bool=True):
+        if requests_per_minute < 1 or tokens_per_minute < 1:
+            raise ValueError('rate limits must be greater than 0')
+        if min_concurrency < 1 or max_concurrency < min_concurrency:
+            raise ValueError('concurrency bounds must satisfy 1 <= min_concurrency <= max_concurrency')
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.follow_headers = follow_headers
+        self.concurrency = float(max_concurrency)
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.epoch = 0
+        self.nb_requests = 0
+        self.nb_rate_limited = 0
+        self.condition = threading.Condition()
+
+    @classmethod
+    def for_model(cls, model:str, requests_per_minute:Optional[int]=None, tokens_per_minute:Optional[int]=None, max_concurrency:int=8) -> 'RateLimiter':
+        default_rpm, default_tpm = MODEL_RATE_LIMITS.get(model, DEFAULT_RATE_LIMITS)
+        return cls(
+            requests_per_minute=requests_per_minute or default_rpm,
+            tokens_per_minute=tokens_per_minute or default_tpm,
+            max_concurrency=max_concurrency,
+            # explicit budgets are kept as is, defaults follow the limits reported by the provider
+            follow_headers=requests_per_minute is None and tokens_per_minute is None
+        )
+
+    def _reserve(self, nb_tokens:int) -> Optional[float]:
+        # returns 0 once the request may start, the time to wait otherwise, None to wait for a release
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.in_flight >= int(self.concurrency):
+            return None
+        wait = max(self.requests.wait_time(1), self.tokens.wait_time(nb_tokens))
+        if wait > 0:
+            return wait
+        self.requests.consume(1)
+        self.tokens.consume(nb_tokens)
+        self.in_flight += 1
+        self.nb_requests += 1
+        return 0.0
+
+    def acquire(self, nb_tokens:int) -> int:
+        # returns the window epoch the request was started in
+        with self.condition:
+            while True:
+                wait = self._reserve(nb_tokens)
+                if wait == 0:
+                    return self.epoch
+                self.condition.wait(timeout=wait)
+
+    async def aacquire(self, nb_tokens:int) -> int:
+        while True:
+            with self.condition:
+                wait = self._reserve(nb_tokens)
+                if wait == 0:
+                    return self.epoch
+            await asyncio.sleep(wait if wait is not None else 0.01)
+
+    def release(self, epoch:Optional[int]=None, headers:Optional[Mapping[str, str]]=None, rate_limited:bool=False, nb_unused_tokens:int=0) -> None:
+        with self.condition:
+            self.in_flight -= 1
+            self.tokens.give_back(max(nb_unused_tokens, 0))
+            congested = rate_limited
+            if headers is not None:
+                congested = self._observe(headers) or congested
+            if rate_limited:
+                self.nb_rate_limited += 1
+                delay = retry_after(headers or {})
+                self.paused_until = max(self.paused_until, time.monotonic() + delay)
+            if congested:
+                # multiplicative decrease on congestion, once per window : the requests started before
+                # the last decrease were sent with the old window and must not shrink the new one
+                if epoch is None or epoch == self.epoch:
+                    self.concurrency = max(self.min_concurrency, self.concurrency / 2)
+                    self.epoch += 1
+            else:
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+            self.condition.notify_all()
+
+    def _observe(self, headers:Mapping[str, str]) -> bool:
+        if self.follow_headers:
+            if 'x-ratelimit-limit-requests' in headers:
+                self.requests.set_rate(int(headers['x-ratelimit-limit-requests']))
+            if 'x-ratelimit-limit-tokens' in headers:
+                self.tokens.set_rate(int(headers['x-ratelimit-limit-tokens']))
+
+        exhausted = False
+        for kind in ['requests', 'tokens']:
+            remaining = headers.get(f'x-ratelimit-remaining-{kind}')
+            reset = headers.get(f'x-ratelimit-reset-{kind}')
+            if remaining is None or not remaining.isdigit() or int(remaining) > 0:
+                continue
+            exhausted = True
+            if reset is not None:
+                self.paused_until = max(self.paused_until, time.monotonic() + parse_duration(reset))
+        return exhausted
+
+    def call(self, fn:Callable[[], Any], nb_tokens:int) -> Any:
+        # fn returns a raw response, its headers are read before the completion is handed back
+        for attempt in range(self.max_retries + 1):
+            epoch = self.acquire(nb_tokens)
+            try:
+                raw_response = fn()
+                completion = raw_response.parse()
+            except RateLimitError as e:
+                self.release(epoch, headers=e.response.headers, rate_limited=True)
+                logger.warning(f'rate limited, concurrency lowered to {int(self.concurrency)}')
+                if attempt == self.max_retries:
+                    raise
+                continue
+            except BaseException:
+                self.release(epoch)
+                raise
+            self.release(epoch, headers=raw_response.headers, nb_unused_tokens=unused_tokens(completion, nb_tokens))
+            return completion
+
+    async def acall(self, fn:Callable[[], Awaitable[Any]], nb_tokens:int) -> Any:
+        for attempt in range(self.max_retries + 1):
+            epoch = await self.aacquire(nb_tokens)
+            try:
+                raw_response = await fn()
+                completion = raw_response.parse()
+            except RateLimitError as e:
+                self.release(epoch, headers=e.response.headers, rate_limited=True)
+                logger.warning(f'rate limited, concurrency lowered to {int(self.concurrency)}')
+                if attempt == self.max_retries:
+                    raise
+                continue
+            except BaseException:
+                self.release(epoch)
+                raise
+            self.release(epoch, headers=raw_response.headers, nb_unused_tokens=unused_tokens(completion, nb_tokens))
+            return completion
+
+    def stats(self) -> Dict[str, int]:
+        with self.condition:
+            return {
+                'concurrency': int(self.concurrency),
+                'nb_requests': self.nb_requests,
+                'nb_rate_limited': self.nb_rate_limited
+            }
+
+class ModelRateLimiters:
+    # the provider enforces the rpm/tpm limits of every model separately, a map model and a reduce model get a limiter each
+    def __init__(self, requests_per_minute:Optional[int]=None, tokens_per_minute:Optional[int]=None, max_concurrency:int=8):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_concurrency = max_concurrency
+        self.limiters:Dict[str, RateLimiter] = {}
+        self.mutex = threading.Lock()
+
+    def get(self, model:str) -> RateLimiter:
+        with self.mutex:
+            if model not in self.limiters:
+                self.limiters[model] = RateLimiter.for_model(model, self.requests_per_minute, self.tokens_per_minute, self.max_concurrency)
+            return self.limiters[model]
+
+    def stats(self) -> Dict[str, Any]:
+        with self.mutex:
+            limiters = dict(self.limiters)
+        stats = { model: limiter.stats() for model, limiter in limiters.items() }
+        return {
+            'concurrency': { model: model_stats['concurrency'] for model, model_stats in stats.items() },
+            'nb_requests': sum(model_stats['nb_requests'] for model_stats in stats.values()),
+            'nb_rate_limited': sum(model_stats['nb_rate_limited'] for model_stats in stats.values())
+        }
+
+RateLimiters = Union[RateLimiter, ModelRateLimiters]
+
+def limiter_of(rate_limiter:RateLimiters, kwargs:Dict[str, Any]) -> RateLimiter:
+    if isinstance(rate_limiter, ModelRateLimiters):
+        return rate_limiter.get(kwargs['model'])
+    return rate_limiter
+
+class RateLimitedCompletions:
+    def __init__(self, completions:Any, rate_limiter:RateLimiters):
+        self.completions = completions
+        self.rate_limiter = rate_limiter
+
+    def create(self, **kwargs) -> Any:
+        return limiter_of(self.rate_limiter, kwargs).call(lambda: self.completions.with_raw_response.create(**kwargs), request_tokens(kwargs))
+
+class AsyncRateLimitedCompletions:
+    def __init__(self, completions:Any, rate_limiter:RateLimiters):
+        self.completions = completions
+        self.rate_limiter = rate_limiter
+
+    async def create(self, **kwargs) -> Any:
+        return await limiter_of(self.rate_limiter, kwargs).acall(lambda: self.completions.with_raw_response.create(**kwargs), request_tokens(kwargs))
+
+class RateLimitedOpenAI:
+    # exposes the part of the client used by the strategies, every completion goes through the limiter
+    def __init__(self, llm:OpenAI, rate_limiter:RateLimiters):
+        self.llm = llm
+        self.rate_limiter = rate_limiter
+        self.chat = SimpleNamespace(completions=RateLimitedCompletions(llm.chat.completions, rate_limiter))
+
+    def close(self) -> None:
+        self.llm.close()
+
+class AsyncRateLimitedOpenAI:
+    def __init__(self, llm:AsyncOpenAI, rate_limiter:RateLimiters):
+        self.llm = llm
+        self.rate_limiter = rate_limiter
+        self.chat = SimpleNamespace(completions=AsyncRateLimitedCompletions(llm.chat.completions, rate_limiter))
+
+    async def close(self) -> None:
+        await self.llm.close()
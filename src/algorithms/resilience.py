@@ -0,0 +1,195 @@
+import time
+import random
+import asyncio
+import threading
+
+from types import SimpleNamespace
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from openai import APIConnectionError, InternalServerError, RateLimitError
+
+from typing import Any, Deque, Dict, List, Optional
+
+from src.algorithms.backends import LLMBackend, AsyncLLMBackend
+from src.log import logger
+
+# timeouts are reported as APITimeoutError, a subclass of APIConnectionError
+RETRYABLE_ERRORS = (APIConnectionError, InternalServerError, RateLimitError)
+# under a rate limiter the 429s are retried by the limiter, on its own pacing, and must pass through
+RATE_LIMITED_RETRYABLE_ERRORS = (APIConnectionError, InternalServerError)
+
+class RetryPolicy:
+    def __init__(self, max_retries:int=3, base_delay:float=0.5, max_delay:float=8.0, timeout:Optional[float]=60.0, hedge_quantile:Optional[float]=None, min_samples:int=20, retry_rate_limits:bool=True):
+        if max_retries < 0:
+            raise ValueError('max_retries must be greater than or equal to 0')
+        if hedge_quantile is not None and not 0 < hedge_quantile < 1:
+            raise ValueError('hedge_quantile must be between 0 and 1')
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.hedge_quantile = hedge_quantile
+        self.min_samples = min_samples
+        self.retryable_errors = RETRYABLE_ERRORS if retry_rate_limits else RATE_LIMITED_RETRYABLE_ERRORS
+
+    def backoff(self, attempt:int) -> float:
+        # full jitter : concurrent callers that failed together do not retry together
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+class LatencyTracker:
+    # latencies are tracked per system prompt, map, reduce and digest calls do not have the same profile
+    def __init__(self, window:int=256):
+        self.window = window
+        self.samples:Dict[str, Deque[float]] = {}
+        self.mutex = threading.Lock()
+
+    def observe(self, key:str, latency:float) -> None:
+        with self.mutex:
+            self.samples.setdefault(key, deque(maxlen=self.window)).append(latency)
+
+    def quantile(self, key:str, quantile:float, min_samples:int) -> Optional[float]:
+        with self.mutex:
+            samples = sorted(self.samples.get(key, []))
+        if len(samples) < min_samples:
+            return None
+        return samples[min(int(quantile * len(samples)), len(samples) - 1)]
+
+def request_kind(kwargs:Dict[str, Any]) -> str:
+    messages = kwargs.get('messages', [])
+    return messages[0]['content'] if len(messages) > 0 else ''
+
+class ResilientCompletions:
+    def __init__(self, completions:Any, policy:RetryPolicy, tracker:LatencyTracker, executor:Optional[ThreadPoolExecutor]):
+        self.completions = completions
+        self.policy = policy
+        self.tracker = tracker
+        self.executor = executor
+
+    def create(self, **kwargs) -> Any:
+        if self.policy.timeout is not None:
+            kwargs['timeout'] = self.policy.timeout
+        for attempt in range(self.policy.max_retries + 1):
+            try:
+                return self._attempt(kwargs)
+            except self.policy.retryable_errors as e:
+                if attempt == self.policy.max_retries:
+                    raise
+                delay = self.policy.backoff(attempt)
+                logger.warning(f'{type(e).__name__} on attempt {attempt + 1}, retrying in {delay:.2f}s')
+                time.sleep(delay)
+
+    def _attempt(self, kwargs:Dict[str, Any]) -> Any:
+        # a streamed answer is printed as it arrives, it can not be duplicated
+        if kwargs.get('stream', False):
+            return self.completions.create(**kwargs)
+
+        kind = request_kind(kwargs)
+        threshold = None
+        if self.policy.hedge_quantile is not None and self.executor is not None:
+            threshold = self.tracker.quantile(kind, self.policy.hedge_quantile, self.policy.min_samples)
+
+        start = time.perf_counter()
+        if threshold is None:
+            completion = self.completions.create(**kwargs)
+        else:
+            completion = self._hedged(kwargs, threshold)
+        self.tracker.observe(kind, time.perf_counter() - start)
+        return completion
+
+    def _hedged(self, kwargs:Dict[str, Any], threshold:float) -> Any:
+        primary = self.executor.submit(self.completions.create, **kwargs)
+        done, _ = wait([primary], timeout=threshold)
+        if len(done) > 0:
+            return primary.result()
+
+        logger.info(f'request slower than {threshold:.2f}s, sending a hedged duplicate')
+        pending:List[Future] = [primary, self.executor.submit(self.completions.create, **kwargs)]
+        while len(pending) > 0:
+            done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    # the slower duplicate can not be interrupted, its answer is dropped
+                    return future.result()
+            pending = list(not_done)
+        return primary.result()
+
+class AsyncResilientCompletions:
+    def __init__(self, completions:Any, policy:RetryPolicy, tracker:LatencyTracker):
+        self.completions = completions
+        self.policy = policy
+        self.tracker = tracker
+
+    async def create(self, **kwargs) -> Any:
+        if self.policy.timeout is not None:
+            kwargs['timeout'] = self.policy.timeout
+        for attempt in range(self.policy.max_retries + 1):
+            try:
+                return await self._attempt(kwargs)
+            except self.policy.retryable_errors as e:
+                if attempt == self.policy.max_retries:
+                    raise
+                delay = self.policy.backoff(attempt)
+                logger.warning(f'{type(e).__name__} on attempt {attempt + 1}, retrying in {delay:.2f}s')
+                await asyncio.sleep(delay)
+
+    async def _attempt(self, kwargs:Dict[str, Any]) -> Any:
+        if kwargs.get('stream', False):
+            return await self.completions.create(**kwargs)
+
+        kind = request_kind(kwargs)
+        threshold = None
+        if self.policy.hedge_quantile is not None:
+            threshold = self.tracker.quantile(kind, self.policy.hedge_quantile, self.policy.min_samples)
+
+        start = time.perf_counter()
+        if threshold is None:
+            completion = await self.completions.create(**kwargs)
+        else:
+            completion = await self._hedged(kwargs, threshold)
+        self.tracker.observe(kind, time.perf_counter() - start)
+        return completion
+
+    async def _hedged(self, kwargs:Dict[str, Any], threshold:float) -> Any:
+        primary = asyncio.ensure_future(self.completions.create(**kwargs))
+        done, _ = await asyncio.wait([primary], timeout=threshold)
+        if len(done) > 0:
+            return primary.result()
+
+        logger.info(f'request slower than {threshold:.2f}s, sending a hedged duplicate')
+        pending = {primary, asyncio.ensure_future(self.completions.create(**kwargs))}
+        try:
+            while len(pending) > 0:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+            return primary.result()
+        finally:
+            # unlike threads, the losing request is cancelled
+            for task in pending:
+                task.cancel()
+
+class ResilientOpenAI:
+    # retries, per call timeouts and hedged duplicates around any client exposing chat.completions.create
+    def __init__(self, llm:LLMBackend, policy:RetryPolicy, max_workers:int=16):
+        self.llm = llm
+        self.policy = policy
+        self.tracker = LatencyTracker()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers) if policy.hedge_quantile is not None else None
+        self.chat = SimpleNamespace(completions=ResilientCompletions(llm.chat.completions, policy, self.tracker, self.executor))
+
+    def close(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        self.llm.close()
+
+class AsyncResilientOpenAI:
+    def __init__(self, llm:AsyncLLMBackend, policy:RetryPolicy):
+        self.llm = llm
+        self.policy = policy
+        self.tracker = LatencyTracker()
+        self.chat = SimpleNamespace(completions=AsyncResilientCompletions(llm.chat.completions, policy, self.tracker))
+
+    async def close(self) -> None:
+        await self.llm.close()
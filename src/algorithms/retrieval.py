@@ -0,0 +1,67 @@
+import re
+import math
+
+from collections import Counter
+
+from typing import Dict, List, Optional, Tuple
+
+from src.log import logger
+
+# okapi bm25 defaults : term frequency saturation and page length normalization
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# words of most questions, they would only add noise to the scores
+STOPWORDS = frozenset([
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'do', 'does', 'for', 'from', 'how', 'in', 'is', 'it', 'its',
+    'of', 'on', 'or', 'that', 'the', 'this', 'to', 'was', 'what', 'when', 'where', 'which', 'who', 'why', 'with'
+])
+
+def tokenize(text:str) -> List[str]:
+    return [ token for token in re.findall(r'\w+', text.lower()) if token not in STOPWORDS ]
+
+class BM25Index:
+    # inverted index over the pages of one document, built once and scored for every query
+    def __init__(self, pages:List[str], k1:float=BM25_K1, b:float=BM25_B):
+        self.k1 = k1
+        self.b = b
+        self.nb_pages = len(pages)
+        self.page_lengths:List[int] = []
+        self.postings:Dict[str, List[Tuple[int, int]]] = {}
+        for page_id, page in enumerate(pages):
+            tokens = tokenize(page)
+            self.page_lengths.append(len(tokens))
+            for term, frequency in Counter(tokens).items():
+                self.postings.setdefault(term, []).append((page_id, frequency))
+        self.average_length = sum(self.page_lengths) / max(self.nb_pages, 1)
+
+    def idf(self, term:str) -> float:
+        nb_matches = len(self.postings.get(term, []))
+        return math.log(1 + (self.nb_pages - nb_matches + 0.5) / (nb_matches + 0.5))
+
+    def score(self, query:str) -> List[float]:
+        scores = [ 0.0 ] * self.nb_pages
+        for term in set(tokenize(query)):
+            idf = self.idf(term)
+            for page_id, frequency in self.postings.get(term, []):
+                normalization = 1 - self.b + self.b * self.page_lengths[page_id] / max(self.average_length, 1)
+                scores[page_id] += idf * frequency * (self.k1 + 1) / (frequency + self.k1 * normalization)
+        return scores
+
+    def search(self, query:str, top_k:Optional[int]=None, min_score:Optional[float]=None) -> List[int]:
+        # ids of the best pages, in document order so that the map-reduce tree keeps the reading order
+        scores = self.score(query)
+        ranking = sorted((page_id for page_id, score in enumerate(scores) if score > 0), key=lambda page_id: -scores[page_id])
+        if min_score is not None:
+            ranking = [ page_id for page_id in ranking if scores[page_id] >= min_score ]
+        if top_k is not None:
+            ranking = ranking[:top_k]
+        return sorted(ranking)
+
+def select_pages(index:BM25Index, pages:List[str], query:str, top_k:Optional[int]=None, min_score:Optional[float]=None) -> List[str]:
+    page_ids = index.search(query, top_k, min_score)
+    if len(page_ids) == 0:
+        # no page shares a term with the query or clears the threshold, a lexical score can not tell which pages matter
+        logger.warning('no page matches the query, every page is sent to the map phase')
+        return pages
+    return [ pages[page_id] for page_id in page_ids ]
@@ -0,0 +1,67 @@
+import threading
+import contextvars
+
+from typing import Any, Callable, Dict
+
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from src.algorithms.tracing import is_tracing, mark_queued
+
+class Scheduler:
+    def __init__(self, max_workers:int=8):
+        if max_workers < 1:
+            raise ValueError('max_workers must be greater than 0')
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.mutex = threading.Lock()
+        self.reset()
+
+    def __enter__(self) -> 'Scheduler':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.shutdown()
+
+    def reset(self) -> None:
+        with self.mutex:
+            self.in_flight = 0
+            self.peak_in_flight = 0
+            self.peak_threads = threading.active_count()
+            self.nb_tasks = 0
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=True)
+
+    def _run(self, fn:Callable[..., Any], *args, **kwargs) -> Any:
+        with self.mutex:
+            self.in_flight += 1
+            self.nb_tasks += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self.mutex:
+                self.in_flight -= 1
+
+    def submit(self, fn:Callable[..., Any], *args, **kwargs) -> Future:
+        if not is_tracing():
+            return self.executor.submit(self._run, fn, *args, **kwargs)
+        # the task runs under the span of its caller and reports how long it waited for a worker
+        context = contextvars.copy_context()
+        context.run(mark_queued)
+        return self.executor.submit(context.run, self._run, fn, *args, **kwargs)
+
+    def done(self, value:Any) -> Future:
+        future:Future = Future()
+        future.set_result(value)
+        return future
+
+    def stats(self) -> Dict[str, int]:
+        with self.mutex:
+            return {
+                'max_workers': self.max_workers,
+                'nb_tasks': self.nb_tasks,
+                'peak_threads': self.peak_threads,
+                'peak_in_flight': self.peak_in_flight
+            }
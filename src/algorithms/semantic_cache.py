@@ -0,0 +1,131 @@
+import time
+import math
+import threading
+
+from collections import Counter, OrderedDict
+
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from src.algorithms.retrieval import tokenize
+
+# words that rephrase a request without changing what is asked about the document
+FILLER_WORDS = frozenset([
+    'can', 'could', 'would', 'will', 'please', 'i', 'me', 'my', 'you', 'your', 'we', 'us', 'give', 'tell', 'show',
+    'want', 'like', 'need', 'let', 'know', 'some', 'about', 'document', 'pdf', 'file', 'text'
+])
+
+def stem(token:str) -> str:
+    # light suffix stripping that sends every form of a word to the same stem : process, processes, processing
+    # and processed give process, summarize, summarized, summary and summaries give summar
+    def strip(token:str, suffix:str) -> str:
+        if token.endswith(suffix) and len(token) - len(suffix) >= 3:
+            return token[:-len(suffix)]
+        return token
+
+    if token.endswith(('sses', 'ies')):
+        token = strip(token, 'es')
+    elif not token.endswith(('ss', 'us', 'is')):
+        token = strip(token, 's')
+    for suffix in ('ing', 'ed'):
+        if token.endswith(suffix):
+            token = strip(token, suffix)
+            break
+    for suffix in ('ize', 'ise', 'iz'):
+        if token.endswith(suffix):
+            token = strip(token, suffix)
+            break
+    for suffix in ('e', 'y', 'i'):
+        if token.endswith(suffix):
+            token = strip(token, suffix)
+            break
+    return token
+
+def normalize(query:str) -> List[str]:
+    return [ stem(token) for token in tokenize(query) if token not in FILLER_WORDS ]
+
+def embed(query:str) -> Dict[str, float]:
+    # unit vector of the stems and of the pairs of consecutive stems, computed locally in microseconds
+    # the pairs carry the word order : "does smoking cause cancer" and "does cancer cause smoking" stay apart
+    stems = normalize(query)
+    counts = Counter(stems + [ f'{left} {right}' for left, right in zip(stems, stems[1:]) ])
+    norm = math.sqrt(sum(count * count for count in counts.values()))
+    return { term: count / norm for term, count in counts.items() } if norm > 0 else {}
+
+def similarity(left:Dict[str, float], right:Dict[str, float]) -> float:
+    if len(left) > len(right):
+        left, right = right, left
+    return sum(weight * right.get(term, 0.0) for term, weight in left.items())
+
+class SemanticCache:
+    # final answers of the recent queries of a document, a rephrased query close enough to one of them gets its answer
+    def __init__(self, threshold:float=0.9, ttl:Optional[float]=3600.0, max_entries:int=256, clock:Callable[[], float]=time.monotonic):
+        if not 0 < threshold <= 1:
+            raise ValueError('threshold must be between 0 and 1')
+        if ttl is not None and ttl <= 0:
+            raise ValueError('ttl must be greater than 0')
+        if max_entries < 1:
+            raise ValueError('max_entries must be greater than 0')
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self.mutex = threading.Lock()
+        # (document key, normalized query) => (embedding, answer, stored at), least recently used first
+        self.entries:OrderedDict[Tuple[str, str], Tuple[Dict[str, float], str, float]] = OrderedDict()
+        self.nb_lookups = 0
+        self.nb_hits = 0
+        self.nb_evictions = 0
+
+    def get(self, document_key:str, query:str) -> Optional[str]:
+        vector = embed(query)
+        with self.mutex:
+            self.nb_lookups += 1
+            self._expire()
+            best_key, best_similarity = None, 0.0
+            for key, (entry_vector, _, _) in self.entries.items():
+                if key[0] != document_key:
+                    continue
+                score = similarity(vector, entry_vector)
+                if score > best_similarity:
+                    best_key, best_similarity = key, score
+            # a query made only of stopwords has no vector, it never matches
+            if best_key is None or best_similarity < self.threshold:
+                return None
+            self.nb_hits += 1
+            self.entries.move_to_end(best_key)
+            return self.entries[best_key][1]
+
+    def put(self, document_key:str, query:str, answer:str) -> None:
+        vector = embed(query)
+        if len(vector) == 0:
+            return
+        key = (document_key, ' '.join(normalize(query)))
+        with self.mutex:
+            self.entries[key] = (vector, answer, self.clock())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.nb_evictions += 1
+
+    def _expire(self) -> None:
+        if self.ttl is None:
+            return
+        deadline = self.clock() - self.ttl
+        expired = [ key for key, (_, _, stored_at) in self.entries.items() if stored_at < deadline ]
+        for key in expired:
+            del self.entries[key]
+        self.nb_evictions += len(expired)
+
+    def clear(self) -> None:
+        with self.mutex:
+            self.entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self.mutex:
+            return {
+                'nb_lookups': self.nb_lookups,
+                'nb_hits': self.nb_hits,
+                'hit_rate': round(self.nb_hits / self.nb_lookups, 4) if self.nb_lookups > 0 else 0.0,
+                'nb_entries': len(self.entries),
+                'nb_evictions': self.nb_evictions
+            }
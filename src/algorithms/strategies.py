@@ -1,46 +1,81 @@
-import json 
+import json
+import math
+import functools
+import queue
+import asyncio
 
-from pydantic import BaseModel, Field 
-from openai import OpenAI
+from pydantic import BaseModel, Field
 from openai.types.chat import ChatCompletion
 
-from typing import List, Dict, Tuple, Type, Optional 
+from typing import Any, List, Dict, Tuple, Type, Optional, Iterable, Callable, Set, Awaitable
 
-from functools import partial
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future
 
-from src.algorithms.prompts import map_system_prompt, reduce_system_prompt
-from src.log import logger 
+from src.algorithms.prompts import map_system_prompt, multi_map_system_prompt, reduce_system_prompt, digest_system_prompt
+from src.algorithms.scheduler import Scheduler
+from src.algorithms.cache import Cache
+from src.algorithms.budget import BudgetExceededError, CostEstimate, CHEAPER_MODELS, MODEL_PRICES, cost_of, model_price
+from src.algorithms.tracing import span, tag, annotate, record_usage, mark_queued
+from src.algorithms.backends import LLMBackend, AsyncLLMBackend
+from src.algorithms.partitioning import TokenCounter, pack_pages, pack_segments, get_token_counter, default_token_budget, MODEL_CONTEXT_WINDOWS, DEFAULT_CONTEXT_WINDOW, PROMPT_RESERVE
+from src.log import logger
 
-def llm_map(page:str, query:str, model:str, llm:OpenAI) -> str:
-    logger.info('map phase')
-    out_map:ChatCompletion = llm.chat.completions.create(
-        model=model,
-        messages=[
-            {
-                "role": "system",
-                "content": map_system_prompt
-            }, 
-            {
-                "role": "user", 
-                "content": f"""query: {query}
-                Page content: {page}
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_MAX_CONCURRENCY = 1024
+MAX_TOKENS = 1024
+# expected answer length of a call as a share of its max_tokens, used to estimate the cost of a plan
+EXPECTED_COMPLETION_RATIO = 4
+# a map answer only keeps what is relevant to the query, when it is sized from its partition it gets a share of it
+MAP_ANSWER_RATIO = 4
+MIN_MAP_MAX_TOKENS = 128
+# output limit of the gpt-4o family, a map call answering several queries gets a share per query up to it
+MAX_OUTPUT_TOKENS = 16384
+
+# the map answer is a json object, a partition without anything relevant is dropped before the reduce
+MAP_RESPONSE_FORMAT = {'type': 'json_object'}
+
+TokenCallback = Callable[[str], None]
+
+# the messages put the system prompt and the page first and the query last, providers cache the longest
+# prompt prefix they have already seen so the page is billed at the cached price for every further query
+
+class MapResult(BaseModel):
+    relevant:bool = True
+    content:Optional[str] = None
+
+def build_map_messages(page:str, query:str) -> List[Dict[str, str]]:
+    return [
+        {
+            "role": "system",
+            "content": map_system_prompt
+        },
+        {
+            "role": "user",
+            "content": f"""Page content: {page}
                 Extract the relevant information from this page that helps address the query.
+                query: {query}
                 """
-            }
-        ],
-        max_tokens=1024
-    )
-    stringyfied_data = out_map.choices[0].message.content
-    return stringyfied_data
+        }
+    ]
 
-def llm_reduce(accumulator:List[Optional[str]], model:str, llm:OpenAI, query:str) -> Optional[str]:
-    logger.info('reduce phase')
-    accumulator = [ res for res in accumulator if res is not None ]
+def build_multi_map_messages(page:str, queries:List[str]) -> List[Dict[str, str]]:
+    numbered_queries = "\n".join(f"{index}: {query}" for index, query in enumerate(queries))
+    return [
+        {
+            "role": "system",
+            "content": multi_map_system_prompt
+        },
+        {
+            "role": "user",
+            "content": f"""Page content: {page}
+                Extract the relevant information from this page for every query.
+                queries:
+                {numbered_queries}
+                """
+        }
+    ]
 
-    if len(accumulator) == 0:
-        return None 
-    
+def build_reduce_messages(accumulator:List[str], query:str) -> List[Dict[str, str]]:
     context = []
     for index, segment in enumerate(accumulator):
         context.append(
@@ -48,57 +83,985 @@ def llm_reduce(accumulator:List[Optional[str]], model:str, llm:OpenAI, query:str
                 {segment}
             """
         )
-    
+
     context = "\n###\n".join(context)
-    out_reduce:ChatCompletion = llm.chat.completions.create(
-        model=model,
-        messages=[
-            {
-                "role": "system",
-                "content": reduce_system_prompt
-            }, 
-            {
-                "role": "user",                 
-                "content": f"""Query: {query}
-                segments : 
+    return [
+        {
+            "role": "system",
+            "content": reduce_system_prompt
+        },
+        {
+            "role": "user",
+            "content": f"""segments : 
                 {context}
                 Combine these segments into a unified response that addresses the query. Maintain all relevant information while eliminating redundancies.
+                Query: {query}
                 """
-            }
-        ],
-        max_tokens=1024
-    )
-    stringyfied_data = out_reduce.choices[0].message.content
-    return stringyfied_data
+        }
+    ]
 
+def build_digest_messages(page:str) -> List[Dict[str, str]]:
+    return [
+        {
+            "role": "system",
+            "content": digest_system_prompt
+        },
+        {
+            "role": "user",
+            "content": f"""Page content: {page}
+                Write the digest of this page.
+                """
+        }
+    ]
 
-def llm_map_reduce(query:str, model:str, llm:OpenAI, context_size:int, pages:List[str]) -> Optional[str]:
-    if len(pages) == 0:
-        return None  
-    
-    if len(pages) < context_size:
-        page = "\n".join(pages)
-        return llm_map(
-            page=page, model=model, llm=llm, query=query
-        )
-    
+def partition_pages(pages:List[str], context_size:int) -> List[List[str]]:
     nb_pages = len(pages)
-    batch_size = int(nb_pages / context_size)
+    batch_size = max(nb_pages // max(context_size, 2), 1)
     paritions = []
     for counter in range(0, nb_pages, batch_size):
         paritions.append(
             pages[counter:counter+batch_size]
         )
+    return paritions
+
+def collect_leaves(pages:List[str], context_size:int) -> List[List[str]]:
+    if len(pages) <= max(context_size, 1):
+        return [pages]
+
+    leaves:List[List[str]] = []
+    for partition in partition_pages(pages, context_size):
+        leaves.extend(collect_leaves(partition, context_size))
+    return leaves
+
+def plan_leaves(pages:List[str], model:str, context_size:int, token_budget:Optional[int]=None, token_counter:Optional[TokenCounter]=None) -> List[str]:
+    # page-count batching by default, token packing puts exactly one chunk per map call
+    if token_budget is None:
+        return [ "\n".join(leaf) for leaf in collect_leaves(pages, context_size) ]
+    if token_counter is None:
+        token_counter = get_token_counter(model)
+    return pack_pages(pages, token_budget, token_counter)
+
+def plan_reduce(segments:List[str], model:str, fan_in:int, reduce_token_budget:Optional[int]=None, token_counter:Optional[TokenCounter]=None) -> List[List[str]]:
+    if reduce_token_budget is None:
+        reduce_token_budget = default_token_budget(model)
+    if token_counter is None:
+        token_counter = get_token_counter(model)
+    return pack_segments(segments, fan_in, reduce_token_budget, token_counter)
+
+def validate_map_result(data:Any) -> Optional[MapResult]:
+    # None when the object carries none of the fields of the json mode answer, it is no verdict on the partition
+    if not isinstance(data, dict) or len(data.keys() & MapResult.model_fields.keys()) == 0:
+        return None
+    try:
+        return MapResult.model_validate(data)
+    except ValueError:
+        return None
+
+def parse_map_result(stringyfied_data:Optional[str]) -> Optional[str]:
+    # None for an irrelevant or empty partition, it is then skipped like a failed one and its subtree costs no reduce call
+    if stringyfied_data is None:
+        return None
+    try:
+        data = json.loads(stringyfied_data)
+    except ValueError:
+        # servers without the json mode answer in plain text, the answer is kept as is
+        return stringyfied_data
+    result = validate_map_result(data)
+    if result is None:
+        # an answer of another shape is read by the reduce as is
+        logger.warning('map answer of an unexpected shape, the raw answer is kept')
+        return stringyfied_data
+    if not result.relevant or not result.content:
+        annotate(relevant=False)
+        return None
+    return result.content
+
+def parse_multi_map_result(stringyfied_data:Optional[str], nb_queries:int) -> List[Optional[str]]:
+    # one answer per query, a query missing from the object found nothing relevant on the page
+    if stringyfied_data is None:
+        return [ None ] * nb_queries
+    try:
+        answers = json.loads(stringyfied_data)
+    except ValueError:
+        answers = None
+    if not isinstance(answers, dict):
+        # a plain text answer can not be split per query, handing all of it to every query would leak the others into each reduce
+        logger.warning('the grouped map answer is not a json object, the partition is skipped for every query')
+        return [ None ] * nb_queries
+    contents:List[Optional[str]] = []
+    for index in range(nb_queries):
+        result = validate_map_result(answers.get(str(index), {'relevant': False}))
+        if result is None:
+            logger.warning(f'grouped map answer of an unexpected shape for query {index}, the partition is skipped for it')
+            contents.append(None)
+        else:
+            contents.append(result.content if result.relevant and result.content else None)
+    annotate(nb_relevant=sum(content is not None for content in contents))
+    return contents
+
+def multi_map_max_tokens_of(leaf:str, nb_queries:int, map_max_tokens:Optional[int], token_counter:TokenCounter) -> int:
+    return min(map_max_tokens_of(leaf, map_max_tokens, token_counter) * nb_queries, MAX_OUTPUT_TOKENS)
+
+def map_max_tokens_of(leaf:str, map_max_tokens:Optional[int], token_counter:TokenCounter) -> int:
+    # None sizes the answer from the partition, small partitions do not reserve a full answer
+    if map_max_tokens is not None:
+        return map_max_tokens
+    return max(MIN_MAP_MAX_TOKENS, min(MAX_TOKENS, token_counter(leaf) // MAP_ANSWER_RATIO))
+
+class BudgetPlan(BaseModel):
+    pages:List[str]
+    context_size:int
+    token_budget:Optional[int] = None
+    map_model:str
+    estimate:CostEstimate
+    degradations:List[str] = Field(default_factory=list)
+
+def messages_tokens(messages:List[Dict[str, str]], token_counter:TokenCounter) -> int:
+    return sum(token_counter(message['content']) for message in messages)
+
+def estimate_cost(query:str, pages:List[str], model:str, context_size:int, token_budget:Optional[int]=None, token_counter:Optional[TokenCounter]=None, fan_in:Optional[int]=None, reduce_token_budget:Optional[int]=None, map_model:Optional[str]=None, map_max_tokens:Optional[int]=MAX_TOKENS, reduce_max_tokens:int=MAX_TOKENS) -> CostEstimate:
+    # the leaves are planned exactly, the reduce tree is simulated with answers of the expected length
+    if token_counter is None:
+        token_counter = get_token_counter(model)
+    if reduce_token_budget is None:
+        reduce_token_budget = default_token_budget(model)
+    fan_in = max(fan_in or context_size, 2)
+    map_model = map_model or model
+
+    leaves = plan_leaves(pages, map_model, context_size, token_budget, token_counter)
+    map_overhead = messages_tokens(build_map_messages('', query), token_counter)
+    map_prompt_tokens = sum(token_counter(leaf) + map_overhead for leaf in leaves)
+    map_completion_tokens = sum(map_max_tokens_of(leaf, map_max_tokens, token_counter) // EXPECTED_COMPLETION_RATIO for leaf in leaves)
+
+    reduce_overhead = messages_tokens(build_reduce_messages([], query), token_counter)
+    segment_overhead = token_counter(build_reduce_messages([''], query)[1]['content']) - token_counter(build_reduce_messages([], query)[1]['content'])
+    # the first level merges map answers, the next ones merge reduce answers
+    answer_tokens = map_completion_tokens // max(len(leaves), 1)
+    reduce_answer_tokens = reduce_max_tokens // EXPECTED_COMPLETION_RATIO
+    nb_segments = len(leaves)
+    nb_reduce_calls = 0
+    reduce_prompt_tokens = 0
+    while nb_segments > 1:
+        group_size = max(2, min(fan_in, reduce_token_budget // max(answer_tokens, 1)))
+        # a lone trailing segment is promoted without a call
+        nb_calls = nb_segments // group_size + (1 if nb_segments % group_size > 1 else 0)
+        nb_merged = nb_segments - (1 if nb_segments % group_size == 1 else 0)
+        reduce_prompt_tokens += nb_calls * reduce_overhead + nb_merged * (answer_tokens + segment_overhead)
+        nb_reduce_calls += nb_calls
+        nb_segments = math.ceil(nb_segments / group_size)
+        answer_tokens = reduce_answer_tokens
+    reduce_completion_tokens = reduce_answer_tokens * nb_reduce_calls
+
+    cost = reduce_cost = None
+    if map_model in MODEL_PRICES and model in MODEL_PRICES:
+        reduce_cost = cost_of(model, reduce_prompt_tokens, reduce_completion_tokens)
+        cost = cost_of(map_model, map_prompt_tokens, map_completion_tokens) + reduce_cost
+    return CostEstimate(
+        nb_map_calls=len(leaves),
+        nb_reduce_calls=nb_reduce_calls,
+        prompt_tokens=map_prompt_tokens + reduce_prompt_tokens,
+        completion_tokens=map_completion_tokens + reduce_completion_tokens,
+        reduce_tokens=reduce_prompt_tokens + reduce_completion_tokens,
+        max_leaf_tokens=max((token_counter(leaf) + map_overhead for leaf in leaves), default=0),
+        cost=cost,
+        reduce_cost=reduce_cost
+    )
+
+def fits_budget(estimate:CostEstimate, max_tokens:Optional[int]=None, max_cost:Optional[float]=None) -> bool:
+    if max_tokens is not None and estimate.tokens > max_tokens:
+        return False
+    if max_cost is not None and (estimate.cost is None or estimate.cost > max_cost):
+        return False
+    return True
+
+def sample_pages(pages:List[str], nb_pages:int) -> List[str]:
+    # evenly spaced pages, the sample still covers the whole document
+    return [ pages[counter * len(pages) // nb_pages] for counter in range(nb_pages) ]
+
+def fit_budget(query:str, pages:List[str], model:str, context_size:int, max_tokens:Optional[int]=None, max_cost:Optional[float]=None, token_budget:Optional[int]=None, token_counter:Optional[TokenCounter]=None, fan_in:Optional[int]=None, reduce_token_budget:Optional[int]=None, map_model:Optional[str]=None, map_max_tokens:Optional[int]=MAX_TOKENS, reduce_max_tokens:int=MAX_TOKENS) -> BudgetPlan:
+    # degrades the plan until its estimate fits : coarser partitions, then a cheaper map model, then a sample of the pages
+    configured_model = map_model = map_model or model
+    if max_cost is not None:
+        model_price(model)
+        model_price(map_model)
+    if token_counter is None:
+        token_counter = get_token_counter(model)
+    # the candidate plans share most of their leaves, each one is counted once
+    token_counter = functools.lru_cache(maxsize=None)(token_counter)
+    context_window = MODEL_CONTEXT_WINDOWS.get(map_model, DEFAULT_CONTEXT_WINDOW) - PROMPT_RESERVE
+
+    def estimate(pages:List[str], context_size:int, token_budget:Optional[int], map_model:str) -> CostEstimate:
+        return estimate_cost(query, pages, model, context_size, token_budget, token_counter, fan_in, reduce_token_budget, map_model, map_max_tokens, reduce_max_tokens)
+
+    def fits(estimate:CostEstimate) -> bool:
+        # the budget holds the whole completion allowance of a call in flight, the largest map call must fit with it
+        if max_tokens is not None and estimate.max_leaf_tokens + (map_max_tokens or MAX_TOKENS) > max_tokens:
+            return False
+        return fits_budget(estimate, max_tokens, max_cost)
+
+    def spend(estimate:CostEstimate) -> float:
+        return estimate.cost if max_cost is not None and estimate.cost is not None else estimate.tokens
+
+    def partitionings(pages:List[str]) -> List[Tuple[int, Optional[int]]]:
+        if token_budget is not None:
+            budgets = [ token_budget ]
+            while budgets[-1] < context_window:
+                budgets.append(min(2 * budgets[-1], context_window))
+            return [ (context_size, budget) for budget in budgets ]
+        # the number of leaves does not shrink monotonically with the context size, every size is a candidate
+        # (20 pages give 20, 10, 20 and 1 leaves at 4, 8, 16 and 20), the sizes giving the same leaves are estimated once
+        candidates:List[Tuple[int, Optional[int]]] = []
+        layouts:Set[Tuple[int, ...]] = set()
+        for size in range(context_size, max(len(pages), context_size) + 1):
+            layout = tuple(len(leaf) for leaf in collect_leaves(pages, size))
+            if layout not in layouts:
+                layouts.add(layout)
+                candidates.append((size, None))
+        return candidates
+
+    def coarsen(pages:List[str], map_model:str) -> Tuple[int, Optional[int], CostEstimate]:
+        # the cheapest partitioning that fits, the cheapest one when none does
+        plans:List[Tuple[int, Optional[int], CostEstimate]] = []
+        for size, budget in partitionings(pages):
+            candidate = estimate(pages, size, budget, map_model)
+            if (size, budget) == (context_size, token_budget) or candidate.max_leaf_tokens <= context_window:
+                plans.append((size, budget, candidate))
+        fitting = [ plan for plan in plans if fits(plan[2]) ]
+        return min(fitting or plans, key=lambda plan: spend(plan[2]))
+
+    current = estimate(pages, context_size, token_budget, map_model)
+    if fits(current):
+        return BudgetPlan(pages=pages, context_size=context_size, token_budget=token_budget, map_model=map_model, estimate=current)
+
+    # fewer map calls pay the prompt overhead less often and leave fewer answers to reduce
+    plan_size, plan_budget, current = coarsen(pages, map_model)
+
+    if not fits(current) and max_cost is not None and map_model in CHEAPER_MODELS:
+        map_model = CHEAPER_MODELS[map_model]
+        plan_size, plan_budget, current = coarsen(pages, map_model)
+
+    nb_pages = len(pages)
+    if not fits(current):
+        # the largest evenly spaced sample that fits
+        low, high = 0, len(pages)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if fits(coarsen(sample_pages(pages, middle), map_model)[2]):
+                low = middle
+            else:
+                high = middle - 1
+        if low == 0:
+            raise BudgetExceededError(f'the budget does not cover a single map call (estimate: {current.tokens} tokens, ${current.cost or 0.0:.4f})')
+        pages = sample_pages(pages, low)
+        plan_size, plan_budget, current = coarsen(pages, map_model)
+
+    degradations:List[str] = []
+    if plan_size != context_size:
+        degradations.append(f'context_size {context_size} -> {plan_size}')
+    if plan_budget != token_budget:
+        degradations.append(f'token_budget {token_budget} -> {plan_budget}')
+    if map_model != configured_model:
+        degradations.append(f'map model {configured_model} -> {map_model}')
+    if len(pages) < nb_pages:
+        degradations.append(f'{len(pages)}/{nb_pages} pages sampled')
+    return BudgetPlan(pages=pages, context_size=plan_size, token_budget=plan_budget, map_model=map_model, estimate=current, degradations=degradations)
+
+def map_cache_key(page:str, query:str, model:str, max_tokens:int=MAX_TOKENS) -> str:
+    return Cache.make_key('map', map_system_prompt, model, max_tokens, query, page)
+
+def reduce_cache_key(accumulator:List[str], query:str, model:str, max_tokens:int=MAX_TOKENS) -> str:
+    return Cache.make_key('reduce', reduce_system_prompt, model, max_tokens, query, accumulator)
+
+def multi_map_cache_key(page:str, queries:List[str], model:str, max_tokens:int=MAX_TOKENS) -> str:
+    return Cache.make_key('multi_map', multi_map_system_prompt, model, max_tokens, queries, page)
+
+def digest_cache_key(page:str, model:str, max_tokens:int=MAX_TOKENS) -> str:
+    return Cache.make_key('digest', digest_system_prompt, model, max_tokens, page)
+
+
+def llm_map(page:str, query:str, model:str, llm:LLMBackend, cache:Optional[Cache]=None, max_tokens:int=MAX_TOKENS) -> Optional[str]:
+    logger.info('map phase')
+    with span('map', nb_chars=len(page)):
+        if cache is not None:
+            key = map_cache_key(page=page, query=query, model=model, max_tokens=max_tokens)
+            stringyfied_data = cache.get(key)
+            if stringyfied_data is not None:
+                annotate(cache_hit=True)
+                return parse_map_result(stringyfied_data)
+
+        out_map:ChatCompletion = llm.chat.completions.create(
+            model=model,
+            messages=build_map_messages(page=page, query=query),
+            max_tokens=max_tokens,
+            response_format=MAP_RESPONSE_FORMAT
+        )
+        record_usage(out_map)
+        stringyfied_data = out_map.choices[0].message.content
+        if cache is not None and stringyfied_data is not None:
+            cache.put(key, stringyfied_data)
+        return parse_map_result(stringyfied_data)
+
+def llm_multi_map(page:str, queries:List[str], model:str, llm:LLMBackend, cache:Optional[Cache]=None, max_tokens:int=MAX_TOKENS) -> List[Optional[str]]:
+    logger.info('map phase')
+    with span('map', nb_chars=len(page), nb_queries=len(queries)):
+        if cache is not None:
+            key = multi_map_cache_key(page=page, queries=queries, model=model, max_tokens=max_tokens)
+            stringyfied_data = cache.get(key)
+            if stringyfied_data is not None:
+                annotate(cache_hit=True)
+                return parse_multi_map_result(stringyfied_data, len(queries))
+
+        out_map:ChatCompletion = llm.chat.completions.create(
+            model=model,
+            messages=build_multi_map_messages(page=page, queries=queries),
+            max_tokens=max_tokens,
+            response_format=MAP_RESPONSE_FORMAT
+        )
+        record_usage(out_map)
+        stringyfied_data = out_map.choices[0].message.content
+        if cache is not None and stringyfied_data is not None:
+            cache.put(key, stringyfied_data)
+        return parse_multi_map_result(stringyfied_data, len(queries))
+
+def stream_completion(llm:LLMBackend, model:str, messages:List[Dict[str, str]], on_token:TokenCallback, max_tokens:int=MAX_TOKENS) -> Optional[str]:
+    tokens:List[str] = []
+    annotate(streamed=True)
+    for chunk in llm.chat.completions.create(model=model, messages=messages, max_tokens=max_tokens, stream=True):
+        record_usage(chunk)
+        if len(chunk.choices) == 0 or chunk.choices[0].delta.content is None:
+            continue
+        tokens.append(chunk.choices[0].delta.content)
+        on_token(tokens[-1])
+    if len(tokens) == 0:
+        return None
+    return "".join(tokens)
 
-    accumulator:List[Optional[str]] = []
-    with ThreadPoolExecutor(max_workers=len(paritions)) as executor:
-        fn = partial(llm_map_reduce, query, model, llm, context_size)
-        features = executor.map(fn, paritions)
-        for map_response in features:
-            accumulator.append(map_response)
+def llm_reduce(accumulator:List[Optional[str]], model:str, llm:LLMBackend, query:str, cache:Optional[Cache]=None, on_token:Optional[TokenCallback]=None, max_tokens:int=MAX_TOKENS) -> Optional[str]:
+    logger.info('reduce phase')
+    accumulator = [ res for res in accumulator if res is not None ]
 
-    out_response = llm_reduce(
-        query=query, model=model, llm=llm, accumulator=accumulator
+    if len(accumulator) == 0:
+        return None
+
+    with span('reduce', nb_segments=len(accumulator)):
+        if cache is not None:
+            key = reduce_cache_key(accumulator=accumulator, query=query, model=model, max_tokens=max_tokens)
+            stringyfied_data = cache.get(key)
+            if stringyfied_data is not None:
+                annotate(cache_hit=True)
+                if on_token is not None:
+                    on_token(stringyfied_data)
+                return stringyfied_data
+
+        messages = build_reduce_messages(accumulator=accumulator, query=query)
+        if on_token is not None:
+            stringyfied_data = stream_completion(llm, model, messages, on_token, max_tokens)
+        else:
+            out_reduce:ChatCompletion = llm.chat.completions.create(
+                model=model,
+                messages=messages,
+                max_tokens=max_tokens
+            )
+            record_usage(out_reduce)
+            stringyfied_data = out_reduce.choices[0].message.content
+        if cache is not None and stringyfied_data is not None:
+            cache.put(key, stringyfied_data)
+        return stringyfied_data
+
+def check_map_failures(errors:List[Exception], nb_calls:int, failure_tolerance:float) -> None:
+    # partitions skipped once the query budget is spent are expected, they do not count against the tolerance
+    nb_skipped = sum(isinstance(error, BudgetExceededError) for error in errors)
+    if nb_skipped > 0:
+        logger.warning(f'{nb_skipped}/{nb_calls} map calls skipped by the query budget')
+        errors = [ error for error in errors if not isinstance(error, BudgetExceededError) ]
+    # the reduce runs on the partitions that succeeded as long as the failed share stays under the tolerance
+    if len(errors) == 0:
+        return
+    if len(errors) > failure_tolerance * nb_calls:
+        raise errors[0]
+    logger.warning(f'{len(errors)}/{nb_calls} map calls failed, the reduce runs on the partitions that succeeded')
+
+def gather_map_results(features:List[Future], failure_tolerance:float=0.0) -> List[Optional[str]]:
+    results:List[Optional[str]] = []
+    errors:List[Exception] = []
+    for future in features:
+        try:
+            results.append(future.result())
+        except BudgetExceededError as e:
+            errors.append(e)
+            results.append(None)
+        except Exception as e:
+            if failure_tolerance <= 0:
+                raise
+            errors.append(e)
+            results.append(None)
+    check_map_failures(errors, len(features), failure_tolerance)
+    return results
+
+def llm_tree_reduce(query:str, model:str, llm:LLMBackend, segments:List[Optional[str]], fan_in:int, scheduler:Optional[Scheduler]=None, cache:Optional[Cache]=None, reduce_token_budget:Optional[int]=None, token_counter:Optional[TokenCounter]=None, on_token:Optional[TokenCallback]=None, max_tokens:int=MAX_TOKENS) -> Optional[str]:
+    # level by level : every reduce call of a level runs in parallel and stays under fan_in and the token budget
+    if scheduler is None:
+        with Scheduler(max_workers=DEFAULT_MAX_WORKERS) as scheduler:
+            return llm_tree_reduce(query, model, llm, segments, fan_in, scheduler, cache, reduce_token_budget, token_counter, on_token, max_tokens)
+
+    if token_counter is None:
+        token_counter = get_token_counter(model)
+
+    segments = [ segment for segment in segments if segment is not None ]
+    level = 1
+    while len(segments) > 1:
+        groups = plan_reduce(segments, model, fan_in, reduce_token_budget, token_counter)
+        with span('level', level=level, nb_segments=len(segments), nb_groups=len(groups)):
+            if len(groups) == 1:
+                # only the root reduce streams its tokens, inner nodes are not part of the answer
+                return scheduler.submit(
+                    llm_reduce, accumulator=groups[0], model=model, llm=llm, query=query, cache=cache, on_token=on_token, max_tokens=max_tokens
+                ).result()
+
+            features:List[Future] = []
+            for group in groups:
+                if len(group) == 1:
+                    # a lone segment is promoted as is instead of paying a reduce call
+                    features.append(scheduler.done(group[0]))
+                    continue
+                features.append(
+                    scheduler.submit(llm_reduce, accumulator=group, model=model, llm=llm, query=query, cache=cache, max_tokens=max_tokens)
+                )
+            segments = [ future.result() for future in features ]
+            segments = [ segment for segment in segments if segment is not None ]
+        level += 1
+
+    if len(segments) == 0:
+        return None
+    return segments[0]
+
+def llm_map_reduce(query:str, model:str, llm:LLMBackend, context_size:int, pages:List[str], scheduler:Optional[Scheduler]=None, cache:Optional[Cache]=None, token_budget:Optional[int]=None, token_counter:Optional[TokenCounter]=None, fan_in:Optional[int]=None, reduce_token_budget:Optional[int]=None, on_token:Optional[TokenCallback]=None, failure_tolerance:float=0.0, map_model:Optional[str]=None, map_max_tokens:Optional[int]=MAX_TOKENS, reduce_max_tokens:int=MAX_TOKENS) -> Optional[str]:
+    if len(pages) == 0:
+        return None
+
+    if scheduler is None:
+        with Scheduler(max_workers=DEFAULT_MAX_WORKERS) as scheduler:
+            return llm_map_reduce(query, model, llm, context_size, pages, scheduler, cache, token_budget, token_counter, fan_in, reduce_token_budget, on_token, failure_tolerance, map_model, map_max_tokens, reduce_max_tokens)
+
+    # cascade : the fan-out of map calls can run on a cheaper model than the reduce tree
+    map_model = map_model or model
+    if token_counter is None:
+        token_counter = get_token_counter(model)
+    leaves = plan_leaves(pages, map_model, context_size, token_budget, token_counter)
+    with span('level', level=0, nb_pages=len(pages), nb_leaves=len(leaves)):
+        features:List[Future] = []
+        for index, page in enumerate(leaves):
+            with tag(leaf=index):
+                features.append(scheduler.submit(
+                    llm_map, page=page, model=map_model, llm=llm, query=query, cache=cache, max_tokens=map_max_tokens_of(page, map_max_tokens, token_counter)
+                ))
+        accumulator = gather_map_results(features, failure_tolerance)
+    if len(accumulator) == 1:
+        return accumulator[0]
+
+    return llm_tree_reduce(
+        query, model, llm, accumulator, fan_in or context_size, scheduler, cache, reduce_token_budget, token_counter, on_token, reduce_max_tokens
     )
-    return out_response
 
+def llm_map_reduce_stream(query:str, model:str, llm:LLMBackend, context_size:int, pages:Iterable[str], scheduler:Optional[Scheduler]=None, cache:Optional[Cache]=None, fan_in:Optional[int]=None, reduce_token_budget:Optional[int]=None, on_token:Optional[TokenCallback]=None, failure_tolerance:float=0.0, map_model:Optional[str]=None, map_max_tokens:Optional[int]=MAX_TOKENS, reduce_max_tokens:int=MAX_TOKENS, nb_pages:Optional[int]=None) -> Optional[str]:
+    # map calls are submitted while the pages are still being produced, on the leaves of collect_leaves so that
+    # both engines send the same map calls and share their cache entries
+    if scheduler is None:
+        with Scheduler(max_workers=DEFAULT_MAX_WORKERS) as scheduler:
+            return llm_map_reduce_stream(query, model, llm, context_size, pages, scheduler, cache, fan_in, reduce_token_budget, on_token, failure_tolerance, map_model, map_max_tokens, reduce_max_tokens, nb_pages)
+
+    map_model = map_model or model
+    token_counter = get_token_counter(model)
+    # the leaf boundaries depend on the page count, without it every page is awaited before the first map call
+    leaf_sizes = [ len(leaf) for leaf in collect_leaves(list(range(nb_pages)), context_size) ] if nb_pages else []
+    submitted:Dict[str, Future] = {}
+
+    def submit_leaf(leaf:str) -> Future:
+        if leaf not in submitted:
+            with tag(leaf=len(submitted)):
+                submitted[leaf] = scheduler.submit(
+                    llm_map, page=leaf, model=map_model, llm=llm, query=query, cache=cache, max_tokens=map_max_tokens_of(leaf, map_max_tokens, token_counter)
+                )
+        return submitted[leaf]
+
+    received:List[str] = []
+    with span('level', level=0):
+        cursor = 0
+        for page in pages:
+            received.append(page)
+            if len(leaf_sizes) > 0 and len(received) - cursor == leaf_sizes[0]:
+                submit_leaf("\n".join(received[cursor:]))
+                cursor = len(received)
+                leaf_sizes.pop(0)
+        if len(received) == 0:
+            return None
+        # a wrong page count (empty pages are skipped by the extraction) is replanned on the actual pages,
+        # the leaves that were already right keep their call and the others are left out of the reduce
+        features = [ submit_leaf("\n".join(leaf)) for leaf in collect_leaves(received, context_size) ]
+        annotate(nb_pages=len(received), nb_leaves=len(features))
+        accumulator = gather_map_results(features, failure_tolerance)
+    if len(accumulator) == 1:
+        return accumulator[0]
+
+    return llm_tree_reduce(
+        query, model, llm, accumulator, fan_in or context_size, scheduler, cache, reduce_token_budget, token_counter, on_token, reduce_max_tokens
+    )
+
+def pop_ready_groups(ready:List[str], fan_in:int, reduce_token_budget:int, token_counter:TokenCounter) -> List[List[str]]:
+    # only the groups closed by the fan-in or the token budget are merged, the open tail waits for more results
+    groups = pack_segments(ready, fan_in, reduce_token_budget, token_counter)
+    closed:List[List[str]] = []
+    remaining:List[str] = []
+    for counter, group in enumerate(groups):
+        is_closed = len(group) >= max(fan_in, 2) or (counter < len(groups) - 1 and len(group) > 1)
+        if is_closed:
+            closed.append(group)
+        else:
+            remaining.extend(group)
+    ready[:] = remaining
+    return closed
+
+def llm_map_reduce_incremental(query:str, model:str, llm:LLMBackend, context_size:int, pages:Iterable[str], scheduler:Optional[Scheduler]=None, cache:Optional[Cache]=None, token_budget:Optional[int]=None, token_counter:Optional[TokenCounter]=None, fan_in:Optional[int]=None, reduce_token_budget:Optional[int]=None, on_token:Optional[TokenCallback]=None, failure_tolerance:float=0.0, map_model:Optional[str]=None, map_max_tokens:Optional[int]=MAX_TOKENS, reduce_max_tokens:int=MAX_TOKENS) -> Optional[str]:
+    # results are merged in completion order, a slow page only delays the reduce calls that need it
+    if scheduler is None:
+        with Scheduler(max_workers=DEFAULT_MAX_WORKERS) as scheduler:
+            return llm_map_reduce_incremental(query, model, llm, context_size, pages, scheduler, cache, token_budget, token_counter, fan_in, reduce_token_budget, on_token, failure_tolerance, map_model, map_max_tokens, reduce_max_tokens)
+
+    map_model = map_model or model
+    fan_in = max(fan_in or context_size, 2)
+    if reduce_token_budget is None:
+        reduce_token_budget = default_token_budget(model)
+    if token_counter is None:
+        token_counter = get_token_counter(model)
+
+    completed:queue.Queue = queue.Queue()
+    ready:List[str] = []
+    errors:List[Exception] = []
+    map_features:Set[Future] = set()
+    nb_pending = 0
+
+    def submit(fn:Callable[..., Optional[str]], **kwargs) -> None:
+        nonlocal nb_pending
+        nb_pending += 1
+        future = scheduler.submit(fn, **kwargs)
+        if fn is llm_map:
+            map_features.add(future)
+        future.add_done_callback(completed.put)
+
+    def collect(block:bool) -> None:
+        nonlocal nb_pending
+        while nb_pending > 0:
+            try:
+                future:Future = completed.get(block=block)
+            except queue.Empty:
+                break
+            block = False
+            nb_pending -= 1
+            try:
+                segment = future.result()
+            except Exception as e:
+                # only map failures are tolerated, a failed reduce would drop several partitions at once
+                if future not in map_features or (failure_tolerance <= 0 and not isinstance(e, BudgetExceededError)):
+                    raise
+                errors.append(e)
+                continue
+            if segment is not None:
+                ready.append(segment)
+        for group in pop_ready_groups(ready, fan_in, reduce_token_budget, token_counter):
+            submit(llm_reduce, accumulator=group, model=model, llm=llm, query=query, cache=cache, max_tokens=reduce_max_tokens)
+
+    def submit_leaf(leaf:str) -> None:
+        with tag(leaf=nb_leaves):
+            submit(llm_map, page=leaf, model=map_model, llm=llm, query=query, cache=cache, max_tokens=map_max_tokens_of(leaf, map_max_tokens, token_counter))
+
+    leaf_size = max(context_size, 1)
+    if token_budget is not None:
+        pages = plan_leaves(list(pages), map_model, context_size, token_budget, token_counter)
+        leaf_size = 1
+    nb_leaves = 0
+    buffer:List[str] = []
+    # maps and merges overlap in completion order, they are traced as a single level
+    with span('level', level=0, incremental=True):
+        for page in pages:
+            buffer.append(page)
+            if len(buffer) == leaf_size:
+                submit_leaf("\n".join(buffer))
+                nb_leaves += 1
+                buffer = []
+                collect(block=False)
+        if len(buffer) > 0:
+            submit_leaf("\n".join(buffer))
+            nb_leaves += 1
+
+        while nb_pending > 0:
+            collect(block=True)
+        annotate(nb_leaves=nb_leaves)
+    check_map_failures(errors, nb_leaves, failure_tolerance)
+
+    if nb_leaves == 1:
+        return ready[0] if len(ready) > 0 else None
+
+    return llm_tree_reduce(
+        query, model, llm, ready, fan_in, scheduler, cache, reduce_token_budget, token_counter, on_token, reduce_max_tokens
+    )
+
+def llm_digest(page:str, model:str, llm:LLMBackend, cache:Optional[Cache]=None, max_tokens:int=MAX_TOKENS) -> str:
+    logger.info('digest phase')
+    with span('digest', nb_chars=len(page)):
+        if cache is not None:
+            key = digest_cache_key(page=page, model=model, max_tokens=max_tokens)
+            stringyfied_data = cache.get(key)
+            if stringyfied_data is not None:
+                annotate(cache_hit=True)
+                return stringyfied_data
+
+        out_digest:ChatCompletion = llm.chat.completions.create(
+            model=model,
+            messages=build_digest_messages(page=page),
+            max_tokens=max_tokens
+        )
+        record_usage(out_digest)
+        stringyfied_data = out_digest.choices[0].message.content
+        if cache is not None and stringyfied_data is not None:
+            cache.put(key, stringyfied_data)
+        return stringyfied_data
+
+def llm_index(model:str, llm:LLMBackend, pages:List[str], scheduler:Optional[Scheduler]=None, cache:Optional[Cache]=None, failure_tolerance:float=0.0) -> List[Optional[str]]:
+    if scheduler is None:
+        with Scheduler(max_workers=DEFAULT_MAX_WORKERS) as scheduler:
+            return llm_index(model, llm, pages, scheduler, cache, failure_tolerance)
+
+    with span('level', level=0, nb_pages=len(pages)):
+        features:List[Future] = []
+        for index, page in enumerate(pages):
+            with tag(leaf=index):
+                features.append(scheduler.submit(llm_digest, page=page, model=model, llm=llm, cache=cache))
+        return gather_map_results(features, failure_tolerance)
+
+def llm_index_reduce(query:str, model:str, llm:LLMBackend, context_size:int, digests:List[Optional[str]], scheduler:Optional[Scheduler]=None, cache:Optional[Cache]=None, fan_in:Optional[int]=None, reduce_token_budget:Optional[int]=None, on_token:Optional[TokenCallback]=None, max_tokens:int=MAX_TOKENS) -> Optional[str]:
+    # the digests go straight into the reduce tree, no map call is spent at query time
+    digests = [ digest for digest in digests if digest is not None ]
+    if len(digests) == 0:
+        return None
+
+    if len(digests) == 1:
+        # a digest is not an answer, the query still needs one reduce call
+        return llm_reduce(accumulator=digests, model=model, llm=llm, query=query, cache=cache, on_token=on_token, max_tokens=max_tokens)
+
+    return llm_tree_reduce(
+        query, model, llm, digests, fan_in or context_size, scheduler, cache, reduce_token_budget, on_token=on_token, max_tokens=max_tokens
+    )
+
+def llm_multi_map_reduce(queries:List[str], model:str, llm:LLMBackend, context_size:int, pages:List[str], scheduler:Optional[Scheduler]=None, cache:Optional[Cache]=None, token_budget:Optional[int]=None, token_counter:Optional[TokenCounter]=None, fan_in:Optional[int]=None, reduce_token_budget:Optional[int]=None, failure_tolerance:float=0.0, map_model:Optional[str]=None, map_max_tokens:Optional[int]=MAX_TOKENS, reduce_max_tokens:int=MAX_TOKENS) -> List[Optional[str]]:
+    # one map call per leaf extracts for every query, the map calls and their input tokens scale with the pages only
+    if len(pages) == 0 or len(queries) == 0:
+        return [ None ] * len(queries)
+
+    if scheduler is None:
+        with Scheduler(max_workers=DEFAULT_MAX_WORKERS) as scheduler:
+            return llm_multi_map_reduce(queries, model, llm, context_size, pages, scheduler, cache, token_budget, token_counter, fan_in, reduce_token_budget, failure_tolerance, map_model, map_max_tokens, reduce_max_tokens)
+
+    map_model = map_model or model
+    if token_counter is None:
+        token_counter = get_token_counter(model)
+    leaves = plan_leaves(pages, map_model, context_size, token_budget, token_counter)
+    with span('level', level=0, nb_pages=len(pages), nb_leaves=len(leaves), nb_queries=len(queries)):
+        features:List[Future] = []
+        for index, leaf in enumerate(leaves):
+            with tag(leaf=index):
+                features.append(scheduler.submit(
+                    llm_multi_map, page=leaf, queries=queries, model=map_model, llm=llm, cache=cache, max_tokens=multi_map_max_tokens_of(leaf, len(queries), map_max_tokens, token_counter)
+                ))
+        results = gather_map_results(features, failure_tolerance)
+
+    def reduce_query(index:int) -> Optional[str]:
+        # a failed leaf is missing from every query
+        segments = [ result[index] for result in results if result is not None ]
+        with span('answer', query_index=index):
+            return llm_tree_reduce(
+                queries[index], model, llm, segments, fan_in or context_size, scheduler, cache, reduce_token_budget, token_counter, max_tokens=reduce_max_tokens
+            )
+
+    # every query gets its own reduce tree, the trees only wait on their own calls and are driven side by side
+    with Scheduler(max_workers=len(queries)) as drivers:
+        answers = [ drivers.submit(reduce_query, index) for index in range(len(queries)) ]
+        return [ future.result() for future in answers ]
+
+async def allm_map(page:str, query:str, model:str, llm:AsyncLLMBackend, cache:Optional[Cache]=None, max_tokens:int=MAX_TOKENS) -> Optional[str]:
+    logger.info('map phase')
+    with span('map', nb_chars=len(page)):
+        if cache is not None:
+            key = map_cache_key(page=page, query=query, model=model, max_tokens=max_tokens)
+            stringyfied_data = cache.get(key)
+            if stringyfied_data is not None:
+                annotate(cache_hit=True)
+                return parse_map_result(stringyfied_data)
+
+        out_map:ChatCompletion = await llm.chat.completions.create(
+            model=model,
+            messages=build_map_messages(page=page, query=query),
+            max_tokens=max_tokens,
+            response_format=MAP_RESPONSE_FORMAT
+        )
+        record_usage(out_map)
+        stringyfied_data = out_map.choices[0].message.content
+        if cache is not None and stringyfied_data is not None:
+            cache.put(key, stringyfied_data)
+        return parse_map_result(stringyfied_data)
+
+async def allm_multi_map(page:str, queries:List[str], model:str, llm:AsyncLLMBackend, cache:Optional[Cache]=None, max_tokens:int=MAX_TOKENS) -> List[Optional[str]]:
+    logger.info('map phase')
+    with span('map', nb_chars=len(page), nb_queries=len(queries)):
+        if cache is not None:
+            key = multi_map_cache_key(page=page, queries=queries, model=model, max_tokens=max_tokens)
+            stringyfied_data = cache.get(key)
+            if stringyfied_data is not None:
+                annotate(cache_hit=True)
+                return parse_multi_map_result(stringyfied_data, len(queries))
+
+        out_map:ChatCompletion = await llm.chat.completions.create(
+            model=model,
+            messages=build_multi_map_messages(page=page, queries=queries),
+            max_tokens=max_tokens,
+            response_format=MAP_RESPONSE_FORMAT
+        )
+        record_usage(out_map)
+        stringyfied_data = out_map.choices[0].message.content
+        if cache is not None and stringyfied_data is not None:
+            cache.put(key, stringyfied_data)
+        return parse_multi_map_result(stringyfied_data, len(queries))
+
+async def astream_completion(llm:AsyncLLMBackend, model:str, messages:List[Dict[str, str]], on_token:TokenCallback, max_tokens:int=MAX_TOKENS) -> Optional[str]:
+    tokens:List[str] = []
+    annotate(streamed=True)
+    async for chunk in await llm.chat.completions.create(model=model, messages=messages, max_tokens=max_tokens, stream=True):
+        record_usage(chunk)
+        if len(chunk.choices) == 0 or chunk.choices[0].delta.content is None:
+            continue
+        tokens.append(chunk.choices[0].delta.content)
+        on_token(tokens[-1])
+    if len(tokens) == 0:
+        return None
+    return "".join(tokens)
+
+async def allm_reduce(accumulator:List[Optional[str]], model:str, llm:AsyncLLMBackend, query:str, cache:Optional[Cache]=None, on_token:Optional[TokenCallback]=None, max_tokens:int=MAX_TOKENS) -> Optional[str]:
+    logger.info('reduce phase')
+    accumulator = [ res for res in accumulator if res is not None ]
+
+    if len(accumulator) == 0:
+        return None
+
+    with span('reduce', nb_segments=len(accumulator)):
+        if cache is not None:
+            key = reduce_cache_key(accumulator=accumulator, query=query, model=model, max_tokens=max_tokens)
+            stringyfied_data = cache.get(key)
+            if stringyfied_data is not None:
+                annotate(cache_hit=True)
+                if on_token is not None:
+                    on_token(stringyfied_data)
+                return stringyfied_data
+
+        messages = build_reduce_messages(accumulator=accumulator, query=query)
+        if on_token is not None:
+            stringyfied_data = await astream_completion(llm, model, messages, on_token, max_tokens)
+        else:
+            out_reduce:ChatCompletion = await llm.chat.completions.create(
+                model=model,
+                messages=messages,
+                max_tokens=max_tokens
+            )
+            record_usage(out_reduce)
+            stringyfied_data = out_reduce.choices[0].message.content
+        if cache is not None and stringyfied_data is not None:
+            cache.put(key, stringyfied_data)
+        return stringyfied_data
+
+async def allm_tree_reduce(query:str, model:str, llm:AsyncLLMBackend, segments:List[Optional[str]], fan_in:int, semaphore:Optional[asyncio.Semaphore]=None, cache:Optional[Cache]=None, reduce_token_budget:Optional[int]=None, token_counter:Optional[TokenCounter]=None, on_token:Optional[TokenCallback]=None, max_tokens:int=MAX_TOKENS) -> Optional[str]:
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(DEFAULT_MAX_CONCURRENCY)
+
+    async def reduce_group(group:List[str], on_token:Optional[TokenCallback]=None) -> Optional[str]:
+        if len(group) == 1:
+            return group[0]
+        mark_queued()
+        async with semaphore:
+            return await allm_reduce(accumulator=group, model=model, llm=llm, query=query, cache=cache, on_token=on_token, max_tokens=max_tokens)
+
+    if token_counter is None:
+        token_counter = get_token_counter(model)
+
+    segments = [ segment for segment in segments if segment is not None ]
+    level = 1
+    while len(segments) > 1:
+        groups = plan_reduce(segments, model, fan_in, reduce_token_budget, token_counter)
+        with span('level', level=level, nb_segments=len(segments), nb_groups=len(groups)):
+            if len(groups) == 1:
+                return await reduce_group(groups[0], on_token)
+            segments = await asyncio.gather(*[ reduce_group(group) for group in groups ])
+            segments = [ segment for segment in segments if segment is not None ]
+        level += 1
+
+    if len(segments) == 0:
+        return None
+    return segments[0]
+
+async def skip_over_budget(coroutine:Awaitable[Optional[str]]) -> Any:
+    try:
+        return await coroutine
+    except BudgetExceededError as e:
+        return e
+
+async def agather_map_results(coroutines:List[Awaitable[Optional[str]]], failure_tolerance:float=0.0) -> List[Optional[str]]:
+    if failure_tolerance <= 0:
+        results = await asyncio.gather(*[ skip_over_budget(coroutine) for coroutine in coroutines ])
+        errors = [ result for result in results if isinstance(result, BudgetExceededError) ]
+        check_map_failures(errors, len(results), failure_tolerance)
+        return [ None if isinstance(result, BudgetExceededError) else result for result in results ]
+
+    results = await asyncio.gather(*coroutines, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException) and not isinstance(result, Exception):
+            raise result
+    errors = [ result for result in results if isinstance(result, Exception) ]
+    check_map_failures(errors, len(results), failure_tolerance)
+    return [ None if isinstance(result, Exception) else result for result in results ]
+
+async def allm_map_reduce(query:str, model:str, llm:AsyncLLMBackend, context_size:int, pages:List[str], semaphore:Optional[asyncio.Semaphore]=None, cache:Optional[Cache]=None, token_budget:Optional[int]=None, token_counter:Optional[TokenCounter]=None, fan_in:Optional[int]=None, reduce_token_budget:Optional[int]=None, on_token:Optional[TokenCallback]=None, failure_tolerance:float=0.0, map_model:Optional[str]=None, map_max_tokens:Optional[int]=MAX_TOKENS, reduce_max_tokens:int=MAX_TOKENS) -> Optional[str]:
+    if len(pages) == 0:
+        return None
+
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(DEFAULT_MAX_CONCURRENCY)
+
+    map_model = map_model or model
+    if token_counter is None:
+        token_counter = get_token_counter(model)
+
+    # only the llm calls acquire the semaphore, nothing is held while waiting on a level
+    async def map_leaf(index:int, page:str) -> str:
+        with tag(leaf=index):
+            mark_queued()
+            async with semaphore:
+                return await allm_map(page=page, model=map_model, llm=llm, query=query, cache=cache, max_tokens=map_max_tokens_of(page, map_max_tokens, token_counter))
+
+    leaves = plan_leaves(pages, map_model, context_size, token_budget, token_counter)
+    with span('level', level=0, nb_pages=len(pages), nb_leaves=len(leaves)):
+        accumulator = await agather_map_results([
+            map_leaf(index, page) for index, page in enumerate(leaves)
+        ], failure_tolerance)
+    if len(accumulator) == 1:
+        return accumulator[0]
+
+    return await allm_tree_reduce(
+        query, model, llm, accumulator, fan_in or context_size, semaphore, cache, reduce_token_budget, token_counter, on_token, reduce_max_tokens
+    )
+
+async def allm_map_reduce_incremental(query:str, model:str, llm:AsyncLLMBackend, context_size:int, pages:List[str], semaphore:Optional[asyncio.Semaphore]=None, cache:Optional[Cache]=None, token_budget:Optional[int]=None, token_counter:Optional[TokenCounter]=None, fan_in:Optional[int]=None, reduce_token_budget:Optional[int]=None, on_token:Optional[TokenCallback]=None, failure_tolerance:float=0.0, map_model:Optional[str]=None, map_max_tokens:Optional[int]=MAX_TOKENS, reduce_max_tokens:int=MAX_TOKENS) -> Optional[str]:
+    if len(pages) == 0:
+        return None
+
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(DEFAULT_MAX_CONCURRENCY)
+
+    map_model = map_model or model
+    fan_in = max(fan_in or context_size, 2)
+    if reduce_token_budget is None:
+        reduce_token_budget = default_token_budget(model)
+    if token_counter is None:
+        token_counter = get_token_counter(model)
+
+    async def call(fn:Callable[..., Optional[str]], **kwargs) -> Optional[str]:
+        mark_queued()
+        async with semaphore:
+            return await fn(**kwargs)
+
+    async def map_leaf(index:int, page:str) -> Optional[str]:
+        with tag(leaf=index):
+            return await call(allm_map, page=page, model=map_model, llm=llm, query=query, cache=cache, max_tokens=map_max_tokens_of(page, map_max_tokens, token_counter))
+
+    leaves = plan_leaves(pages, map_model, context_size, token_budget, token_counter)
+    # maps and merges overlap in completion order, they are traced as a single level
+    with span('level', level=0, incremental=True, nb_leaves=len(leaves)):
+        map_tasks:Set[asyncio.Future] = set(
+            asyncio.ensure_future(map_leaf(index, page))
+            for index, page in enumerate(leaves)
+        )
+        pending:Set[asyncio.Future] = set(map_tasks)
+        ready:List[str] = []
+        errors:List[Exception] = []
+        try:
+            while len(pending) > 0:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    try:
+                        segment = task.result()
+                    except Exception as e:
+                        if task not in map_tasks or (failure_tolerance <= 0 and not isinstance(e, BudgetExceededError)):
+                            raise
+                        errors.append(e)
+                        continue
+                    if segment is not None:
+                        ready.append(segment)
+                for group in pop_ready_groups(ready, fan_in, reduce_token_budget, token_counter):
+                    pending.add(
+                        asyncio.ensure_future(call(allm_reduce, accumulator=group, model=model, llm=llm, query=query, cache=cache, max_tokens=reduce_max_tokens))
+                    )
+        finally:
+            for task in pending:
+                task.cancel()
+    check_map_failures(errors, len(leaves), failure_tolerance)
+
+    if len(leaves) == 1:
+        return ready[0] if len(ready) > 0 else None
+
+    return await allm_tree_reduce(
+        query, model, llm, ready, fan_in, semaphore, cache, reduce_token_budget, token_counter, on_token, reduce_max_tokens
+    )
+
+async def allm_index_reduce(query:str, model:str, llm:AsyncLLMBackend, context_size:int, digests:List[Optional[str]], semaphore:Optional[asyncio.Semaphore]=None, cache:Optional[Cache]=None, fan_in:Optional[int]=None, reduce_token_budget:Optional[int]=None, on_token:Optional[TokenCallback]=None, max_tokens:int=MAX_TOKENS) -> Optional[str]:
+    digests = [ digest for digest in digests if digest is not None ]
+    if len(digests) == 0:
+        return None
+
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(DEFAULT_MAX_CONCURRENCY)
+
+    if len(digests) == 1:
+        async with semaphore:
+            return await allm_reduce(accumulator=digests, model=model, llm=llm, query=query, cache=cache, on_token=on_token, max_tokens=max_tokens)
+
+    return await allm_tree_reduce(
+        query, model, llm, digests, fan_in or context_size, semaphore, cache, reduce_token_budget, on_token=on_token, max_tokens=max_tokens
+    )
+
+async def allm_multi_map_reduce(queries:List[str], model:str, llm:AsyncLLMBackend, context_size:int, pages:List[str], semaphore:Optional[asyncio.Semaphore]=None, cache:Optional[Cache]=None, token_budget:Optional[int]=None, token_counter:Optional[TokenCounter]=None, fan_in:Optional[int]=None, reduce_token_budget:Optional[int]=None, failure_tolerance:float=0.0, map_model:Optional[str]=None, map_max_tokens:Optional[int]=MAX_TOKENS, reduce_max_tokens:int=MAX_TOKENS) -> List[Optional[str]]:
+    if len(pages) == 0 or len(queries) == 0:
+        return [ None ] * len(queries)
+
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(DEFAULT_MAX_CONCURRENCY)
+
+    map_model = map_model or model
+    if token_counter is None:
+        token_counter = get_token_counter(model)
+
+    async def map_leaf(index:int, leaf:str) -> List[Optional[str]]:
+        with tag(leaf=index):
+            mark_queued()
+            async with semaphore:
+                return await allm_multi_map(page=leaf, queries=queries, model=map_model, llm=llm, cache=cache, max_tokens=multi_map_max_tokens_of(leaf, len(queries), map_max_tokens, token_counter))
+
+    leaves = plan_leaves(pages, map_model, context_size, token_budget, token_counter)
+    with span('level', level=0, nb_pages=len(pages), nb_leaves=len(leaves), nb_queries=len(queries)):
+        results = await agather_map_results([
+            map_leaf(index, leaf) for index, leaf in enumerate(leaves)
+        ], failure_tolerance)
+
+    async def reduce_query(index:int) -> Optional[str]:
+        segments = [ result[index] for result in results if result is not None ]
+        with span('answer', query_index=index):
+            return await allm_tree_reduce(
+                queries[index], model, llm, segments, fan_in or context_size, semaphore, cache, reduce_token_budget, token_counter, max_tokens=reduce_max_tokens
+            )
+
+    return list(await asyncio.gather(*[ reduce_query(index) for index in range(len(queries)) ]))
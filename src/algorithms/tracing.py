@@ -0,0 +1,230 @@
+import json
+import time
+import threading
+import contextlib
+
+from contextvars import ContextVar
+
+from typing import Any, Dict, Iterator, List, Optional
+
+# the span of the running code, a task submitted to the scheduler runs under the span of its caller
+current_span:ContextVar[Optional['Span']] = ContextVar('current_span', default=None)
+# attributes given to the next span opened in this context : queue wait, leaf index...
+pending_attributes:ContextVar[Optional[Dict[str, Any]]] = ContextVar('pending_attributes', default=None)
+
+CALL_SPANS = ('map', 'reduce', 'digest')
+
+class Span:
+    def __init__(self, name:str, parent:Optional['Span']=None, **attributes:Any):
+        self.name = name
+        self.parent = parent
+        self.attributes:Dict[str, Any] = attributes
+        self.children:List['Span'] = []
+        self.start = time.perf_counter()
+        self.end:Optional[float] = None
+        self.error:Optional[str] = None
+        # every span of a trace shares the mutex of its root, children are added from the scheduler workers
+        self.mutex:threading.Lock = parent.mutex if parent is not None else threading.Lock()
+        self.origin:float = parent.origin if parent is not None else self.start
+        if parent is not None:
+            with self.mutex:
+                parent.children.append(self)
+
+    @property
+    def duration(self) -> Optional[float]:
+        return None if self.end is None else self.end - self.start
+
+    def walk(self) -> Iterator['Span']:
+        yield self
+        with self.mutex:
+            children = list(self.children)
+        for child in children:
+            yield from child.walk()
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self.mutex:
+            children = sorted(self.children, key=lambda child: child.start)
+        out = {
+            'name': self.name,
+            'start': round(self.start - self.origin, 6),
+            'duration': None if self.duration is None else round(self.duration, 6),
+            'attributes': dict(self.attributes)
+        }
+        if self.error is not None:
+            out['error'] = self.error
+        if len(children) > 0:
+            out['children'] = [ child.to_dict() for child in children ]
+        return out
+
+def is_tracing() -> bool:
+    return current_span.get() is not None
+
+def take_pending_attributes(attributes:Dict[str, Any]) -> Dict[str, Any]:
+    pending = pending_attributes.get()
+    if pending is None:
+        return attributes
+    pending_attributes.set(None)
+    pending = dict(pending)
+    queued_at = pending.pop('queued_at', None)
+    attributes = {**pending, **attributes}
+    if queued_at is not None:
+        attributes['queue_wait'] = round(time.perf_counter() - queued_at, 6)
+    return attributes
+
+def start_span(name:str, **attributes:Any) -> Optional[Span]:
+    # for work that ends in a callback instead of a with block, e.g. a call running on a remote worker
+    parent = current_span.get()
+    if parent is None:
+        return None
+    return Span(name, parent, **take_pending_attributes(attributes))
+
+def finish_span(span:Optional[Span], error:Optional[BaseException]=None) -> None:
+    if span is None:
+        return
+    if error is not None:
+        span.error = f'{type(error).__name__}: {error}'
+    span.end = time.perf_counter()
+
+@contextlib.contextmanager
+def span(name:str, **attributes:Any) -> Iterator[Optional[Span]]:
+    # no-op outside of a trace, the strategies pay nothing when nobody is tracing
+    parent = current_span.get()
+    if parent is None:
+        yield None
+        return
+
+    child = Span(name, parent, **take_pending_attributes(attributes))
+    token = current_span.set(child)
+    error:Optional[BaseException] = None
+    try:
+        yield child
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        finish_span(child, error)
+        current_span.reset(token)
+
+@contextlib.contextmanager
+def tag(**attributes:Any) -> Iterator[None]:
+    # the attributes are picked by the first span opened by the code run or submitted in this block
+    if not is_tracing():
+        yield
+        return
+    token = pending_attributes.set({**(pending_attributes.get() or {}), **attributes})
+    try:
+        yield
+    finally:
+        pending_attributes.reset(token)
+
+def mark_queued() -> None:
+    # called where a call starts waiting for a worker or the semaphore, the next span reports the wait
+    if not is_tracing():
+        return
+    pending_attributes.set({**(pending_attributes.get() or {}), 'queued_at': time.perf_counter()})
+
+def annotate(**attributes:Any) -> None:
+    current = current_span.get()
+    if current is not None:
+        current.attributes.update(attributes)
+
+def record_usage(completion:Any) -> None:
+    # prompt and completion tokens as billed by the provider, clients without usage are skipped
+    current = current_span.get()
+    if current is None:
+        return
+    usage = getattr(completion, 'usage', None)
+    for field in ['prompt_tokens', 'completion_tokens']:
+        value = getattr(usage, field, None)
+        if isinstance(value, int):
+            current.attributes[field] = value
+    # the prompt prefix served from the provider cache, reported by openai and most compatible servers
+    cached_tokens = getattr(getattr(usage, 'prompt_tokens_details', None), 'cached_tokens', None)
+    if isinstance(cached_tokens, int):
+        current.attributes['cached_tokens'] = cached_tokens
+
+class Tracer:
+    # one root span per traced query, exported as a json tree and summarized per tree level
+    def __init__(self):
+        self.roots:List[Span] = []
+        self.mutex = threading.Lock()
+
+    @contextlib.contextmanager
+    def trace(self, name:str='query', **attributes:Any) -> Iterator[Span]:
+        root = Span(name, None, **attributes)
+        with self.mutex:
+            self.roots.append(root)
+        token = current_span.set(root)
+        error:Optional[BaseException] = None
+        try:
+            yield root
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            finish_span(root, error)
+            current_span.reset(token)
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self.mutex:
+            roots = list(self.roots)
+        return {'traces': [ root.to_dict() for root in roots ]}
+
+    def write(self, path2file:str) -> None:
+        with open(path2file, 'w') as fp:
+            json.dump(self.to_dict(), fp, indent=2)
+
+def call_level(call:Span) -> int:
+    parent = call.parent
+    while parent is not None:
+        if 'level' in parent.attributes:
+            return parent.attributes['level']
+        parent = parent.parent
+    return 0
+
+def summarize(root:Span) -> Dict[str, Any]:
+    calls = [ item for item in root.walk() if item.name in CALL_SPANS ]
+    levels:Dict[int, Dict[str, Any]] = {}
+    for call in calls:
+        level = levels.setdefault(call_level(call), {
+            'nb_calls': 0, 'nb_cache_hits': 0, 'nb_errors': 0, 'prompt_tokens': 0, 'cached_tokens': 0, 'completion_tokens': 0, 'max_latency': 0.0, 'max_queue_wait': 0.0
+        })
+        level['nb_calls'] += 1
+        level['nb_cache_hits'] += int(call.attributes.get('cache_hit', False))
+        level['nb_errors'] += int(call.error is not None)
+        level['prompt_tokens'] += call.attributes.get('prompt_tokens', 0)
+        level['cached_tokens'] += call.attributes.get('cached_tokens', 0)
+        level['completion_tokens'] += call.attributes.get('completion_tokens', 0)
+        level['max_latency'] = round(max(level['max_latency'], call.duration or 0.0), 6)
+        level['max_queue_wait'] = round(max(level['max_queue_wait'], call.attributes.get('queue_wait', 0.0)), 6)
+
+    slowest = max(calls, key=lambda call: call.duration or 0.0, default=None)
+    return {
+        'duration': None if root.duration is None else round(root.duration, 6),
+        'nb_calls': len(calls),
+        'nb_cache_hits': sum(level['nb_cache_hits'] for level in levels.values()),
+        'prompt_tokens': sum(level['prompt_tokens'] for level in levels.values()),
+        'cached_tokens': sum(level['cached_tokens'] for level in levels.values()),
+        'completion_tokens': sum(level['completion_tokens'] for level in levels.values()),
+        'levels': { level: levels[level] for level in sorted(levels) },
+        'slowest_call': None if slowest is None else {
+            'name': slowest.name,
+            'level': call_level(slowest),
+            'duration': round(slowest.duration or 0.0, 6),
+            **{ key: value for key, value in slowest.attributes.items() if key in ['leaf', 'queue_wait'] }
+        }
+    }
+
+def format_summary(summary:Dict[str, Any]) -> str:
+    levels = ' | '.join(
+        f"level {level}: {stats['nb_calls']} calls, {stats['nb_cache_hits']} cached, max {stats['max_latency']:.2f}s"
+        for level, stats in summary['levels'].items()
+    )
+    line = f"{summary['nb_calls']} calls ({summary['nb_cache_hits']} cached) in {summary['duration'] or 0.0:.2f}s | prompt tokens: {summary['prompt_tokens']} ({summary['cached_tokens']} cached) | completion tokens: {summary['completion_tokens']}"
+    if len(levels) > 0:
+        line = f'{line} | {levels}'
+    slowest = summary['slowest_call']
+    if slowest is not None:
+        where = f" leaf {slowest['leaf']}" if 'leaf' in slowest else ''
+        line = f"{line} | slowest: {slowest['name']}{where} at level {slowest['level']} {slowest['duration']:.2f}s"
+    return line
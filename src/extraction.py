@@ -0,0 +1,166 @@
+import os
+import hashlib
+import threading
+
+from PyPDF2 import PdfReader
+
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from src.algorithms.cache import Cache
+from src.log import logger
+
+DEFAULT_EXTRACTION_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'llm_map_reduce', 'pages.db')
+
+def file_hash(path2file:str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path2file, mode='rb') as fp:
+        for block in iter(lambda: fp.read(1024 * 1024), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+def page_cache_key(digest:str, page_number:int) -> str:
+    return Cache.make_key('page', digest, page_number)
+
+def count_pages(path2file:str) -> int:
+    return len(PdfReader(stream=path2file).pages)
+
+def extract_batch(path2file:str, page_numbers:List[int]) -> List[Tuple[int, str]]:
+    # runs in a worker process, the reader is parsed once per batch
+    pdf_reader = PdfReader(stream=path2file)
+    return [ (page_number, pdf_reader.pages[page_number].extract_text()) for page_number in page_numbers ]
+
+def parse_page_ranges(page_ranges:str, nb_pages:int) -> List[int]:
+    # 1-based inclusive ranges as printed by pdf viewers : "10-80,120-" or "3,5,7-9"
+    page_numbers:List[int] = []
+    seen = set()
+    for item in page_ranges.split(','):
+        item = item.strip()
+        if len(item) == 0:
+            continue
+        start, separator, end = item.partition('-')
+        try:
+            first = int(start) if start.strip() else 1
+            last = (int(end) if end.strip() else nb_pages) if separator else first
+        except ValueError:
+            raise ValueError(f'invalid page range : {item}')
+        if first < 1 or last < first:
+            raise ValueError(f'invalid page range : {item}')
+        for page_number in range(first - 1, min(last, nb_pages)):
+            if page_number not in seen:
+                seen.add(page_number)
+                page_numbers.append(page_number)
+    return page_numbers
+
+def iter_pages(path2file:str, max_workers:Optional[int]=None, batch_size:int=8, cache:Optional[Cache]=None, nb_pages:Optional[int]=None, page_numbers:Optional[List[int]]=None) -> Iterator[Tuple[int, str]]:
+    if page_numbers is None:
+        if nb_pages is None:
+            nb_pages = count_pages(path2file)
+        page_numbers = list(range(nb_pages))
+
+    digest = file_hash(path2file) if cache is not None else None
+    max_workers = max_workers or os.cpu_count() or 1
+    # only a bounded window of batches is in flight, a consumer that stops early wastes at most this window
+    look_ahead = 2 * max_workers
+
+    batches = iter([ page_numbers[counter:counter+batch_size] for counter in range(0, len(page_numbers), batch_size) ])
+    window:Deque[Tuple[List[int], Dict[int, str], Optional[Future]]] = deque()
+    executor:Optional[ProcessPoolExecutor] = None
+
+    def submit_next() -> bool:
+        nonlocal executor
+        batch = next(batches, None)
+        if batch is None:
+            return False
+        texts:Dict[int, str] = {}
+        if cache is not None:
+            for page_number in batch:
+                text = cache.get(page_cache_key(digest, page_number))
+                if text is not None:
+                    texts[page_number] = text
+        missing_pages = [ page_number for page_number in batch if page_number not in texts ]
+        future = None
+        if len(missing_pages) > 0:
+            if executor is None:
+                executor = ProcessPoolExecutor(max_workers=max_workers)
+            future = executor.submit(extract_batch, path2file, missing_pages)
+        window.append((batch, texts, future))
+        return True
+
+    try:
+        while len(window) < look_ahead and submit_next():
+            pass
+        while len(window) > 0:
+            batch, texts, future = window.popleft()
+            submit_next()
+            if future is not None:
+                for page_number, text in future.result():
+                    texts[page_number] = text
+                    if cache is not None:
+                        cache.put(page_cache_key(digest, page_number), text)
+            for page_number in batch:
+                yield page_number, texts[page_number]
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+class PageStream:
+    # drains iter_pages in a background thread so that consumers can start on the first pages
+    def __init__(self, pages:Iterator[Tuple[int, str]], limit:Optional[int]=None):
+        self.pages:List[str] = []
+        self.limit = limit
+        self.condition = threading.Condition()
+        self.done = False
+        self.error:Optional[BaseException] = None
+        self.thread = threading.Thread(target=self._drain, args=(pages,), daemon=True)
+        self.thread.start()
+
+    def _drain(self, pages:Iterator[Tuple[int, str]]) -> None:
+        try:
+            for _, text in pages:
+                if len(text) == 0:
+                    continue
+                with self.condition:
+                    self.pages.append(text)
+                    self.condition.notify_all()
+                if self.limit is not None and len(self.pages) >= self.limit:
+                    break
+        except BaseException as e:
+            logger.error(e)
+            self.error = e
+        finally:
+            if hasattr(pages, 'close'):
+                pages.close()
+            with self.condition:
+                self.done = True
+                self.condition.notify_all()
+
+    def __iter__(self) -> Iterator[str]:
+        cursor = 0
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: cursor < len(self.pages) or self.done)
+                if cursor >= len(self.pages):
+                    if self.error is not None:
+                        raise self.error
+                    return
+                page = self.pages[cursor]
+            cursor += 1
+            yield page
+
+    def is_empty(self) -> bool:
+        with self.condition:
+            self.condition.wait_for(lambda: len(self.pages) > 0 or self.done)
+            return len(self.pages) == 0
+
+    def is_complete(self) -> bool:
+        with self.condition:
+            return self.done
+
+    def wait(self) -> List[str]:
+        with self.condition:
+            self.condition.wait_for(lambda: self.done)
+            if self.error is not None:
+                raise self.error
+            return list(self.pages)
@@ -0,0 +1,206 @@
+import os
+import json
+import asyncio
+import hashlib
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from src.algorithms.cache import Cache
+from src.algorithms.backends import LLMBackend
+from src.algorithms.scheduler import Scheduler
+from src.algorithms.strategies import llm_map_reduce
+from src.extraction import iter_pages, file_hash
+from src.log import logger
+
+DEFAULT_UPLOAD_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'llm_map_reduce', 'uploads')
+
+class QueryRequest(BaseModel):
+    query:str
+    stream:bool=True
+
+class Flight:
+    # one in-flight llm_map_reduce shared by every request asking the same query on the same document
+    # events are dispatched on the event loop, a late subscriber first receives the tokens it missed
+    def __init__(self, loop:asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.tokens:List[str] = []
+        self.subscribers:List[asyncio.Queue] = []
+        self.result:Optional[Tuple[str, Any]] = None
+
+    def publish(self, event:str, data:Any) -> None:
+        # called from the worker thread running the computation
+        self.loop.call_soon_threadsafe(self._dispatch, event, data)
+
+    def _dispatch(self, event:str, data:Any) -> None:
+        if event == 'token':
+            self.tokens.append(data)
+        else:
+            self.result = (event, data)
+        for subscriber in self.subscribers:
+            subscriber.put_nowait((event, data))
+
+    def subscribe(self) -> asyncio.Queue:
+        subscriber:asyncio.Queue = asyncio.Queue()
+        for token in self.tokens:
+            subscriber.put_nowait(('token', token))
+        if self.result is not None:
+            subscriber.put_nowait(self.result)
+        self.subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber:asyncio.Queue) -> None:
+        # a disconnected client stops receiving the tokens, the flight itself runs on for the others and the cache
+        if subscriber in self.subscribers:
+            self.subscribers.remove(subscriber)
+
+def document_id_of(content:bytes) -> str:
+    return hashlib.sha256(content).hexdigest()[:16]
+
+def sse_event(event:str, data:Dict[str, Any]) -> str:
+    return f'event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
+
+def create_app(llm:LLMBackend, model:str, context_size:int, scheduler:Scheduler, path2files:Optional[List[str]]=None, cache:Optional[Cache]=None, pages_cache:Optional[Cache]=None, path2upload_dir:str=DEFAULT_UPLOAD_DIR, token_budget:Optional[int]=None, fan_in:Optional[int]=None, reduce_token_budget:Optional[int]=None, failure_tolerance:float=0.0, extraction_workers:Optional[int]=None) -> FastAPI:
+    app = FastAPI()
+    # the extracted pages stay in memory for the lifetime of the process, map and reduce outputs go to the shared cache
+    documents:Dict[str, Dict[str, Any]] = {}
+    flights:Dict[Tuple[str, str], Flight] = {}
+    # extractions in progress keyed by document id, the hash of the content, a second upload of the same bytes waits for the first
+    loading:Dict[str, asyncio.Future] = {}
+    counters = {'nb_queries': 0, 'nb_coalesced': 0}
+
+    def load_document(path2file:str, document_id:str, filename:str) -> Dict[str, Any]:
+        pages = [ text for _, text in iter_pages(path2file, max_workers=extraction_workers, cache=pages_cache) if len(text) > 0 ]
+        if len(pages) == 0:
+            raise ValueError(f'{path2file} does not contain any plain text page')
+        documents[document_id] = {'document_id': document_id, 'filename': filename, 'nb_pages': len(pages), 'pages': pages}
+        logger.info(f'document {document_id} loaded with {len(pages)} pages')
+        return documents[document_id]
+
+    def describe(document:Dict[str, Any]) -> Dict[str, Any]:
+        return { key: value for key, value in document.items() if key != 'pages' }
+
+    def run_flight(flight:Flight, query:str, pages:List[str]) -> None:
+        try:
+            answer = llm_map_reduce(
+                query=query,
+                model=model,
+                llm=llm,
+                context_size=context_size,
+                pages=pages,
+                scheduler=scheduler,
+                cache=cache,
+                token_budget=token_budget,
+                fan_in=fan_in,
+                reduce_token_budget=reduce_token_budget,
+                on_token=lambda token: flight.publish('token', token),
+                failure_tolerance=failure_tolerance
+            )
+            flight.publish('answer', answer)
+        except Exception as e:
+            logger.error(e)
+            flight.publish('error', str(e))
+
+    def join_flight(document_id:str, query:str) -> Flight:
+        counters['nb_queries'] += 1
+        key = (document_id, query)
+        flight = flights.get(key)
+        if flight is not None:
+            counters['nb_coalesced'] += 1
+            return flight
+
+        loop = asyncio.get_running_loop()
+        flight = Flight(loop)
+        flights[key] = flight
+        future = loop.run_in_executor(None, run_flight, flight, query, documents[document_id]['pages'])
+        # once answered, the next identical query is served by the cache instead of this flight
+        future.add_done_callback(lambda _: loop.call_soon(flights.pop, key, None))
+        return flight
+
+    for path2file in path2files or []:
+        # preloaded documents are ready before the first request, the same file uploaded later gets the same id
+        load_document(path2file, file_hash(path2file)[:16], os.path.basename(path2file))
+
+    @app.post('/documents')
+    async def upload_document(request:Request, filename:str='document.pdf') -> Dict[str, Any]:
+        # the pdf is sent as the raw request body, multipart forms would need python-multipart
+        content = await request.body()
+        if len(content) == 0:
+            raise HTTPException(status_code=400, detail='empty request body, send the pdf bytes')
+        document_id = document_id_of(content)
+        if document_id in documents:
+            return describe(documents[document_id])
+
+        load = loading.get(document_id)
+        if load is None:
+            os.makedirs(path2upload_dir, exist_ok=True)
+            path2file = os.path.join(path2upload_dir, f'{document_id}.pdf')
+            with open(path2file, mode='wb') as fp:
+                fp.write(content)
+            load = asyncio.get_running_loop().run_in_executor(None, load_document, path2file, document_id, filename)
+            loading[document_id] = load
+            load.add_done_callback(lambda _: loading.pop(document_id, None))
+        try:
+            # shielded, a client that disconnects does not cancel the extraction awaited by the others
+            document = await asyncio.shield(load)
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        return describe(document)
+
+    @app.get('/documents')
+    async def list_documents() -> List[Dict[str, Any]]:
+        return [ describe(document) for document in documents.values() ]
+
+    @app.get('/documents/{document_id}')
+    async def get_document(document_id:str) -> Dict[str, Any]:
+        if document_id not in documents:
+            raise HTTPException(status_code=404, detail=f'unknown document {document_id}')
+        return describe(documents[document_id])
+
+    @app.post('/documents/{document_id}/queries')
+    async def query_document(document_id:str, request:QueryRequest) -> Any:
+        if document_id not in documents:
+            raise HTTPException(status_code=404, detail=f'unknown document {document_id}')
+        flight = join_flight(document_id, request.query)
+        subscriber = flight.subscribe()
+
+        if not request.stream:
+            try:
+                while True:
+                    event, data = await subscriber.get()
+                    if event == 'answer':
+                        return {'document_id': document_id, 'query': request.query, 'answer': data}
+                    if event == 'error':
+                        raise HTTPException(status_code=502, detail=data)
+            finally:
+                flight.unsubscribe(subscriber)
+
+        async def events() -> AsyncIterator[str]:
+            # closed by the server when the client disconnects, the finally clause then runs
+            try:
+                while True:
+                    event, data = await subscriber.get()
+                    if event == 'token':
+                        yield sse_event('token', {'token': data})
+                        continue
+                    yield sse_event(event, {'answer': data} if event == 'answer' else {'detail': data})
+                    return
+            finally:
+                flight.unsubscribe(subscriber)
+
+        return StreamingResponse(events(), media_type='text/event-stream')
+
+    @app.get('/stats')
+    async def stats() -> Dict[str, Any]:
+        return {
+            'nb_documents': len(documents),
+            'nb_in_flight': len(flights),
+            **counters,
+            **scheduler.stats(),
+            **({'cache': cache.stats()} if cache is not None else {})
+        }
+
+    return app
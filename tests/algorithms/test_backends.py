@@ -0,0 +1,142 @@
+"""Tests for src.algorithms.backends module."""
+
+import time
+
+import pytest
+from openai import APIConnectionError
+from openai.types.chat import ChatCompletion
+
+from src.algorithms.prompts import map_system_prompt
+from src.algorithms.rate_limiter import RateLimiter, RateLimitedOpenAI, AsyncRateLimitedOpenAI
+from src.algorithms.resilience import RetryPolicy, ResilientOpenAI
+from src.algorithms.backends import FakeLLM, AsyncFakeLLM, fake_answer, message_kind
+
+
+def messages(page="page", system=map_system_prompt):
+    """Build the messages of a map call."""
+    return [{'role': 'system', 'content': system}, {'role': 'user', 'content': page}]
+
+
+class TestFakeLLM:
+    """Test cases for the in-process fake."""
+
+    def test_answers_are_deterministic(self):
+        """Test that the same prompt gets the same completion from any fake."""
+        first = FakeLLM().chat.completions.create(model="gpt-4o-mini", messages=messages())
+        second = FakeLLM().chat.completions.create(model="gpt-4o-mini", messages=messages())
+        other = FakeLLM().chat.completions.create(model="gpt-4o-mini", messages=messages("other page"))
+
+        assert isinstance(first, ChatCompletion)
+        assert first.choices[0].message.content == second.choices[0].message.content
+        assert first.choices[0].message.content != other.choices[0].message.content
+        assert first.choices[0].message.content.startswith("map answer")
+
+    def test_usage_counts_tokens(self):
+        """Test that the usage reports the prompt and completion tokens."""
+        llm = FakeLLM()
+        completion = llm.chat.completions.create(model="gpt-4o-mini", messages=messages("x" * 400))
+
+        assert completion.usage.prompt_tokens == sum(len(message['content']) for message in messages("x" * 400)) // 4 + 1
+        assert completion.usage.total_tokens == completion.usage.prompt_tokens + completion.usage.completion_tokens
+        assert llm.stats()['prompt_tokens'] == completion.usage.prompt_tokens
+
+    def test_latency_is_simulated(self):
+        """Test that a call lasts the fixed latency plus the per token latency."""
+        llm = FakeLLM(latency=0.02, latency_per_token=0.001)
+
+        start = time.perf_counter()
+        llm.chat.completions.create(model="gpt-4o-mini", messages=messages("x" * 40))
+        assert time.perf_counter() - start >= 0.02 + 0.001 * 10
+
+    def test_failures(self):
+        """Test the predicate and the seeded failure rate."""
+        llm = FakeLLM(fail_when=lambda messages: "bad" in messages[-1]['content'])
+        with pytest.raises(APIConnectionError):
+            llm.chat.completions.create(model="gpt-4o-mini", messages=messages("bad page"))
+        llm.chat.completions.create(model="gpt-4o-mini", messages=messages("good page"))
+        assert llm.stats()['nb_failures'] == 1
+
+        def count_failures(seed):
+            llm = FakeLLM(failure_rate=0.3, seed=seed)
+            for _ in range(100):
+                try:
+                    llm.chat.completions.create(model="gpt-4o-mini", messages=messages())
+                except APIConnectionError:
+                    pass
+            return llm.stats()['nb_failures']
+
+        assert count_failures(seed=1) == count_failures(seed=1)
+        assert 10 < count_failures(seed=1) < 50
+
+    def test_prompt_cache(self):
+        """Test that a long prompt prefix seen before is reported as cached and skips the per token latency."""
+        llm = FakeLLM(latency_per_token=0.0001)
+        page = "x" * 8000
+
+        first = llm.chat.completions.create(model="gpt-4o-mini", messages=messages(page + " first query"))
+        start = time.perf_counter()
+        second = llm.chat.completions.create(model="gpt-4o-mini", messages=messages(page + " second query"))
+        duration = time.perf_counter() - start
+        short = llm.chat.completions.create(model="gpt-4o-mini", messages=messages("short page"))
+
+        assert first.usage.prompt_tokens_details.cached_tokens == 0
+        assert 1024 <= second.usage.prompt_tokens_details.cached_tokens <= second.usage.prompt_tokens
+        assert second.usage.prompt_tokens_details.cached_tokens % 128 == 0
+        assert duration < 0.0001 * second.usage.prompt_tokens
+        assert short.usage.prompt_tokens_details.cached_tokens == 0
+        assert llm.stats()['cached_tokens'] == second.usage.prompt_tokens_details.cached_tokens
+
+    def test_invalid_arguments(self):
+        """Test that impossible settings are rejected."""
+        with pytest.raises(ValueError):
+            FakeLLM(failure_rate=2)
+        with pytest.raises(ValueError):
+            FakeLLM(latency=-1)
+
+    def test_stream(self):
+        """Test that a streamed answer joins back to the full answer."""
+        llm = FakeLLM()
+        chunks = list(llm.chat.completions.create(model="gpt-4o-mini", messages=messages(), stream=True))
+
+        assert "".join(chunk.choices[0].delta.content for chunk in chunks) == fake_answer(messages())
+        assert len(chunks) == 3
+
+    def test_client_wrappers(self):
+        """Test that the fake sits under the rate limiter and the retry policy."""
+        attempts = []
+        llm = FakeLLM(fail_when=lambda messages: attempts.append(1) or len(attempts) == 1)
+        client = ResilientOpenAI(RateLimitedOpenAI(llm, RateLimiter(1000, 1_000_000)), RetryPolicy(base_delay=0.001, max_delay=0.002))
+
+        completion = client.chat.completions.create(model="gpt-4o-mini", messages=messages(), max_tokens=10)
+
+        assert completion.choices[0].message.content == fake_answer(messages())
+        assert llm.stats()['nb_calls'] == 2
+
+    def test_message_kind(self):
+        """Test that calls are labelled by their system prompt."""
+        assert message_kind(messages()) == "map"
+        assert message_kind(messages(system="something else")) == "other"
+
+
+class TestAsyncFakeLLM:
+    """Test cases for the async fake."""
+
+    @pytest.mark.asyncio
+    async def test_create_and_stream(self):
+        """Test that the async fake answers like the sync one."""
+        llm = AsyncFakeLLM(latency=0.001)
+        completion = await llm.chat.completions.create(model="gpt-4o-mini", messages=messages())
+        tokens = [chunk.choices[0].delta.content async for chunk in await llm.chat.completions.create(model="gpt-4o-mini", messages=messages(), stream=True)]
+
+        assert completion.choices[0].message.content == fake_answer(messages())
+        assert "".join(tokens) == fake_answer(messages())
+        assert llm.stats()['nb_calls_per_kind'] == {'map': 2}
+
+    @pytest.mark.asyncio
+    async def test_rate_limited(self):
+        """Test that the async fake exposes the raw response api."""
+        client = AsyncRateLimitedOpenAI(AsyncFakeLLM(), RateLimiter(1000, 1_000_000))
+
+        completion = await client.chat.completions.create(model="gpt-4o-mini", messages=messages(), max_tokens=10)
+
+        assert completion.choices[0].message.content == fake_answer(messages())
@@ -0,0 +1,105 @@
+"""Tests for src.algorithms.batch module."""
+
+import json
+import os
+
+import pytest
+from unittest.mock import Mock
+from starlette.testclient import TestClient
+from openai import OpenAI
+
+from benchmarks.stub_server import create_app
+from src.algorithms.cache import Cache
+from src.algorithms.prompts import map_system_prompt, reduce_system_prompt
+from src.algorithms.batch import (
+    build_batch_line, build_map_batch, write_batch_file, read_batch_results, wait_batch, batch_map_reduce
+)
+
+
+@pytest.fixture
+def stub_llm():
+    """OpenAI client talking to the in-process stand-in of the file and batch endpoints."""
+    client = TestClient(create_app(latency=0))
+    llm = OpenAI(api_key="stub", base_url="http://testserver/v1", http_client=client)
+    yield llm
+    client.close()
+
+
+class TestBatchFile:
+    """Test cases for the batch input file."""
+
+    def test_batch_line_format(self):
+        """Test that a line follows the batch api file format."""
+        line = build_batch_line("doc0/map/0", "gpt-4o-mini", [{'role': 'user', 'content': 'page'}])
+
+        assert line['custom_id'] == "doc0/map/0"
+        assert line['method'] == 'POST'
+        assert line['url'] == '/v1/chat/completions'
+        assert line['body']['model'] == "gpt-4o-mini"
+        assert line['body']['max_tokens'] == 1024
+
+    def test_map_batch_reuses_the_map_prompt(self, tmp_path, sample_query):
+        """Test that every leaf of every document becomes one map request."""
+        documents = {'doc0': ["p0", "p1", "p2", "p3"], 'doc1': ["q0"]}
+        requests, leaf_ids = build_map_batch(sample_query, "gpt-4o-mini", documents, 2)
+        path2batch = write_batch_file(str(tmp_path / "map.jsonl"), "gpt-4o-mini", requests)
+
+        lines = [json.loads(line) for line in open(path2batch)]
+        assert leaf_ids == {'doc0': ["doc0/map/0", "doc0/map/1"], 'doc1': ["doc1/map/0"]}
+        assert [line['custom_id'] for line in lines] == ["doc0/map/0", "doc0/map/1", "doc1/map/0"]
+        assert all(line['body']['messages'][0]['content'] == map_system_prompt for line in lines)
+        assert all(line['body']['response_format'] == {'type': 'json_object'} for line in lines)
+
+
+class TestBatchResults:
+    """Test cases for the batch polling and output parsing."""
+
+    def test_failed_batch_raises(self):
+        """Test that a batch ending in failure is reported."""
+        llm = Mock()
+        llm.batches.retrieve.return_value = Mock(id="batch_0", status="failed")
+
+        with pytest.raises(RuntimeError):
+            wait_batch(llm, Mock(id="batch_0", status="in_progress"), poll_interval=0)
+
+    def test_failed_requests_are_none(self):
+        """Test that a failed line gives no answer."""
+        output = "\n".join([
+            json.dumps({'custom_id': "a", 'response': {'status_code': 200, 'body': {'choices': [{'message': {'content': "ok"}}]}}, 'error': None}),
+            json.dumps({'custom_id': "b", 'response': {'status_code': 500, 'body': {}}, 'error': None})
+        ])
+        llm = Mock()
+        llm.files.content.return_value = Mock(text=output)
+
+        results = read_batch_results(llm, Mock(output_file_id="file-0", error_file_id=None))
+
+        assert results == {'a': "ok", 'b': None}
+
+
+class TestBatchMapReduce:
+    """Test cases for batch_map_reduce against the stand-in."""
+
+    def test_map_then_reduce_levels(self, stub_llm, tmp_path, sample_query):
+        """Test that documents are answered with one batch per level."""
+        documents = {'doc0': [f"page{i}" for i in range(8)], 'doc1': ["single page"]}
+
+        answers = batch_map_reduce(sample_query, "gpt-4o-mini", stub_llm, 2, documents, path2batch_dir=str(tmp_path), poll_interval=0)
+
+        assert set(answers) == {'doc0', 'doc1'}
+        assert all(answer.startswith("stub answer") for answer in answers.values())
+        # 4 leaves for doc0 with a fan-in of 2: one map batch and two reduce levels
+        path2batches = sorted(os.listdir(tmp_path))
+        assert [path2batch.split('-', 2)[-1] for path2batch in path2batches] == ["map.jsonl", "reduce-0.jsonl", "reduce-1.jsonl"]
+        reduce_lines = [json.loads(line) for line in open(tmp_path / path2batches[1])]
+        assert all(line['body']['messages'][0]['content'] == reduce_system_prompt for line in reduce_lines)
+
+    def test_cached_run_submits_nothing(self, stub_llm, tmp_path, sample_query):
+        """Test that a second run is answered from the cache."""
+        documents = {'doc0': [f"page{i}" for i in range(6)]}
+        with Cache(':memory:') as cache:
+            expected = batch_map_reduce(sample_query, "gpt-4o-mini", stub_llm, 2, documents, path2batch_dir=str(tmp_path), poll_interval=0, cache=cache)
+            llm = Mock()
+            answers = batch_map_reduce(sample_query, "gpt-4o-mini", llm, 2, documents, path2batch_dir=str(tmp_path), poll_interval=0, cache=cache)
+
+        assert answers == expected
+        llm.files.create.assert_not_called()
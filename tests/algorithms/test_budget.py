@@ -0,0 +1,210 @@
+"""Tests for src.algorithms.budget module and the budget planner."""
+
+import asyncio
+
+import pytest
+
+from src.algorithms.backends import FakeLLM, AsyncFakeLLM
+from src.algorithms.partitioning import estimate_tokens
+from src.algorithms.budget import Budget, BudgetedOpenAI, AsyncBudgetedOpenAI, BudgetExceededError, CostEstimate, cost_of
+from src.algorithms.strategies import llm_map_reduce, allm_map_reduce, estimate_cost, fit_budget, sample_pages
+
+
+def _pages(nb_pages, size=2000):
+    """Pages of about size characters."""
+    return [(f"content of page {i} " * (size // 18 + 1))[:size] for i in range(nb_pages)]
+
+
+class TestBudget:
+    """Test cases for the accounting of a query."""
+
+    def test_cost_of(self):
+        """Test the price of a call."""
+        assert cost_of("gpt-4o-mini", 1_000_000, 0) == pytest.approx(0.15)
+        assert cost_of("gpt-4o", 0, 1_000_000) == pytest.approx(10.0)
+        assert cost_of("gpt-4o", 1_000_000, 0, cached_tokens=1_000_000) == pytest.approx(1.25)
+        with pytest.raises(ValueError):
+            cost_of("unknown-model", 1, 1)
+
+    def test_calls_are_refused_once_spent(self):
+        """Test that a call is refused when it would exceed the budget."""
+        budget = Budget(max_tokens=100)
+        pending = budget.acquire("gpt-4o-mini", 60, "map")
+        with pytest.raises(BudgetExceededError):
+            budget.acquire("gpt-4o-mini", 60, "map")
+        budget.charge(pending, "gpt-4o-mini", 60, 10)
+
+        assert budget.stats()["tokens"] == 70
+        assert budget.stats()["nb_refused"] == 1
+
+    def test_completion_allowance_is_held(self):
+        """Test that calls in flight hold their max_tokens until their usage is charged."""
+        budget = Budget(max_tokens=2000)
+        pending = budget.acquire("gpt-4o-mini", 100, "map", max_completion_tokens=1024)
+        with pytest.raises(BudgetExceededError):
+            budget.acquire("gpt-4o-mini", 100, "map", max_completion_tokens=1024)
+
+        budget.charge(pending, "gpt-4o-mini", 100, 50)
+        budget.acquire("gpt-4o-mini", 100, "map", max_completion_tokens=1024)
+        assert budget.pending_tokens == 1124
+
+    def test_reserve_is_kept_for_the_reduce(self):
+        """Test that the map calls can not spend the share of the reduce calls."""
+        budget = Budget(max_tokens=100)
+        budget.reserve(CostEstimate(reduce_tokens=50))
+
+        with pytest.raises(BudgetExceededError):
+            budget.acquire("gpt-4o-mini", 60, "map")
+        budget.acquire("gpt-4o-mini", 60, "reduce")
+
+    def test_invalid_budget(self):
+        """Test that empty budgets are rejected."""
+        with pytest.raises(ValueError):
+            Budget(max_tokens=0)
+        with pytest.raises(ValueError):
+            Budget(max_cost=0)
+
+
+class TestBudgetedOpenAI:
+    """Test cases for the budgeted client."""
+
+    def test_usage_is_charged(self, sample_query):
+        """Test that the reported usage of every call is charged."""
+        llm = FakeLLM()
+        budget = Budget(max_cost=1.0)
+
+        llm_map_reduce(sample_query, "gpt-4o-mini", BudgetedOpenAI(llm, budget), 2, _pages(8))
+
+        stats = llm.stats()
+        assert budget.stats()["nb_calls"] == stats["nb_calls"]
+        assert budget.stats()["tokens"] == stats["prompt_tokens"] + stats["completion_tokens"]
+        assert budget.stats()["cost"] == pytest.approx(cost_of("gpt-4o-mini", stats["prompt_tokens"], stats["completion_tokens"]), abs=1e-6)
+
+    def test_map_phase_stops_early(self, sample_query):
+        """Test that the map calls beyond the budget are skipped and the reduce still answers."""
+        llm = FakeLLM()
+        pages = _pages(40)
+        estimate = estimate_cost(sample_query, pages, "gpt-4o-mini", 2)
+        budget = Budget(max_tokens=estimate.reduce_tokens + 10_000)
+        budget.reserve(estimate)
+
+        answer = llm_map_reduce(sample_query, "gpt-4o-mini", BudgetedOpenAI(llm, budget), 2, pages)
+
+        assert answer.startswith("reduce answer")
+        assert budget.stats()["nb_refused"] > 0
+        assert budget.stats()["tokens"] <= budget.max_tokens
+        assert llm.stats()["nb_calls_per_kind"]["map"] < estimate.nb_map_calls
+
+    def test_cached_tokens_are_charged(self, sample_query):
+        """Test that the cached prompt tokens of a repeated page are recorded and billed at the cached price."""
+        llm = FakeLLM()
+        budget = Budget(max_cost=1.0)
+        pages = _pages(4, size=8000)
+
+        for query in [sample_query, "Another question about the pages"]:
+            llm_map_reduce(query, "gpt-4o-mini", BudgetedOpenAI(llm, budget), 1, pages)
+
+        stats = llm.stats()
+        assert budget.stats()["cached_tokens"] == stats["cached_tokens"] > 0
+        assert budget.stats()["cost"] == pytest.approx(cost_of("gpt-4o-mini", stats["prompt_tokens"], stats["completion_tokens"], stats["cached_tokens"]), abs=1e-6)
+
+    def test_stream_is_charged(self, sample_query):
+        """Test that a streamed reduce is charged once consumed."""
+        budget = Budget(max_tokens=100_000)
+        tokens = []
+
+        llm_map_reduce(sample_query, "gpt-4o-mini", BudgetedOpenAI(FakeLLM(), budget), 2, _pages(4), on_token=tokens.append)
+
+        assert budget.stats()["tokens"] > estimate_tokens("".join(tokens))
+        assert budget.pending_tokens == 0
+
+    @pytest.mark.asyncio
+    async def test_async_map_phase_stops_early(self, sample_query):
+        """Test that the asyncio engine skips the map calls beyond the budget."""
+        pages = _pages(40)
+        estimate = estimate_cost(sample_query, pages, "gpt-4o-mini", 2)
+        budget = Budget(max_tokens=estimate.reduce_tokens + 10_000)
+        budget.reserve(estimate)
+
+        answer = await allm_map_reduce(sample_query, "gpt-4o-mini", AsyncBudgetedOpenAI(AsyncFakeLLM(), budget), 2, pages, asyncio.Semaphore(4))
+
+        assert answer.startswith("reduce answer")
+        assert budget.stats()["nb_refused"] > 0
+
+
+class TestBudgetPlanner:
+    """Test cases for the cost estimate and the degraded plans."""
+
+    def test_estimate_matches_the_calls(self, sample_query):
+        """Test that the estimate predicts the calls of a run."""
+        llm = FakeLLM()
+        pages = _pages(30)
+
+        estimate = estimate_cost(sample_query, pages, "gpt-4o-mini", 2, token_counter=estimate_tokens)
+        llm_map_reduce(sample_query, "gpt-4o-mini", llm, 2, pages, token_counter=estimate_tokens)
+
+        calls = llm.stats()["nb_calls_per_kind"]
+        assert (estimate.nb_map_calls, estimate.nb_reduce_calls) == (calls["map"], calls["reduce"])
+        assert estimate.prompt_tokens >= llm.stats()["prompt_tokens"]
+        assert estimate.cost == pytest.approx(cost_of("gpt-4o-mini", estimate.prompt_tokens, estimate.completion_tokens))
+
+    def test_plan_fits_without_degradation(self, sample_query):
+        """Test that a generous budget keeps the configured plan."""
+        pages = _pages(10)
+
+        plan = fit_budget(sample_query, pages, "gpt-4o-mini", 2, max_cost=10.0)
+
+        assert plan.degradations == []
+        assert plan.pages == pages
+        assert plan.context_size == 2
+
+    def test_coarser_partitions(self, sample_query):
+        """Test that the partitions grow first."""
+        pages = _pages(64, size=200)
+        estimate = estimate_cost(sample_query, pages, "gpt-4o-mini", 1)
+
+        plan = fit_budget(sample_query, pages, "gpt-4o-mini", 1, max_tokens=estimate.tokens // 2)
+
+        assert plan.context_size > 1
+        assert plan.pages == pages
+        assert plan.estimate.tokens <= estimate.tokens // 2
+
+    def test_every_context_size_is_a_candidate(self):
+        """Test that a larger context size is found past one that gives more leaves."""
+        pages = _pages(20, size=100)
+
+        plan = fit_budget("summarize", pages, "gpt-4o-mini", 4, max_tokens=3000)
+
+        assert plan.degradations == ["context_size 4 -> 20"]
+        assert plan.pages == pages
+        assert plan.estimate.nb_map_calls == 1
+        assert plan.estimate.tokens <= 3000
+
+    def test_cheaper_map_model(self, sample_query):
+        """Test that a dollar budget moves the map calls to the cheaper model."""
+        pages = _pages(16, size=20_000)
+        estimate = estimate_cost(sample_query, pages, "gpt-4o", 16)
+
+        plan = fit_budget(sample_query, pages, "gpt-4o", 16, max_cost=estimate.cost / 4)
+
+        assert plan.map_model == "gpt-4o-mini"
+        assert plan.pages == pages
+        assert plan.estimate.cost <= estimate.cost / 4
+
+    def test_sampled_pages(self, sample_query):
+        """Test that pages are sampled when nothing else fits."""
+        pages = _pages(100)
+
+        plan = fit_budget(sample_query, pages, "gpt-4o-mini", 100, max_tokens=20_000)
+
+        assert 0 < len(plan.pages) < len(pages)
+        assert plan.pages == sample_pages(pages, len(plan.pages))
+        assert plan.estimate.tokens <= 20_000
+        assert plan.degradations[-1] == f"{len(plan.pages)}/100 pages sampled"
+
+    def test_budget_too_small(self, sample_query):
+        """Test that a budget below a single call is rejected."""
+        with pytest.raises(BudgetExceededError):
+            fit_budget(sample_query, _pages(4), "gpt-4o-mini", 2, max_tokens=10)
+        with pytest.raises(ValueError):
+            fit_budget(sample_query, _pages(4), "unknown-model", 2, max_cost=1.0)
@@ -0,0 +1,82 @@
+"""Tests for src.algorithms.cache module."""
+
+import threading
+
+import pytest
+
+from src.algorithms.cache import Cache
+
+
+@pytest.fixture
+def cache():
+    """Create an in-memory cache."""
+    with Cache(path2cache=':memory:') as cache:
+        yield cache
+
+
+class TestCache:
+    """Test cases for the Cache class."""
+
+    def test_get_missing_key(self, cache):
+        """Test that an unknown key is a miss."""
+        assert cache.get("unknown") is None
+        assert cache.stats()['misses'] == 1
+        assert cache.stats()['hits'] == 0
+
+    def test_put_then_get(self, cache):
+        """Test that a stored value is returned and counted as a hit."""
+        cache.put("key", "value")
+        assert cache.get("key") == "value"
+        stats = cache.stats()
+        assert stats['hits'] == 1
+        assert stats['nb_entries'] == 1
+        assert stats['size'] == len("value")
+
+    def test_make_key_is_deterministic(self):
+        """Test that make_key only depends on its parts."""
+        assert Cache.make_key("map", "model", 1024, "query", "page") == Cache.make_key("map", "model", 1024, "query", "page")
+        assert Cache.make_key("map", "model", 1024, "query", "page") != Cache.make_key("map", "model", 512, "query", "page")
+        assert Cache.make_key("a", "bc") != Cache.make_key("ab", "c")
+
+    def test_lru_eviction(self):
+        """Test that the least recently used entries are evicted first."""
+        with Cache(path2cache=':memory:', max_size=10) as cache:
+            cache.put("a", "aaaa")
+            cache.put("b", "bbbb")
+            cache.get("a")  # a becomes the most recently used entry
+            cache.put("c", "cccc")
+
+            assert cache.get("b") is None
+            assert cache.get("a") == "aaaa"
+            assert cache.get("c") == "cccc"
+            assert cache.stats()['size'] <= 10
+
+    def test_persistence(self, tmp_path):
+        """Test that entries survive a restart."""
+        path2cache = str(tmp_path / "nested" / "cache.db")
+        with Cache(path2cache=path2cache) as cache:
+            cache.put("key", "value")
+
+        with Cache(path2cache=path2cache) as cache:
+            assert cache.get("key") == "value"
+
+    def test_clear(self, cache):
+        """Test that clear removes entries and counters."""
+        cache.put("key", "value")
+        cache.get("key")
+        cache.clear()
+        assert cache.stats() == {'hits': 0, 'misses': 0, 'nb_entries': 0, 'size': 0}
+
+    def test_thread_safety(self, cache):
+        """Test concurrent writes from several threads."""
+        def write(offset):
+            for index in range(50):
+                cache.put(f"{offset}-{index}", "value")
+
+        threads = [threading.Thread(target=write, args=(offset,)) for offset in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert cache.stats()['nb_entries'] == 200
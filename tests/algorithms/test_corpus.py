@@ -0,0 +1,92 @@
+"""Tests for src.algorithms.corpus module."""
+
+from unittest.mock import patch
+
+from src.algorithms.scheduler import Scheduler
+from src.algorithms.corpus import llm_corpus_map_reduce
+
+
+def _corpus(nb_pages_per_document):
+    """Build one job per document, the pages are named after their document."""
+    return {
+        f"doc{index}/q0": (f"query {index}", [f"d{index}p{page}" for page in range(nb_pages)])
+        for index, nb_pages in enumerate(nb_pages_per_document)
+    }
+
+
+class TestCorpusMapReduce:
+    """Test cases for llm_corpus_map_reduce."""
+
+    @patch('src.algorithms.corpus.llm_map')
+    @patch('src.algorithms.corpus.llm_reduce')
+    def test_map_calls_are_interleaved(self, mock_llm_reduce, mock_llm_map, mock_openai_client):
+        """Test that the pool alternates between documents instead of draining them one by one."""
+        mock_llm_map.side_effect = lambda **kwargs: kwargs['page']
+        mock_llm_reduce.side_effect = lambda **kwargs: "+".join(kwargs['accumulator'])
+
+        with Scheduler(max_workers=1) as scheduler:
+            llm_corpus_map_reduce(_corpus([3, 3]), "gpt-4o-mini", mock_openai_client, 1, scheduler=scheduler)
+
+        pages = [call[1]['page'] for call in mock_llm_map.call_args_list]
+        assert pages == ["d0p0", "d1p0", "d0p1", "d1p1", "d0p2", "d1p2"]
+
+    @patch('src.algorithms.corpus.llm_map')
+    @patch('src.algorithms.corpus.llm_reduce')
+    def test_every_job_gets_its_own_tree(self, mock_llm_reduce, mock_llm_map, mock_openai_client):
+        """Test that reduce levels never mix documents, even on a single worker."""
+        mock_llm_map.side_effect = lambda **kwargs: kwargs['page']
+        mock_llm_reduce.side_effect = lambda **kwargs: "+".join(kwargs['accumulator'])
+
+        with Scheduler(max_workers=1) as scheduler:
+            answers = llm_corpus_map_reduce(_corpus([5, 2, 1]), "gpt-4o-mini", mock_openai_client, 1, scheduler=scheduler, fan_in=2)
+
+        assert answers["doc0/q0"] == "d0p0+d0p1+d0p2+d0p3+d0p4"
+        assert answers["doc1/q0"] == "d1p0+d1p1"
+        assert answers["doc2/q0"] == "d2p0"
+        for call in mock_llm_reduce.call_args_list:
+            assert len(call[1]['accumulator']) <= 2
+            assert len({segment[:2] for segment in call[1]['accumulator']}) == 1
+
+    @patch('src.algorithms.corpus.llm_map')
+    @patch('src.algorithms.corpus.llm_reduce')
+    def test_queries_follow_their_job(self, mock_llm_reduce, mock_llm_map, mock_openai_client):
+        """Test that each call is made with the query of its job."""
+        mock_llm_map.side_effect = lambda **kwargs: f"{kwargs['query']}:{kwargs['page']}"
+        mock_llm_reduce.side_effect = lambda **kwargs: "+".join(kwargs['accumulator'])
+        jobs = {"doc0/q0": ("first", ["p0", "p1"]), "doc0/q1": ("second", ["p0", "p1"])}
+
+        answers = llm_corpus_map_reduce(jobs, "gpt-4o-mini", mock_openai_client, 1)
+
+        assert answers == {"doc0/q0": "first:p0+first:p1", "doc0/q1": "second:p0+second:p1"}
+
+    @patch('src.algorithms.corpus.llm_map')
+    @patch('src.algorithms.corpus.llm_reduce')
+    def test_failed_document_does_not_stop_the_corpus(self, mock_llm_reduce, mock_llm_map, mock_openai_client):
+        """Test that a failing job is reported while the others are answered."""
+        def llm_map(**kwargs):
+            if kwargs['page'].startswith("d1"):
+                raise RuntimeError("map failed")
+            return kwargs['page']
+
+        mock_llm_map.side_effect = llm_map
+        mock_llm_reduce.side_effect = lambda **kwargs: "+".join(kwargs['accumulator'])
+        results = {}
+
+        answers = llm_corpus_map_reduce(
+            _corpus([2, 2]), "gpt-4o-mini", mock_openai_client, 1,
+            on_result=lambda job_id, answer, error: results.update({job_id: (answer, error)})
+        )
+
+        assert answers == {"doc0/q0": "d0p0+d0p1", "doc1/q0": None}
+        assert results["doc0/q0"] == ("d0p0+d0p1", None)
+        assert isinstance(results["doc1/q0"][1], RuntimeError)
+
+    @patch('src.algorithms.corpus.llm_map')
+    @patch('src.algorithms.corpus.llm_reduce')
+    def test_empty_document(self, mock_llm_reduce, mock_llm_map, mock_openai_client):
+        """Test that a document without pages is answered with None."""
+        answers = llm_corpus_map_reduce({"doc0/q0": ("query", [])}, "gpt-4o-mini", mock_openai_client, 4)
+
+        assert answers == {"doc0/q0": None}
+        mock_llm_map.assert_not_called()
+        mock_llm_reduce.assert_not_called()
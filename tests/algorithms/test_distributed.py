@@ -0,0 +1,242 @@
+"""Tests for src.algorithms.distributed module."""
+
+import json
+import socket
+import threading
+import multiprocessing
+
+import zmq
+import pytest
+from unittest.mock import Mock
+from openai import OpenAI
+
+from benchmarks.stub_server import StubServer
+from src.algorithms.cache import Cache
+from src.algorithms.distributed import DistributedScheduler, Worker, RemoteTaskError, READY, TASK, RESULT
+from src.algorithms.strategies import llm_map, llm_reduce, llm_map_reduce
+
+
+HEARTBEAT_INTERVAL = 0.05
+
+
+def _completion(content):
+    """Build a completion holding content."""
+    completion = Mock()
+    completion.choices = [Mock()]
+    completion.choices[0].message.content = content
+    return completion
+
+
+def _echo_llm():
+    """Client answering with the last word of the prompt, reduce answers join them."""
+    def create(**kwargs):
+        prompt = kwargs['messages'][1]['content']
+        if 'segments' in prompt:
+            return _completion("+".join(line.strip() for line in prompt.split("\n") if line.strip().startswith("p")))
+        return _completion(prompt.split("Page content:")[1].split()[0])
+
+    llm = Mock()
+    llm.chat.completions.create.side_effect = create
+    return llm
+
+
+def _free_address():
+    """Local tcp address on a free port."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return f"tcp://127.0.0.1:{sock.getsockname()[1]}"
+
+
+def _run_stub_worker(address, base_url):
+    """Worker process with its own client on the stub server."""
+    llm = OpenAI(api_key="stub", base_url=base_url, max_retries=0)
+    Worker(llm, address=address, capacity=4, heartbeat_interval=HEARTBEAT_INTERVAL).run()
+
+
+class ThreadWorkers:
+    """Start workers in threads of the test process."""
+
+    def __init__(self, address):
+        self.address = address
+        self.stops = []
+        self.threads = []
+
+    def start(self, llm, capacity=2):
+        stop = threading.Event()
+        thread = threading.Thread(target=Worker(llm, self.address, capacity, heartbeat_interval=HEARTBEAT_INTERVAL).run, args=(stop,))
+        thread.start()
+        self.stops.append(stop)
+        self.threads.append(thread)
+        return stop
+
+    def stop(self):
+        for stop in self.stops:
+            stop.set()
+        for thread in self.threads:
+            thread.join()
+
+
+@pytest.fixture
+def scheduler():
+    """Coordinator listening on a free local port."""
+    with DistributedScheduler("tcp://127.0.0.1:*", max_workers=2, heartbeat_interval=HEARTBEAT_INTERVAL) as scheduler:
+        yield scheduler
+
+
+@pytest.fixture
+def workers(scheduler):
+    """Workers of the coordinator, stopped at the end of the test."""
+    workers = ThreadWorkers(scheduler.address)
+    yield workers
+    workers.stop()
+
+
+class TestDistributedScheduler:
+    """Test cases for the coordinator and its workers."""
+
+    def test_map_reduce_on_remote_workers(self, scheduler, workers, sample_query):
+        """Test that the strategies run unchanged with the llm calls on the workers."""
+        first, second = _echo_llm(), _echo_llm()
+        workers.start(first)
+        workers.start(second)
+        coordinator_llm = Mock()
+
+        answer = llm_map_reduce(sample_query, "gpt-4o-mini", coordinator_llm, 1, [f"p{i}" for i in range(8)], scheduler=scheduler, fan_in=8)
+
+        assert answer == "+".join(f"p{i}" for i in range(8))
+        coordinator_llm.chat.completions.create.assert_not_called()
+        assert first.chat.completions.create.call_count + second.chat.completions.create.call_count == 9
+        assert scheduler.stats()['nb_workers'] == 2
+
+    def test_cache_stays_on_the_coordinator(self, scheduler, workers, sample_query):
+        """Test that cached calls are never sent to a worker."""
+        llm = _echo_llm()
+        workers.start(llm)
+        with Cache(':memory:') as cache:
+            expected = llm_map_reduce(sample_query, "gpt-4o-mini", Mock(), 1, ["p0", "p1", "p2"], scheduler=scheduler, cache=cache)
+            nb_calls = llm.chat.completions.create.call_count
+            answer = llm_map_reduce(sample_query, "gpt-4o-mini", Mock(), 1, ["p0", "p1", "p2"], scheduler=scheduler, cache=cache)
+
+            nb_hits = cache.stats()['hits']
+
+        assert answer == expected
+        assert llm.chat.completions.create.call_count == nb_calls
+        # counted like the local pool, every task minus the cache hits reached the api
+        assert scheduler.stats()['nb_tasks'] - nb_hits == nb_calls
+
+    def test_irrelevant_partitions_are_cached(self, scheduler, workers, sample_query):
+        """Test that a partition found irrelevant by a worker is not sent again."""
+        llm = Mock()
+        llm.chat.completions.create.return_value = _completion('{"relevant": false, "content": ""}')
+        workers.start(llm)
+        with Cache(':memory:') as cache:
+            for _ in range(2):
+                assert scheduler.submit(llm_map, page="p0", model="gpt-4o-mini", llm=None, query=sample_query, cache=cache).result(timeout=5) is None
+
+        assert llm.chat.completions.create.call_count == 1
+
+    def test_tokens_are_forwarded(self, scheduler, workers, sample_query):
+        """Test that the tokens streamed by a worker reach the coordinator callback."""
+        def chunk(content):
+            item = Mock()
+            item.choices = [Mock()]
+            item.choices[0].delta.content = content
+            return item
+
+        llm = Mock()
+        llm.chat.completions.create.return_value = iter([chunk("Final "), chunk("answer")])
+        workers.start(llm)
+        tokens = []
+
+        answer = scheduler.submit(llm_reduce, accumulator=["a", "b"], model="gpt-4o-mini", llm=None, query=sample_query, on_token=tokens.append).result(timeout=5)
+
+        assert answer == "Final answer"
+        assert tokens == ["Final ", "answer"]
+
+    def test_remote_errors_are_raised(self, scheduler, workers, sample_query):
+        """Test that a failed call is reported with its remote type."""
+        llm = Mock()
+        llm.chat.completions.create.side_effect = ValueError("bad page")
+        workers.start(llm)
+
+        with pytest.raises(RemoteTaskError, match="ValueError: bad page"):
+            scheduler.submit(llm_map, page="p0", model="gpt-4o-mini", llm=None, query=sample_query).result(timeout=5)
+
+    def test_dead_worker_tasks_are_dispatched_again(self, scheduler, workers, sample_query):
+        """Test that the tasks of a silent worker go to another worker."""
+        hung = Mock()
+        release = threading.Event()
+        hung.chat.completions.create.side_effect = lambda **kwargs: release.wait(timeout=5) and _completion("late")
+        stop = workers.start(hung, capacity=1)
+
+        future = scheduler.submit(llm_map, page="p0 text", model="gpt-4o-mini", llm=None, query=sample_query)
+        while hung.chat.completions.create.call_count == 0:
+            threading.Event().wait(0.01)
+        stop.set()
+        workers.start(_echo_llm())
+
+        try:
+            assert future.result(timeout=5) == "p0"
+            assert scheduler.stats()['nb_redispatched'] == 1
+        finally:
+            release.set()
+
+    def test_late_answer_of_a_dead_worker(self, scheduler, workers, sample_query):
+        """Test that a task answered by a worker declared dead is released once and never sent again."""
+        context = zmq.Context()
+        dealer = context.socket(zmq.DEALER)
+        dealer.setsockopt(zmq.LINGER, 0)
+        dealer.connect(scheduler.address)
+        try:
+            dealer.send_multipart([READY, b'', json.dumps({'capacity': 1}).encode('utf-8')])
+            future = scheduler.submit(llm_map, page="p0 text", model="gpt-4o-mini", llm=None, query=sample_query)
+            command = None
+            while command != TASK:
+                command, task_id, _ = dealer.recv_multipart()
+            # silent until the coordinator puts the task back in the queue
+            while scheduler.stats()['nb_redispatched'] == 0:
+                threading.Event().wait(0.01)
+            dealer.send_multipart([RESULT, task_id, json.dumps({'value': 'late'}).encode('utf-8')])
+
+            assert future.result(timeout=5) == "late"
+            assert scheduler.in_flight == 0
+        finally:
+            dealer.close()
+            context.term()
+        llm = _echo_llm()
+        workers.start(llm)
+        scheduler.submit(llm_map, page="p1 text", model="gpt-4o-mini", llm=None, query=sample_query).result(timeout=5)
+
+        assert llm.chat.completions.create.call_count == 1
+        assert scheduler.in_flight == 0
+
+    def test_local_functions_run_on_the_local_pool(self, scheduler):
+        """Test that anything but an llm call never waits for a worker."""
+        assert scheduler.submit(lambda value: value * 2, 21).result(timeout=5) == 42
+
+
+class TestWorkerProcesses:
+    """Test cases with worker processes and the stub server."""
+
+    def test_map_reduce_on_worker_processes(self, sample_query):
+        """Test a run with two worker processes, each with its own client."""
+        address = _free_address()
+        with StubServer(latency=0.01) as server:
+            processes = [
+                multiprocessing.Process(target=_run_stub_worker, args=(address, server.base_url), daemon=True)
+                for _ in range(2)
+            ]
+            for process in processes:
+                process.start()
+            try:
+                with DistributedScheduler(address, heartbeat_interval=HEARTBEAT_INTERVAL) as scheduler:
+                    answer = llm_map_reduce(sample_query, "gpt-4o-mini", Mock(), 2, [f"page {i}" for i in range(16)], scheduler=scheduler)
+                    stats = scheduler.stats()
+            finally:
+                for process in processes:
+                    process.terminate()
+                    process.join()
+
+        assert answer.startswith("stub answer")
+        assert stats['nb_workers'] == 2
+        assert stats['nb_tasks'] >= 9
@@ -0,0 +1,109 @@
+"""Tests for src.algorithms.partitioning module."""
+
+import pytest
+
+from src.algorithms.partitioning import (
+    estimate_tokens, default_token_budget, get_token_counter, split_text, pack_pages, pack_segments
+)
+
+
+def count_words(text):
+    """Deterministic token counter: one token per word."""
+    return len(text.split())
+
+
+class TestTokenCounting:
+    """Test cases for the token estimators."""
+
+    def test_estimate_tokens(self):
+        """Test the characters based estimator."""
+        assert estimate_tokens("") == 0
+        assert estimate_tokens("abcd") == 1
+        assert estimate_tokens("abcde") == 2
+
+    def test_get_token_counter_is_callable(self):
+        """Test that a counter is always available, with or without tiktoken."""
+        counter = get_token_counter("gpt-4o-mini")
+        assert counter("hello world") > 0
+
+    def test_default_token_budget(self):
+        """Test that the default budget fits in the model context window."""
+        assert 0 < default_token_budget("gpt-4o-mini") <= 128_000
+        assert 0 < default_token_budget("unknown-model") < 8_192
+
+
+class TestSplitText:
+    """Test cases for split_text."""
+
+    def test_small_text_is_untouched(self):
+        """Test that a text under budget is returned as is."""
+        assert split_text("a b c", 10, count_words) == ["a b c"]
+
+    def test_large_text_is_split_without_loss(self):
+        """Test that an oversized page is split into pieces under budget, nothing truncated."""
+        text = " ".join(f"word{i}" for i in range(100))
+        pieces = split_text(text, 10, count_words)
+
+        assert all(count_words(piece) <= 10 for piece in pieces)
+        assert "".join(pieces) == text
+
+
+class TestPackPages:
+    """Test cases for pack_pages."""
+
+    def test_invalid_budget(self):
+        """Test that a non positive budget is rejected."""
+        with pytest.raises(ValueError):
+            pack_pages(["page"], 0)
+
+    def test_sparse_pages_are_packed_together(self):
+        """Test that small pages share a chunk."""
+        pages = ["one two", "three four", "five six", "seven eight"]
+        chunks = pack_pages(pages, 6, count_words)
+
+        assert chunks == ["one two\nthree four", "five six\nseven eight"]
+
+    def test_dense_page_is_split(self):
+        """Test that a page bigger than the budget spans several chunks."""
+        dense = " ".join(f"w{i}" for i in range(25))
+        chunks = pack_pages(["a b", dense, "c d"], 10, count_words)
+
+        assert all(count_words(chunk) <= 10 for chunk in chunks)
+        assert " ".join(" ".join(chunks).split()) == " ".join(["a b", dense, "c d"])
+
+    def test_fewer_chunks_than_pages(self):
+        """Test that token packing needs fewer map calls on sparse input."""
+        pages = [f"short page {i}" for i in range(40)]
+        chunks = pack_pages(pages, 100, count_words)
+
+        assert len(chunks) < len(pages)
+        assert all(count_words(chunk) <= 100 for chunk in chunks)
+
+
+class TestPackSegments:
+    """Test cases for pack_segments."""
+
+    def test_groups_are_bounded_by_fan_in(self):
+        """Test that no group holds more than fan_in segments."""
+        groups = pack_segments([f"s{i}" for i in range(7)], 3, 1000, count_words)
+
+        assert groups == [["s0", "s1", "s2"], ["s3", "s4", "s5"], ["s6"]]
+
+    def test_groups_are_bounded_by_token_budget(self):
+        """Test that a group is closed before it exceeds the token budget."""
+        segments = ["a b c", "d e f", "g h", "i j k l"]
+        groups = pack_segments(segments, 10, 6, count_words)
+
+        assert groups == [["a b c", "d e f"], ["g h", "i j k l"]]
+        assert sum(group == [segment] for group in groups for segment in segments) == 0
+
+    def test_oversized_segments_are_paired(self):
+        """Test that segments larger than the budget are still merged two by two."""
+        segments = ["a b c", "d e f", "g h i"]
+        groups = pack_segments(segments, 4, 2, count_words)
+
+        assert groups == [["a b c", "d e f"], ["g h i"]]
+
+    def test_single_segment(self):
+        """Test that a single segment is a single group."""
+        assert pack_segments(["a"], 4, 10, count_words) == [["a"]]
@@ -2,7 +2,7 @@
 
 import pytest
 
-from src.algorithms.prompts import map_system_prompt, reduce_system_prompt
+from src.algorithms.prompts import map_system_prompt, reduce_system_prompt, digest_system_prompt
 
 
 class TestPrompts:
@@ -73,4 +73,12 @@ class TestPrompts:
         
         # Should contain actual content (not just newlines and spaces)
         assert len(map_system_prompt.strip()) > 10
-        assert len(reduce_system_prompt.strip()) > 10
\ No newline at end of file
+        assert len(reduce_system_prompt.strip()) > 10
+
+    def test_digest_system_prompt_is_query_independent(self):
+        """Test that the digest prompt does not expect a query."""
+        prompt = digest_system_prompt.lower()
+        assert 'page' in prompt
+        assert 'digest' in prompt
+        assert "user's query" not in prompt
+        assert 50 <= len(digest_system_prompt.strip()) <= 2000
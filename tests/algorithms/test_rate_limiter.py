@@ -0,0 +1,206 @@
+"""Tests for src.algorithms.rate_limiter module."""
+
+import time
+
+import httpx
+import pytest
+from unittest.mock import Mock, AsyncMock
+
+from openai import RateLimitError
+
+from src.algorithms.rate_limiter import (
+    RateLimiter, ModelRateLimiters, RateLimitedOpenAI, AsyncRateLimitedOpenAI, TokenBucket, parse_duration, retry_after, request_tokens
+)
+
+
+def rate_limit_error(headers=None):
+    """Build the error raised by the client on a 429."""
+    request = httpx.Request('POST', 'http://localhost/v1/chat/completions')
+    response = httpx.Response(429, headers=headers or {'retry-after-ms': '1'}, request=request)
+    return RateLimitError('rate limit reached', response=response, body=None)
+
+
+def raw_response(content="answer", headers=None, total_tokens=None):
+    """Build a raw response as returned by with_raw_response.create."""
+    completion = Mock()
+    completion.choices = [Mock()]
+    completion.choices[0].message.content = content
+    completion.usage.total_tokens = total_tokens
+    raw = Mock()
+    raw.headers = headers or {}
+    raw.parse.return_value = completion
+    return raw
+
+
+class TestHeaders:
+    """Test cases for the header helpers."""
+
+    @pytest.mark.parametrize("duration,seconds", [
+        ("1s", 1.0), ("20ms", 0.02), ("6m0s", 360.0), ("1h2m3.5s", 3723.5), ("", 0.0)
+    ])
+    def test_parse_duration(self, duration, seconds):
+        """Test the reset durations reported by the provider."""
+        assert parse_duration(duration) == pytest.approx(seconds)
+
+    def test_retry_after(self):
+        """Test that retry-after-ms wins over retry-after."""
+        assert retry_after({'retry-after-ms': '250', 'retry-after': '3'}) == 0.25
+        assert retry_after({'retry-after': '3'}) == 3.0
+        assert retry_after({}) > 0
+
+    def test_request_tokens(self):
+        """Test that the completion budget is reserved with the prompt."""
+        kwargs = {'messages': [{'role': 'user', 'content': 'x' * 40}], 'max_tokens': 100}
+        assert request_tokens(kwargs) == 110
+
+
+class TestTokenBucket:
+    """Test cases for TokenBucket."""
+
+    def test_wait_time(self):
+        """Test that an empty bucket waits for the refill."""
+        bucket = TokenBucket(per_minute=60)
+        assert bucket.wait_time(60) == 0
+        bucket.consume(60)
+        assert bucket.wait_time(1) == pytest.approx(1.0, abs=0.05)
+
+    def test_request_bigger_than_bucket(self):
+        """Test that an oversized request only waits for a full bucket."""
+        bucket = TokenBucket(per_minute=10)
+        assert bucket.wait_time(1000) == 0
+
+
+class TestRateLimiter:
+    """Test cases for RateLimiter."""
+
+    def test_invalid_limits(self):
+        """Test that non positive budgets are rejected."""
+        with pytest.raises(ValueError):
+            RateLimiter(requests_per_minute=0, tokens_per_minute=10)
+        with pytest.raises(ValueError):
+            RateLimiter(requests_per_minute=10, tokens_per_minute=10, max_concurrency=0)
+
+    def test_for_model_defaults(self):
+        """Test that default budgets follow the headers and explicit ones do not."""
+        assert RateLimiter.for_model('gpt-4o-mini').follow_headers
+        assert not RateLimiter.for_model('gpt-4o-mini', requests_per_minute=10).follow_headers
+
+    def test_multiplicative_decrease_once_per_window(self):
+        """Test that a burst of 429s halves the window only once."""
+        limiter = RateLimiter(1000, 1_000_000, max_concurrency=8)
+        epochs = [limiter.acquire(1) for _ in range(4)]
+        for epoch in epochs:
+            limiter.release(epoch, headers={'retry-after-ms': '1'}, rate_limited=True)
+
+        assert limiter.stats()['concurrency'] == 4
+        assert limiter.stats()['nb_rate_limited'] == 4
+
+    def test_additive_increase(self):
+        """Test that successes grow the window back one slot at a time."""
+        limiter = RateLimiter(1000, 1_000_000, max_concurrency=8)
+        limiter.release(limiter.acquire(1), headers={'retry-after-ms': '1'}, rate_limited=True)
+        time.sleep(0.01)
+        # each success adds 1/concurrency, a window of successes adds about one slot
+        for _ in range(5):
+            limiter.release(limiter.acquire(1))
+
+        assert limiter.stats()['concurrency'] == 5
+
+    def test_exhausted_headers_pause_requests(self):
+        """Test that a zero remaining budget pauses until the reset."""
+        limiter = RateLimiter(1000, 1_000_000, max_concurrency=8)
+        limiter.release(limiter.acquire(1), headers={'x-ratelimit-remaining-requests': '0', 'x-ratelimit-reset-requests': '50ms'})
+
+        start = time.monotonic()
+        limiter.acquire(1)
+        assert time.monotonic() - start >= 0.04
+        assert limiter.stats()['concurrency'] == 4
+
+    def test_limit_headers_update_the_buckets(self):
+        """Test that the buckets adopt the limits reported by the provider."""
+        limiter = RateLimiter(1000, 1_000_000)
+        limiter.release(limiter.acquire(1), headers={'x-ratelimit-limit-requests': '60', 'x-ratelimit-limit-tokens': '5000'})
+
+        assert limiter.requests.capacity == 60
+        assert limiter.tokens.capacity == 5000
+
+    def test_requests_per_minute_is_enforced(self):
+        """Test that requests beyond the budget wait for the bucket."""
+        limiter = RateLimiter(requests_per_minute=600, tokens_per_minute=1_000_000)
+        limiter.requests.consume(600)
+
+        start = time.monotonic()
+        limiter.acquire(1)
+        assert time.monotonic() - start >= 0.08
+
+    def test_call_retries_after_429(self):
+        """Test that a rate limited request is retried after the pause."""
+        limiter = RateLimiter(1000, 1_000_000)
+        fn = Mock(side_effect=[rate_limit_error(), raw_response("answer")])
+
+        completion = limiter.call(fn, 10)
+
+        assert completion.choices[0].message.content == "answer"
+        assert fn.call_count == 2
+        assert limiter.in_flight == 0
+
+    def test_call_gives_up_after_max_retries(self):
+        """Test that the 429 is raised once the retries are exhausted."""
+        limiter = RateLimiter(1000, 1_000_000, max_retries=1)
+        fn = Mock(side_effect=[rate_limit_error(), rate_limit_error()])
+
+        with pytest.raises(RateLimitError):
+            limiter.call(fn, 10)
+        assert limiter.in_flight == 0
+
+    def test_unused_tokens_are_given_back(self):
+        """Test that the token reservation is corrected with the usage."""
+        limiter = RateLimiter(1000, 10_000)
+        limiter.call(lambda: raw_response(total_tokens=100), 4000)
+
+        assert limiter.tokens.level == pytest.approx(9900, abs=5)
+
+
+class TestRateLimitedClients:
+    """Test cases for the rate limited clients."""
+
+    def test_sync_client(self):
+        """Test that completions go through the raw response API."""
+        llm = Mock()
+        llm.chat.completions.with_raw_response.create.return_value = raw_response("answer")
+        client = RateLimitedOpenAI(llm, RateLimiter(1000, 1_000_000))
+
+        completion = client.chat.completions.create(model="gpt-4o-mini", messages=[{'role': 'user', 'content': 'hi'}], max_tokens=10)
+
+        assert completion.choices[0].message.content == "answer"
+        llm.chat.completions.with_raw_response.create.assert_called_once_with(
+            model="gpt-4o-mini", messages=[{'role': 'user', 'content': 'hi'}], max_tokens=10
+        )
+
+    def test_one_limiter_per_model(self):
+        """Test that the calls of each model are paced on the limits of that model."""
+        llm = Mock()
+        llm.chat.completions.with_raw_response.create.side_effect = [rate_limit_error(), raw_response("map"), raw_response("reduce")]
+        rate_limiters = ModelRateLimiters(max_concurrency=4)
+        client = RateLimitedOpenAI(llm, rate_limiters)
+
+        client.chat.completions.create(model="gpt-4o-mini", messages=[{'role': 'user', 'content': 'hi'}], max_tokens=10)
+        client.chat.completions.create(model="gpt-4o", messages=[{'role': 'user', 'content': 'hi'}], max_tokens=10)
+
+        assert rate_limiters.get("gpt-4o-mini").tokens.capacity == 200_000
+        assert rate_limiters.get("gpt-4o").tokens.capacity == 30_000
+        assert rate_limiters.get("gpt-4o-mini").stats()['nb_rate_limited'] == 1
+        assert rate_limiters.get("gpt-4o").stats() == {'concurrency': 4, 'nb_requests': 1, 'nb_rate_limited': 0}
+        assert rate_limiters.stats()['nb_requests'] == 3
+
+    @pytest.mark.asyncio
+    async def test_async_client_retries(self):
+        """Test that the async client retries on 429."""
+        allm = Mock()
+        allm.chat.completions.with_raw_response.create = AsyncMock(side_effect=[rate_limit_error(), raw_response("answer")])
+        client = AsyncRateLimitedOpenAI(allm, RateLimiter(1000, 1_000_000))
+
+        completion = await client.chat.completions.create(model="gpt-4o-mini", messages=[{'role': 'user', 'content': 'hi'}], max_tokens=10)
+
+        assert completion.choices[0].message.content == "answer"
+        assert client.rate_limiter.stats()['nb_rate_limited'] == 1
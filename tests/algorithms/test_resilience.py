@@ -0,0 +1,212 @@
+"""Tests for src.algorithms.resilience module."""
+
+import asyncio
+import threading
+import time
+
+import httpx
+import pytest
+from unittest.mock import Mock, AsyncMock
+
+from openai import APIConnectionError, BadRequestError, RateLimitError
+
+from src.algorithms.resilience import (
+    RetryPolicy, LatencyTracker, ResilientOpenAI, AsyncResilientOpenAI
+)
+
+
+REQUEST = httpx.Request('POST', 'http://localhost/v1/chat/completions')
+
+
+def connection_error():
+    """Build the error raised by the client when the connection drops."""
+    return APIConnectionError(request=REQUEST)
+
+
+def bad_request_error():
+    """Build a non retryable error."""
+    return BadRequestError('bad request', response=httpx.Response(400, request=REQUEST), body=None)
+
+
+def rate_limit_error():
+    """Build the error raised on a 429."""
+    return RateLimitError('rate limited', response=httpx.Response(429, request=REQUEST), body=None)
+
+
+def messages(system="map"):
+    """Build the messages of a request, the system prompt identifies the kind of call."""
+    return [{'role': 'system', 'content': system}, {'role': 'user', 'content': 'page'}]
+
+
+def fast_policy(**kwargs):
+    """Build a policy without noticeable backoff."""
+    return RetryPolicy(base_delay=0.001, max_delay=0.002, **kwargs)
+
+
+class TestRetryPolicy:
+    """Test cases for RetryPolicy."""
+
+    def test_invalid_arguments(self):
+        """Test that invalid policies are rejected."""
+        with pytest.raises(ValueError):
+            RetryPolicy(max_retries=-1)
+        with pytest.raises(ValueError):
+            RetryPolicy(hedge_quantile=1.5)
+
+    def test_backoff_is_jittered_and_capped(self):
+        """Test that the delays stay under the exponential envelope."""
+        policy = RetryPolicy(base_delay=0.5, max_delay=4.0)
+        for attempt in range(8):
+            delays = [policy.backoff(attempt) for _ in range(50)]
+            assert all(0 <= delay <= min(4.0, 0.5 * 2 ** attempt) for delay in delays)
+            assert len(set(delays)) > 1
+
+
+class TestLatencyTracker:
+    """Test cases for LatencyTracker."""
+
+    def test_quantile_needs_enough_samples(self):
+        """Test that no threshold is given before min_samples observations."""
+        tracker = LatencyTracker()
+        for latency in range(10):
+            tracker.observe("map", latency)
+
+        assert tracker.quantile("map", 0.95, min_samples=20) is None
+        assert tracker.quantile("map", 0.9, min_samples=10) == 9
+        assert tracker.quantile("reduce", 0.9, min_samples=1) is None
+
+    def test_window_is_bounded(self):
+        """Test that old samples are dropped."""
+        tracker = LatencyTracker(window=5)
+        for latency in range(100):
+            tracker.observe("map", latency)
+
+        assert tracker.quantile("map", 0.0, min_samples=5) == 95
+
+
+class TestResilientOpenAI:
+    """Test cases for the retrying and hedging client."""
+
+    def test_retries_transient_errors(self):
+        """Test that a dropped connection is retried."""
+        llm = Mock()
+        llm.chat.completions.create.side_effect = [connection_error(), connection_error(), "answer"]
+        client = ResilientOpenAI(llm, fast_policy(max_retries=3))
+
+        assert client.chat.completions.create(model="gpt-4o-mini", messages=messages()) == "answer"
+        assert llm.chat.completions.create.call_count == 3
+
+    def test_gives_up_after_max_retries(self):
+        """Test that the last error is raised once the retries are exhausted."""
+        llm = Mock()
+        llm.chat.completions.create.side_effect = connection_error()
+        client = ResilientOpenAI(llm, fast_policy(max_retries=2))
+
+        with pytest.raises(APIConnectionError):
+            client.chat.completions.create(model="gpt-4o-mini", messages=messages())
+        assert llm.chat.completions.create.call_count == 3
+
+    def test_client_errors_are_not_retried(self):
+        """Test that a bad request fails at once."""
+        llm = Mock()
+        llm.chat.completions.create.side_effect = bad_request_error()
+        client = ResilientOpenAI(llm, fast_policy(max_retries=3))
+
+        with pytest.raises(BadRequestError):
+            client.chat.completions.create(model="gpt-4o-mini", messages=messages())
+        assert llm.chat.completions.create.call_count == 1
+
+    def test_rate_limits_pass_through_a_rate_limited_client(self):
+        """Test that 429s are left to the rate limiter when it retries them."""
+        llm = Mock()
+        llm.chat.completions.create.side_effect = [rate_limit_error(), "answer"]
+
+        with pytest.raises(RateLimitError):
+            ResilientOpenAI(llm, fast_policy(max_retries=3, retry_rate_limits=False)).chat.completions.create(model="gpt-4o-mini", messages=messages())
+        assert llm.chat.completions.create.call_count == 1
+        assert ResilientOpenAI(llm, fast_policy(max_retries=3)).chat.completions.create(model="gpt-4o-mini", messages=messages()) == "answer"
+
+    def test_timeout_is_set_per_call(self):
+        """Test that the per call timeout is forwarded to the client."""
+        llm = Mock()
+        client = ResilientOpenAI(llm, fast_policy(timeout=12.5))
+
+        client.chat.completions.create(model="gpt-4o-mini", messages=messages())
+
+        assert llm.chat.completions.create.call_args[1]['timeout'] == 12.5
+
+    def test_slow_request_is_hedged(self):
+        """Test that a duplicate is sent past the latency threshold and the first answer wins."""
+        calls = []
+        release_primary = threading.Event()
+
+        def create(**kwargs):
+            calls.append(kwargs)
+            if len(calls) == 1:
+                release_primary.wait(timeout=5)
+                return "slow"
+            return "fast"
+
+        llm = Mock()
+        llm.chat.completions.create.side_effect = create
+        client = ResilientOpenAI(llm, fast_policy(hedge_quantile=0.5, min_samples=3), max_workers=4)
+        for _ in range(3):
+            client.tracker.observe("map", 0.01)
+
+        try:
+            assert client.chat.completions.create(model="gpt-4o-mini", messages=messages()) == "fast"
+            assert len(calls) == 2
+        finally:
+            release_primary.set()
+            client.executor.shutdown(wait=True)
+
+    def test_streamed_request_is_not_hedged(self):
+        """Test that a streamed answer is never duplicated."""
+        llm = Mock()
+        llm.chat.completions.create.side_effect = lambda **kwargs: time.sleep(0.05) or "stream"
+        client = ResilientOpenAI(llm, fast_policy(hedge_quantile=0.5, min_samples=1))
+        client.tracker.observe("map", 0.001)
+
+        assert client.chat.completions.create(model="gpt-4o-mini", messages=messages(), stream=True) == "stream"
+        assert llm.chat.completions.create.call_count == 1
+
+
+class TestAsyncResilientOpenAI:
+    """Test cases for the async retrying and hedging client."""
+
+    @pytest.mark.asyncio
+    async def test_retries_transient_errors(self):
+        """Test that a dropped connection is retried."""
+        allm = Mock()
+        allm.chat.completions.create = AsyncMock(side_effect=[connection_error(), "answer"])
+        client = AsyncResilientOpenAI(allm, fast_policy(max_retries=1))
+
+        assert await client.chat.completions.create(model="gpt-4o-mini", messages=messages()) == "answer"
+        assert allm.chat.completions.create.await_count == 2
+
+    @pytest.mark.asyncio
+    async def test_slow_request_is_hedged_and_cancelled(self):
+        """Test that the losing request is cancelled once the duplicate answers."""
+        cancelled = asyncio.Event()
+        nb_calls = 0
+
+        async def create(**kwargs):
+            nonlocal nb_calls
+            nb_calls += 1
+            if nb_calls == 1:
+                try:
+                    await asyncio.sleep(5)
+                except asyncio.CancelledError:
+                    cancelled.set()
+                    raise
+                return "slow"
+            return "fast"
+
+        allm = Mock()
+        allm.chat.completions.create = create
+        client = AsyncResilientOpenAI(allm, fast_policy(hedge_quantile=0.5, min_samples=3))
+        for _ in range(3):
+            client.tracker.observe("map", 0.01)
+
+        assert await client.chat.completions.create(model="gpt-4o-mini", messages=messages()) == "fast"
+        await asyncio.wait_for(cancelled.wait(), timeout=1)
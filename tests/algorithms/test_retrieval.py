@@ -0,0 +1,68 @@
+"""Tests for src.algorithms.retrieval module."""
+
+import pytest
+
+from src.algorithms.backends import FakeLLM
+from src.algorithms.strategies import llm_map_reduce
+from src.algorithms.retrieval import BM25Index, select_pages, tokenize
+
+
+@pytest.fixture
+def manual_pages():
+    """A long manual where only a few pages are about the battery."""
+    pages = [f"Chapter {i}: assembly of the frame, screws and panels for section {i}." for i in range(400)]
+    pages[37] = "Battery replacement: remove the cover, unplug the battery and insert the new battery."
+    pages[212] = "Charging the battery takes four hours, the led turns green once the battery is full."
+    pages[305] = "Dispose of the old battery at a recycling point."
+    return pages
+
+
+class TestBM25Index:
+    """Test cases for the page scores."""
+
+    def test_tokenize(self):
+        """Test that stopwords and punctuation are dropped."""
+        assert tokenize("What is the Battery life, in hours?") == ["battery", "life", "hours"]
+
+    def test_relevant_pages_rank_first(self, manual_pages):
+        """Test that the pages sharing rare terms with the query are found."""
+        index = BM25Index(manual_pages)
+
+        assert index.search("how do I replace the battery?", top_k=3) == [37, 212, 305]
+        assert index.search("how long does charging the battery take?", top_k=1) == [212]
+
+    def test_min_score(self, manual_pages):
+        """Test that the threshold keeps the pages above it."""
+        index = BM25Index(manual_pages)
+        scores = index.score("battery charging")
+
+        page_ids = index.search("battery charging", min_score=scores[37] + 1e-9)
+
+        assert page_ids == [212]
+
+    def test_unknown_terms(self, manual_pages):
+        """Test that a query without any known term selects nothing."""
+        index = BM25Index(manual_pages)
+
+        assert index.search("warranty", top_k=5) == []
+        assert select_pages(index, manual_pages, "warranty", top_k=5) == manual_pages
+
+    def test_empty_document(self):
+        """Test that an index without pages scores nothing."""
+        assert BM25Index([]).search("battery") == []
+
+
+class TestPrefilteredMapReduce:
+    """Test cases running the map phase on the selected pages only."""
+
+    def test_api_calls_drop(self, manual_pages):
+        """Test that a targeted question only maps the selected pages."""
+        llm = FakeLLM()
+        query = "How do I replace the battery?"
+
+        pages = select_pages(BM25Index(manual_pages), manual_pages, query, top_k=3)
+        answer = llm_map_reduce(query, "gpt-4o-mini", llm, 1, pages)
+
+        assert pages == [manual_pages[37], manual_pages[212], manual_pages[305]]
+        assert answer.startswith("reduce answer")
+        assert llm.stats()["nb_calls_per_kind"]["map"] == 3
@@ -0,0 +1,54 @@
+"""Tests for src.algorithms.scheduler module."""
+
+import time
+
+import pytest
+
+from src.algorithms.scheduler import Scheduler
+
+
+class TestScheduler:
+    """Test cases for the Scheduler class."""
+
+    def test_invalid_max_workers(self):
+        """Test that a non positive cap is rejected."""
+        with pytest.raises(ValueError):
+            Scheduler(max_workers=0)
+
+    def test_submit_returns_result(self):
+        """Test that submit runs the callable on the pool."""
+        with Scheduler(max_workers=2) as scheduler:
+            future = scheduler.submit(lambda x, y: x + y, 1, y=2)
+            assert future.result() == 3
+            assert scheduler.stats()['nb_tasks'] == 1
+
+    def test_done_does_not_use_the_pool(self):
+        """Test that done wraps a value in a resolved future."""
+        with Scheduler(max_workers=1) as scheduler:
+            future = scheduler.done("value")
+            assert future.done() and future.result() == "value"
+            assert scheduler.stats()['nb_tasks'] == 0
+
+    def test_peak_in_flight_is_bounded(self):
+        """Test that the number of concurrent tasks never exceeds the cap."""
+        def task():
+            time.sleep(0.01)
+
+        with Scheduler(max_workers=3) as scheduler:
+            futures = [scheduler.submit(task) for _ in range(20)]
+            for future in futures:
+                future.result()
+            stats = scheduler.stats()
+
+        assert stats['nb_tasks'] == 20
+        assert 1 <= stats['peak_in_flight'] <= 3
+        assert stats['max_workers'] == 3
+
+    def test_reset_clears_counters(self):
+        """Test that reset clears the per query counters."""
+        with Scheduler(max_workers=2) as scheduler:
+            scheduler.submit(lambda: None).result()
+            scheduler.reset()
+            stats = scheduler.stats()
+        assert stats['nb_tasks'] == 0
+        assert stats['peak_in_flight'] == 0
@@ -0,0 +1,109 @@
+"""Tests for src.algorithms.semantic_cache module."""
+
+import pytest
+
+from src.algorithms.backends import FakeLLM
+from src.algorithms.strategies import llm_map_reduce
+from src.algorithms.semantic_cache import SemanticCache, embed, normalize, similarity, stem
+
+
+class _Clock:
+    """Clock moved by hand."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestEmbedding:
+    """Test cases for the query vectors."""
+
+    def test_normalize(self):
+        """Test that fillers are dropped and the words are stemmed."""
+        assert normalize("Can you give me a summary?") == normalize("summarize the document") == ["summar"]
+        assert normalize("What is the battery life in hours?") == ["batter", "lif", "hour"]
+
+    def test_stem(self):
+        """Test that every form of a word gets the same stem."""
+        assert {stem(word) for word in ["process", "processes", "processing", "processed"]} == {"process"}
+        assert {stem(word) for word in ["summarize", "summarized", "summarizing", "summary", "summaries"]} == {"summar"}
+        assert {stem(word) for word in ["cause", "causes", "caused"]} == {"caus"}
+
+    def test_similarity(self):
+        """Test that rephrasings are close and different questions are not."""
+        assert similarity(embed("summarize"), embed("give me a summary")) == pytest.approx(1.0)
+        assert similarity(embed("summarize chapter 2"), embed("summarize chapter 3")) < 0.9
+        assert similarity(embed("summarize"), embed("who wrote it?")) == 0.0
+        assert similarity(embed("does smoking cause cancer?"), embed("does cancer cause smoking?")) < 0.9
+        assert embed("what is it?") == {}
+
+
+class TestSemanticCache:
+    """Test cases for the lookups and the eviction."""
+
+    def test_rephrased_query_hits(self):
+        """Test that a rephrased query of the same document gets the cached answer."""
+        cache = SemanticCache()
+        cache.put("doc", "summarize", "the summary")
+
+        assert cache.get("doc", "Give me a summary") == "the summary"
+        assert cache.get("doc", "who wrote it?") is None
+        assert cache.get("other doc", "summarize") is None
+        assert cache.stats() == {'nb_lookups': 3, 'nb_hits': 1, 'hit_rate': 0.3333, 'nb_entries': 1, 'nb_evictions': 0}
+
+    def test_swapped_words_miss(self):
+        """Test that a question with its terms swapped does not get the answer of the other one."""
+        cache = SemanticCache()
+        cache.put("doc", "Does smoking cause cancer?", "yes")
+
+        assert cache.get("doc", "Does cancer cause smoking?") is None
+        assert cache.get("doc", "does smoking causes cancer") == "yes"
+
+    def test_ttl(self):
+        """Test that an answer older than the ttl is evicted."""
+        clock = _Clock()
+        cache = SemanticCache(ttl=60, clock=clock)
+        cache.put("doc", "summarize", "the summary")
+
+        clock.now = 59
+        assert cache.get("doc", "summarize") == "the summary"
+        clock.now = 61
+        assert cache.get("doc", "summarize") is None
+        assert cache.stats()['nb_evictions'] == 1
+
+    def test_lru(self):
+        """Test that the least recently used answer goes first."""
+        cache = SemanticCache(max_entries=2)
+        cache.put("doc", "summarize", "the summary")
+        cache.put("doc", "battery life", "ten hours")
+        cache.get("doc", "summarize")
+        cache.put("doc", "who wrote it", "the author")
+
+        assert cache.get("doc", "summarize") == "the summary"
+        assert cache.get("doc", "battery life") is None
+        assert cache.stats()['nb_entries'] == 2
+
+    def test_invalid_arguments(self):
+        """Test that impossible settings are rejected."""
+        with pytest.raises(ValueError):
+            SemanticCache(threshold=0)
+        with pytest.raises(ValueError):
+            SemanticCache(ttl=0)
+        with pytest.raises(ValueError):
+            SemanticCache(max_entries=0)
+
+    def test_in_front_of_map_reduce(self):
+        """Test that a rephrased query is answered without any llm call."""
+        llm = FakeLLM(latency=0.01)
+        pages = [f"page {i}" for i in range(8)]
+        cache = SemanticCache()
+        cache.put("doc", "summarize", llm_map_reduce("summarize", "gpt-4o-mini", llm, 2, pages))
+        nb_calls = llm.stats()['nb_calls']
+
+        answer = cache.get("doc", "Could you give me a summary of the document?")
+
+        assert answer.startswith("reduce answer")
+        assert cache.get("doc", "Summarize the second chapter") is None
+        assert llm.stats()['nb_calls'] == nb_calls
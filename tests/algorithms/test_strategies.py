@@ -1,10 +1,23 @@
 """Tests for src.algorithms.strategies module."""
 
+import json
+import asyncio
+import threading
+
 import pytest
-from unittest.mock import Mock, patch, MagicMock
-from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import Mock, patch, MagicMock, AsyncMock
 
-from src.algorithms.strategies import llm_map, llm_reduce, llm_map_reduce
+from src.algorithms.cache import Cache
+from src.algorithms.backends import FakeLLM, AsyncFakeLLM, message_kind, fake_answer
+from src.algorithms.scheduler import Scheduler
+from src.algorithms.partitioning import estimate_tokens
+from src.algorithms.prompts import digest_system_prompt
+from src.algorithms.strategies import (
+    llm_map, llm_reduce, llm_map_reduce, allm_map, allm_reduce, allm_map_reduce, llm_map_reduce_stream,
+    llm_tree_reduce, allm_tree_reduce, llm_map_reduce_incremental, allm_map_reduce_incremental, plan_leaves, build_digest_messages, llm_digest, llm_index, llm_index_reduce, allm_index_reduce,
+    map_max_tokens_of, MIN_MAP_MAX_TOKENS, parse_map_result, parse_multi_map_result, llm_multi_map_reduce, allm_multi_map_reduce,
+    build_map_messages, build_multi_map_messages, build_reduce_messages
+)
 
 
 class TestLLMMap:
@@ -139,49 +152,78 @@ class TestLLMMapReduce:
             page="page1\npage2",
             model="gpt-4o-mini",
             llm=mock_openai_client,
-            query=sample_query
+            query=sample_query,
+            cache=None,
+            max_tokens=1024
         )
 
+    @patch('src.algorithms.strategies.llm_map')
     @patch('src.algorithms.strategies.llm_reduce')
-    @patch('src.algorithms.strategies.ThreadPoolExecutor')
-    def test_llm_map_reduce_large_pages_uses_threads(self, mock_executor_class, mock_llm_reduce, mock_openai_client, sample_query):
-        """Test llm_map_reduce with large pages uses ThreadPoolExecutor."""
-        # Setup
-        mock_executor = Mock()
-        mock_executor_class.return_value.__enter__.return_value = mock_executor
-        mock_executor.map.return_value = ["result1", "result2", "result3"]
+    def test_llm_map_reduce_large_pages_uses_scheduler(self, mock_llm_reduce, mock_llm_map, mock_openai_client, sample_query):
+        """Test llm_map_reduce with large pages runs every call on the shared scheduler."""
+        mock_llm_map.return_value = "Mapped result"
         mock_llm_reduce.return_value = "Final reduced result"
-        
+
         pages = [f"page{i}" for i in range(12)]  # 12 pages
         context_size = 4
-        
-        # Execute
-        result = llm_map_reduce(sample_query, "gpt-4o-mini", mock_openai_client, context_size, pages)
-        
-        # Assert
+
+        with Scheduler(max_workers=2) as scheduler:
+            result = llm_map_reduce(sample_query, "gpt-4o-mini", mock_openai_client, context_size, pages, scheduler)
+            stats = scheduler.stats()
+
+        # 12 pages with batch_size=3: [0:3], [3:6], [6:9], [9:12] = 4 partitions
         assert result == "Final reduced result"
-        mock_executor_class.assert_called_once_with(max_workers=4)  # 12 pages with batch_size=3: [0:3], [3:6], [6:9], [9:12] = 4 partitions
-        mock_executor.map.assert_called_once()
+        assert mock_llm_map.call_count == 4
         mock_llm_reduce.assert_called_once()
+        assert stats['nb_tasks'] == 5
+        assert stats['peak_in_flight'] <= 2
 
     def test_llm_map_reduce_partition_calculation(self, mock_openai_client, sample_query):
         """Test that llm_map_reduce correctly calculates partitions."""
-        with patch('src.algorithms.strategies.ThreadPoolExecutor') as mock_executor_class, \
+        with patch('src.algorithms.strategies.llm_map') as mock_llm_map, \
              patch('src.algorithms.strategies.llm_reduce') as mock_llm_reduce:
-            
-            mock_executor = Mock()
-            mock_executor_class.return_value.__enter__.return_value = mock_executor
-            mock_executor.map.return_value = ["result"]
+
+            mock_llm_map.side_effect = lambda page, **kwargs: page
             mock_llm_reduce.return_value = "Final result"
-            
+
             pages = [f"page{i}" for i in range(8)]  # 8 pages
             context_size = 4
-            
+
             llm_map_reduce(sample_query, "gpt-4o-mini", mock_openai_client, context_size, pages)
-            
+
             # With 8 pages and context_size 4: batch_size = 8/4 = 2
             # Partitions: [0:2], [2:4], [4:6], [6:8] = 4 partitions
-            mock_executor_class.assert_called_once_with(max_workers=4)
+            mock_llm_reduce.assert_called_once()
+            accumulator = mock_llm_reduce.call_args[1]['accumulator']
+            assert accumulator == ["page0\npage1", "page2\npage3", "page4\npage5", "page6\npage7"]
+
+    @patch('src.algorithms.strategies.llm_map')
+    @patch('src.algorithms.strategies.llm_reduce')
+    def test_llm_map_reduce_does_not_nest_thread_pools(self, mock_llm_reduce, mock_llm_map, mock_openai_client, sample_query):
+        """Test that a deep recursion runs on a single bounded pool."""
+        mock_llm_map.return_value = "Mapped result"
+        mock_llm_reduce.return_value = "Reduced result"
+
+        pages = [f"page{i}" for i in range(200)]
+
+        with Scheduler(max_workers=3) as scheduler:
+            result = llm_map_reduce(sample_query, "gpt-4o-mini", mock_openai_client, 2, pages, scheduler)
+            stats = scheduler.stats()
+
+        assert result == "Reduced result"
+        assert stats['peak_in_flight'] <= 3
+        assert stats['peak_threads'] <= 3 + 2  # pool workers + main thread + slack
+
+    @patch('src.algorithms.strategies.llm_map')
+    @patch('src.algorithms.strategies.llm_reduce')
+    def test_llm_map_reduce_propagates_errors(self, mock_llm_reduce, mock_llm_map, mock_openai_client, sample_query):
+        """Test that a failing map call surfaces to the caller."""
+        mock_llm_map.side_effect = RuntimeError("api failure")
+
+        with pytest.raises(RuntimeError):
+            llm_map_reduce(sample_query, "gpt-4o-mini", mock_openai_client, 2, [f"page{i}" for i in range(6)])
+
+        mock_llm_reduce.assert_not_called()
 
     @patch('src.algorithms.strategies.llm_map')
     def test_llm_map_reduce_single_page_equal_context_size(self, mock_llm_map, mock_openai_client, sample_query):
@@ -213,6 +255,476 @@ class TestLLMMapReduce:
         mock_llm_reduce.assert_called()
 
 
+class TestLLMMapReduceTokenPartitioning:
+    """Test cases for token aware partitioning."""
+
+    @patch('src.algorithms.strategies.llm_map')
+    @patch('src.algorithms.strategies.llm_reduce')
+    def test_each_map_call_gets_one_chunk(self, mock_llm_reduce, mock_llm_map, mock_openai_client, sample_query):
+        """Test that every map call receives a chunk under the token budget."""
+        mock_llm_map.return_value = "Mapped"
+        mock_llm_reduce.return_value = "Reduced"
+        pages = ["word " * 30 for _ in range(10)]  # 10 pages of ~38 tokens
+
+        result = llm_map_reduce(sample_query, "gpt-4o-mini", mock_openai_client, 4, pages, token_budget=100, token_counter=estimate_tokens)
+
+        assert result == "Reduced"
+        # two pages fit in a 100 tokens budget: 5 map calls instead of 10
+        assert mock_llm_map.call_count == 5
+        for call in mock_llm_map.call_args_list:
+            assert estimate_tokens(call[1]['page']) <= 100
+
+    @patch('src.algorithms.strategies.llm_map')
+    def test_single_chunk_skips_reduce(self, mock_llm_map, mock_openai_client, sample_query):
+        """Test that a document fitting in one chunk is answered by one map call."""
+        mock_llm_map.return_value = "Mapped"
+
+        result = llm_map_reduce(sample_query, "gpt-4o-mini", mock_openai_client, 2, ["a", "b", "c", "d", "e"], token_budget=1000)
+
+        assert result == "Mapped"
+        mock_llm_map.assert_called_once()
+        assert mock_llm_map.call_args[1]['page'] == "a\nb\nc\nd\ne"
+
+    @pytest.mark.asyncio
+    async def test_async_engine_uses_same_plan(self, sample_query):
+        """Test that both engines pack pages the same way."""
+        pages = ["word " * (i * 7 + 1) for i in range(20)]
+        llm = Mock()
+        llm.chat.completions.create = Mock(side_effect=_echo_completion)
+        allm = Mock()
+        allm.chat.completions.create = AsyncMock(side_effect=_echo_completion)
+
+        expected = llm_map_reduce(sample_query, "gpt-4o-mini", llm, 3, pages, token_budget=120)
+        result = await allm_map_reduce(sample_query, "gpt-4o-mini", allm, 3, pages, token_budget=120)
+
+        assert result == expected
+        assert allm.chat.completions.create.call_count == llm.chat.completions.create.call_count
+
+
+class TestLLMMapReduceStream:
+    """Test cases for the streaming map-reduce."""
+
+    @patch('src.algorithms.strategies.llm_map')
+    @patch('src.algorithms.strategies.llm_reduce')
+    def test_map_calls_start_before_the_stream_ends(self, mock_llm_reduce, mock_llm_map, mock_openai_client, sample_query):
+        """Test that the first map call runs while later pages are still produced."""
+        first_map_started = threading.Event()
+        mock_llm_map.side_effect = lambda **kwargs: first_map_started.set() or kwargs['page']
+        mock_llm_reduce.side_effect = lambda **kwargs: "|".join(kwargs['accumulator'])
+
+        def pages():
+            yield "page0"
+            yield "page1"
+            yield "page2"
+            assert first_map_started.wait(timeout=5)
+            yield "page3"
+
+        result = llm_map_reduce_stream(sample_query, "gpt-4o-mini", mock_openai_client, 2, pages(), nb_pages=4)
+
+        assert result == "page0\npage1|page2\npage3"
+
+    @pytest.mark.parametrize("nb_pages", [None, 32, 40])
+    @patch('src.algorithms.strategies.llm_map')
+    def test_same_leaves_as_map_reduce(self, mock_llm_map, mock_openai_client, sample_query, nb_pages):
+        """Test that the stream sends the map calls of llm_map_reduce, with a missing or a wrong page count."""
+        leaves = []
+        mock_llm_map.side_effect = lambda **kwargs: leaves.append(kwargs['page']) or None
+        pages = [f"page{i}" for i in range(32)]
+
+        llm_map_reduce(sample_query, "gpt-4o-mini", mock_openai_client, 4, pages)
+        expected, leaves[:] = sorted(leaves), []
+        llm_map_reduce_stream(sample_query, "gpt-4o-mini", mock_openai_client, 4, iter(pages), nb_pages=nb_pages)
+
+        assert len(expected) == 16
+        assert sorted(set(leaves)) == expected
+        if nb_pages == len(pages):
+            assert sorted(leaves) == expected
+
+    @patch('src.algorithms.strategies.llm_map')
+    @patch('src.algorithms.strategies.llm_reduce')
+    def test_reduce_levels(self, mock_llm_reduce, mock_llm_map, mock_openai_client, sample_query):
+        """Test that results are reduced level by level with context_size fan-in."""
+        mock_llm_map.return_value = "Mapped"
+        mock_llm_reduce.return_value = "Reduced"
+
+        result = llm_map_reduce_stream(sample_query, "gpt-4o-mini", mock_openai_client, 2, iter([f"page{i}" for i in range(9)]))
+
+        assert result == "Reduced"
+        # 5 leaves of 2 pages, then 2 + 1 + 1 reduces, the lone trailing leaf is promoted
+        assert mock_llm_map.call_count == 5
+        assert mock_llm_reduce.call_count == 4
+
+    def test_empty_stream(self, mock_openai_client, sample_query):
+        """Test that an empty stream returns None."""
+        assert llm_map_reduce_stream(sample_query, "gpt-4o-mini", mock_openai_client, 2, iter([])) is None
+
+
+class TestLLMTreeReduce:
+    """Test cases for the level by level tree reduce."""
+
+    @patch('src.algorithms.strategies.llm_reduce')
+    def test_fan_in_bounds_every_reduce_call(self, mock_llm_reduce, mock_openai_client, sample_query):
+        """Test that no reduce call receives more than fan_in segments."""
+        mock_llm_reduce.side_effect = lambda **kwargs: "+".join(kwargs['accumulator'])
+        segments = [f"s{i}" for i in range(10)]
+
+        result = llm_tree_reduce(sample_query, "gpt-4o-mini", mock_openai_client, segments, 3)
+
+        assert all(len(call.kwargs['accumulator']) <= 3 for call in mock_llm_reduce.call_args_list)
+        # 10 -> 4 (3 reduces + 1 promoted) -> 2 (1 reduce + 1 promoted) -> 1
+        assert mock_llm_reduce.call_count == 5
+        assert result.split("+") == segments
+
+    @patch('src.algorithms.strategies.llm_reduce')
+    def test_token_budget_bounds_every_reduce_call(self, mock_llm_reduce, mock_openai_client, sample_query):
+        """Test that the reduce payload stays under the token budget."""
+        mock_llm_reduce.side_effect = lambda **kwargs: "x" * 40
+        segments = ["y" * 40 for _ in range(16)]
+
+        llm_tree_reduce(sample_query, "gpt-4o-mini", mock_openai_client, segments, 16, reduce_token_budget=25, token_counter=estimate_tokens)
+
+        assert mock_llm_reduce.call_count == 15
+        assert all(
+            sum(estimate_tokens(segment) for segment in call.kwargs['accumulator']) <= 25
+            for call in mock_llm_reduce.call_args_list
+        )
+
+    def test_reduces_of_a_level_run_in_parallel(self, sample_query):
+        """Test that independent reduce calls of the same level are in flight together."""
+        barrier = threading.Barrier(4, timeout=5)
+        first_level = ["s0", "s2", "s4", "s6"]
+
+        def create(**kwargs):
+            if any(f"{segment}\n" in kwargs['messages'][1]['content'] for segment in first_level):
+                barrier.wait()
+            return _echo_completion(**kwargs)
+
+        llm = Mock()
+        llm.chat.completions.create = Mock(side_effect=create)
+        segments = [f"s{i}" for i in range(8)]
+
+        with Scheduler(max_workers=4) as scheduler:
+            # the first level holds 4 reduces, it can only pass the barrier if they overlap
+            llm_tree_reduce(sample_query, "gpt-4o-mini", llm, segments, 2, scheduler, token_counter=estimate_tokens)
+            assert scheduler.stats()['peak_in_flight'] == 4
+
+    def test_none_segments_are_dropped(self, mock_openai_client, sample_query):
+        """Test that an empty tree returns None."""
+        assert llm_tree_reduce(sample_query, "gpt-4o-mini", mock_openai_client, [None, None], 2) is None
+
+    @pytest.mark.asyncio
+    async def test_allm_tree_reduce_matches_threaded_engine(self, sample_query):
+        """Test that both engines build the same tree."""
+        segments = [f"s{i}" for i in range(13)]
+        llm = Mock()
+        llm.chat.completions.create = Mock(side_effect=_echo_completion)
+        allm = Mock()
+        allm.chat.completions.create = AsyncMock(side_effect=_echo_completion)
+
+        expected = llm_tree_reduce(sample_query, "gpt-4o-mini", llm, segments, 3, token_counter=estimate_tokens)
+        result = await allm_tree_reduce(sample_query, "gpt-4o-mini", allm, segments, 3, token_counter=estimate_tokens)
+
+        assert result == expected
+        assert allm.chat.completions.create.await_count == llm.chat.completions.create.call_count
+
+
+class TestStreamingReduce:
+    """Test cases for the token streaming of the final reduce."""
+
+    def test_llm_reduce_streams_tokens(self, sample_query):
+        """Test that llm_reduce forwards every delta and returns the joined answer."""
+        llm = Mock()
+        llm.chat.completions.create.return_value = iter(_stream_chunks(["Final ", None, "answer"]))
+        tokens = []
+
+        result = llm_reduce(["a", "b"], "gpt-4o-mini", llm, sample_query, on_token=tokens.append)
+
+        assert result == "Final answer"
+        assert tokens == ["Final ", "answer"]
+        assert llm.chat.completions.create.call_args[1]['stream'] is True
+
+    def test_cached_reduce_is_streamed_once(self, sample_query):
+        """Test that a cache hit is still sent to the token callback."""
+        llm = Mock()
+        llm.chat.completions.create.side_effect = _echo_completion
+        tokens = []
+        with Cache(':memory:') as cache:
+            expected = llm_reduce(["a", "b"], "gpt-4o-mini", llm, sample_query, cache=cache)
+            result = llm_reduce(["a", "b"], "gpt-4o-mini", llm, sample_query, cache=cache, on_token=tokens.append)
+
+        assert result == expected
+        assert tokens == [expected]
+
+    @patch('src.algorithms.strategies.llm_reduce')
+    def test_only_the_root_reduce_streams(self, mock_llm_reduce, mock_openai_client, sample_query):
+        """Test that inner reduce nodes are not streamed."""
+        mock_llm_reduce.return_value = "Reduced"
+        on_token = Mock()
+
+        llm_tree_reduce(sample_query, "gpt-4o-mini", mock_openai_client, [f"s{i}" for i in range(4)], 2, on_token=on_token)
+
+        streamed = [ call for call in mock_llm_reduce.call_args_list if call.kwargs.get('on_token') is not None ]
+        assert mock_llm_reduce.call_count == 3
+        assert len(streamed) == 1
+        assert streamed[0].kwargs['accumulator'] == ["Reduced", "Reduced"]
+
+    @pytest.mark.asyncio
+    async def test_allm_reduce_streams_tokens(self, sample_query):
+        """Test that allm_reduce forwards every delta of the async stream."""
+        async def chunks():
+            for chunk in _stream_chunks(["Final ", "answer"]):
+                yield chunk
+
+        allm = Mock()
+        allm.chat.completions.create = AsyncMock(return_value=chunks())
+        tokens = []
+
+        result = await allm_reduce(["a", "b"], "gpt-4o-mini", allm, sample_query, on_token=tokens.append)
+
+        assert result == "Final answer"
+        assert tokens == ["Final ", "answer"]
+
+
+class TestIncrementalMapReduce:
+    """Test cases for the completion order reduce."""
+
+    @patch('src.algorithms.strategies.llm_map')
+    @patch('src.algorithms.strategies.llm_reduce')
+    def test_slow_leaf_does_not_block_reduces(self, mock_llm_reduce, mock_llm_map, mock_openai_client, sample_query):
+        """Test that finished results are merged while a slow map call is still running."""
+        first_reduce_done = threading.Event()
+
+        def map_side_effect(**kwargs):
+            if kwargs['page'] == "page0":
+                assert first_reduce_done.wait(timeout=5)
+            return kwargs['page']
+
+        def reduce_side_effect(**kwargs):
+            first_reduce_done.set()
+            return "+".join(kwargs['accumulator'])
+
+        mock_llm_map.side_effect = map_side_effect
+        mock_llm_reduce.side_effect = reduce_side_effect
+        pages = [f"page{i}" for i in range(5)]
+
+        with Scheduler(max_workers=4) as scheduler:
+            result = llm_map_reduce_incremental(sample_query, "gpt-4o-mini", mock_openai_client, 1, pages, scheduler, fan_in=2, token_counter=estimate_tokens)
+
+        assert sorted(result.split("+")) == pages
+        assert all(len(call.kwargs['accumulator']) <= 2 for call in mock_llm_reduce.call_args_list)
+        assert mock_llm_reduce.call_count == 4
+
+    @patch('src.algorithms.strategies.llm_map')
+    @patch('src.algorithms.strategies.llm_reduce')
+    def test_single_leaf_is_not_reduced(self, mock_llm_reduce, mock_llm_map, mock_openai_client, sample_query):
+        """Test that a single leaf is returned as the answer."""
+        mock_llm_map.return_value = "Mapped"
+
+        result = llm_map_reduce_incremental(sample_query, "gpt-4o-mini", mock_openai_client, 4, ["page0", "page1"])
+
+        assert result == "Mapped"
+        mock_llm_reduce.assert_not_called()
+
+    def test_empty_pages(self, mock_openai_client, sample_query):
+        """Test that no page gives no answer."""
+        assert llm_map_reduce_incremental(sample_query, "gpt-4o-mini", mock_openai_client, 2, iter([])) is None
+
+    @pytest.mark.asyncio
+    async def test_allm_map_reduce_incremental(self, sample_query):
+        """Test that the async engine merges every leaf and streams the root."""
+        allm = Mock()
+        allm.chat.completions.create = AsyncMock(side_effect=_echo_completion)
+        pages = [f"page{i}" for i in range(9)]
+
+        result = await allm_map_reduce_incremental(sample_query, "gpt-4o-mini", allm, 1, pages, fan_in=3, token_counter=estimate_tokens)
+
+        # 9 maps, 3 reduces of 3 leaves, 1 root reduce
+        assert result is not None
+        assert allm.chat.completions.create.await_count == 13
+
+
+class TestMapFailureTolerance:
+    """Test cases for the partial failure policy of the map phase."""
+
+    @patch('src.algorithms.strategies.llm_map')
+    @patch('src.algorithms.strategies.llm_reduce')
+    def test_failure_is_raised_by_default(self, mock_llm_reduce, mock_llm_map, mock_openai_client, sample_query):
+        """Test that a failed map call fails the query without tolerance."""
+        mock_llm_map.side_effect = lambda **kwargs: _fail_on("page2", kwargs['page'])
+
+        with pytest.raises(RuntimeError):
+            llm_map_reduce(sample_query, "gpt-4o-mini", mock_openai_client, 1, [f"page{i}" for i in range(4)])
+        mock_llm_reduce.assert_not_called()
+
+    @patch('src.algorithms.strategies.llm_map')
+    @patch('src.algorithms.strategies.llm_reduce')
+    def test_reduce_runs_on_succeeded_partitions(self, mock_llm_reduce, mock_llm_map, mock_openai_client, sample_query):
+        """Test that the reduce skips the failed partitions under the tolerance."""
+        mock_llm_map.side_effect = lambda **kwargs: _fail_on("page2", kwargs['page'])
+        mock_llm_reduce.side_effect = lambda **kwargs: "+".join(kwargs['accumulator'])
+
+        result = llm_map_reduce(sample_query, "gpt-4o-mini", mock_openai_client, 1, [f"page{i}" for i in range(4)], fan_in=4, failure_tolerance=0.25)
+
+        assert result == "page0+page1+page3"
+
+    @patch('src.algorithms.strategies.llm_map')
+    def test_too_many_failures_are_raised(self, mock_llm_map, mock_openai_client, sample_query):
+        """Test that failures above the tolerance fail the query."""
+        mock_llm_map.side_effect = lambda **kwargs: _fail_on("page", kwargs['page'])
+
+        with pytest.raises(RuntimeError):
+            llm_map_reduce_stream(sample_query, "gpt-4o-mini", mock_openai_client, 1, iter(["page0", "page1", "other"]), failure_tolerance=0.5)
+
+    @patch('src.algorithms.strategies.llm_map')
+    @patch('src.algorithms.strategies.llm_reduce')
+    def test_incremental_tolerates_map_failures(self, mock_llm_reduce, mock_llm_map, mock_openai_client, sample_query):
+        """Test that the completion order reduce skips a failed map call."""
+        mock_llm_map.side_effect = lambda **kwargs: _fail_on("page0", kwargs['page'])
+        mock_llm_reduce.side_effect = lambda **kwargs: "+".join(kwargs['accumulator'])
+
+        result = llm_map_reduce_incremental(sample_query, "gpt-4o-mini", mock_openai_client, 1, [f"page{i}" for i in range(4)], fan_in=4, failure_tolerance=0.5)
+
+        assert sorted(result.split("+")) == ["page1", "page2", "page3"]
+
+    @pytest.mark.asyncio
+    async def test_async_engine_tolerates_map_failures(self, sample_query):
+        """Test that the asyncio engine applies the same policy."""
+        async def create(**kwargs):
+            if "page1" in kwargs['messages'][-1]['content']:
+                raise RuntimeError("map failed")
+            return _echo_completion(**kwargs)
+
+        allm = Mock()
+        allm.chat.completions.create = create
+        pages = [f"page{i}" for i in range(4)]
+
+        assert await allm_map_reduce(sample_query, "gpt-4o-mini", allm, 1, pages, failure_tolerance=0.25) is not None
+        with pytest.raises(RuntimeError):
+            await allm_map_reduce(sample_query, "gpt-4o-mini", allm, 1, pages)
+
+
+class TestLLMMapReduceCache:
+    """Test cases for the completion cache integration."""
+
+    def test_llm_map_uses_cache(self, mock_openai_client, mock_chat_completion, sample_query):
+        """Test that a cached map output skips the api call."""
+        mock_openai_client.chat.completions.create.return_value = mock_chat_completion
+        with Cache(path2cache=':memory:') as cache:
+            first = llm_map("content", sample_query, "gpt-4o-mini", mock_openai_client, cache)
+            second = llm_map("content", sample_query, "gpt-4o-mini", mock_openai_client, cache)
+            stats = cache.stats()
+
+        assert first == second == "Test response content"
+        mock_openai_client.chat.completions.create.assert_called_once()
+        assert stats['hits'] == 1
+        assert stats['misses'] == 1
+
+    def test_llm_map_cache_key_depends_on_query_and_model(self, mock_openai_client, mock_chat_completion, sample_query):
+        """Test that a different query or model is a cache miss."""
+        mock_openai_client.chat.completions.create.return_value = mock_chat_completion
+        with Cache(path2cache=':memory:') as cache:
+            llm_map("content", sample_query, "gpt-4o-mini", mock_openai_client, cache)
+            llm_map("content", "another query", "gpt-4o-mini", mock_openai_client, cache)
+            llm_map("content", sample_query, "gpt-4o", mock_openai_client, cache)
+
+        assert mock_openai_client.chat.completions.create.call_count == 3
+
+    def test_llm_reduce_uses_cache(self, mock_openai_client, mock_chat_completion, sample_query):
+        """Test that a cached reduce output skips the api call."""
+        mock_openai_client.chat.completions.create.return_value = mock_chat_completion
+        with Cache(path2cache=':memory:') as cache:
+            llm_reduce(["a", "b"], "gpt-4o-mini", mock_openai_client, sample_query, cache)
+            llm_reduce(["a", None, "b"], "gpt-4o-mini", mock_openai_client, sample_query, cache)
+
+        mock_openai_client.chat.completions.create.assert_called_once()
+
+    def test_repeated_query_costs_no_api_call(self, mock_openai_client, mock_chat_completion, sample_query, tmp_path):
+        """Test that a repeated query on a restarted session is served from disk."""
+        mock_openai_client.chat.completions.create.return_value = mock_chat_completion
+        pages = [f"page{i}" for i in range(12)]
+        path2cache = str(tmp_path / "cache.db")
+
+        with Cache(path2cache=path2cache) as cache:
+            llm_map_reduce(sample_query, "gpt-4o-mini", mock_openai_client, 2, pages, cache=cache)
+        nb_calls = mock_openai_client.chat.completions.create.call_count
+
+        with Cache(path2cache=path2cache) as cache:
+            result = llm_map_reduce(sample_query, "gpt-4o-mini", mock_openai_client, 2, pages, cache=cache)
+
+        assert result == "Test response content"
+        assert mock_openai_client.chat.completions.create.call_count == nb_calls
+
+
+class TestLLMIndex:
+    """Test cases for the query-independent digest index."""
+
+    def test_llm_digest_does_not_depend_on_query(self, mock_openai_client, mock_chat_completion):
+        """Test that the digest prompt only carries the page."""
+        mock_openai_client.chat.completions.create.return_value = mock_chat_completion
+
+        result = llm_digest("Sample page content", "gpt-4o-mini", mock_openai_client)
+
+        assert result == "Test response content"
+        messages = mock_openai_client.chat.completions.create.call_args[1]['messages']
+        assert messages[0]['content'] == digest_system_prompt
+        assert "Sample page content" in messages[1]['content']
+
+    def test_llm_index_digests_every_page_once(self, mock_openai_client, mock_chat_completion, sample_pages):
+        """Test that llm_index issues one call per page and keeps the page order."""
+        mock_openai_client.chat.completions.create.side_effect = _echo_completion
+
+        digests = llm_index("gpt-4o-mini", mock_openai_client, sample_pages)
+
+        assert len(digests) == len(sample_pages)
+        assert mock_openai_client.chat.completions.create.call_count == len(sample_pages)
+        assert digests == [
+            _echo_completion(messages=build_digest_messages(page)).choices[0].message.content
+            for page in sample_pages
+        ]
+
+    def test_llm_index_reuses_cache(self, mock_openai_client, mock_chat_completion, sample_pages):
+        """Test that a rebuilt index is served from the cache."""
+        mock_openai_client.chat.completions.create.return_value = mock_chat_completion
+        with Cache(path2cache=':memory:') as cache:
+            llm_index("gpt-4o-mini", mock_openai_client, sample_pages, cache=cache)
+            llm_index("gpt-4o-mini", mock_openai_client, sample_pages, cache=cache)
+
+        assert mock_openai_client.chat.completions.create.call_count == len(sample_pages)
+
+    @patch('src.algorithms.strategies.llm_map')
+    @patch('src.algorithms.strategies.llm_reduce')
+    def test_llm_index_reduce_skips_map_phase(self, mock_llm_reduce, mock_llm_map, mock_openai_client, sample_query):
+        """Test that the digests are reduced without any map call."""
+        mock_llm_reduce.return_value = "Reduced"
+        digests = [f"digest{i}" for i in range(8)]
+
+        result = llm_index_reduce(sample_query, "gpt-4o-mini", mock_openai_client, 4, digests)
+
+        assert result == "Reduced"
+        mock_llm_map.assert_not_called()
+        # 8 digests with a fan-in of 4: 2 reduces of 4 digests + 1 root reduce
+        assert mock_llm_reduce.call_count == 3
+
+    def test_llm_index_reduce_empty_digests(self, mock_openai_client, sample_query):
+        """Test llm_index_reduce with no digest."""
+        assert llm_index_reduce(sample_query, "gpt-4o-mini", mock_openai_client, 4, []) is None
+
+    @pytest.mark.asyncio
+    async def test_allm_index_reduce_matches_threaded_engine(self, sample_query):
+        """Test that both engines reduce the digests the same way."""
+        digests = [f"digest{i}" for i in range(11)]
+        llm = Mock()
+        llm.chat.completions.create = Mock(side_effect=_echo_completion)
+        allm = Mock()
+        allm.chat.completions.create = AsyncMock(side_effect=_echo_completion)
+
+        expected = llm_index_reduce(sample_query, "gpt-4o-mini", llm, 3, digests)
+        result = await allm_index_reduce(sample_query, "gpt-4o-mini", allm, 3, digests)
+
+        assert result == expected
+        assert allm.chat.completions.create.call_count == llm.chat.completions.create.call_count
+
+
 class TestLLMMapReduceIntegration:
     """Integration tests for the map-reduce workflow."""
 
@@ -260,4 +772,445 @@ class TestLLMMapReduceIntegration:
                 call_args = mock_llm_reduce.call_args
                 assert call_args[1]['query'] == sample_query
                 assert call_args[1]['model'] == model
-                assert call_args[1]['llm'] == mock_openai_client
\ No newline at end of file
+                assert call_args[1]['llm'] == mock_openai_client
+
+def _echo_completion(**kwargs):
+    """Build a deterministic completion from the request messages."""
+    completion = Mock()
+    completion.choices = [Mock()]
+    completion.choices[0].message.content = f"len={len(kwargs['messages'][-1]['content'])}"
+    return completion
+
+
+def _fail_on(marker, page):
+    """Echo the page unless it contains the marker."""
+    if marker in page:
+        raise RuntimeError(f"map failed on {page}")
+    return page
+
+
+def _stream_chunks(tokens):
+    """Build streamed completion chunks, None stands for a chunk without content."""
+    chunks = []
+    for token in tokens:
+        chunk = Mock()
+        chunk.choices = [Mock()]
+        chunk.choices[0].delta.content = token
+        chunks.append(chunk)
+    return chunks
+
+
+class TestAsyncLLMMapReduce:
+    """Test cases for the asyncio engine."""
+
+    @pytest.mark.asyncio
+    async def test_allm_map_success(self, sample_query):
+        """Test successful allm_map execution."""
+        allm = Mock()
+        allm.chat.completions.create = AsyncMock(side_effect=_echo_completion)
+
+        result = await allm_map("Sample page content", sample_query, "gpt-4o-mini", allm)
+
+        assert result.startswith("len=")
+        call_args = allm.chat.completions.create.call_args
+        assert call_args[1]['max_tokens'] == 1024
+        assert "Sample page content" in call_args[1]['messages'][1]['content']
+
+    @pytest.mark.asyncio
+    async def test_allm_reduce_with_all_none_values(self, sample_query):
+        """Test allm_reduce skips the call when every segment is None."""
+        allm = Mock()
+        allm.chat.completions.create = AsyncMock()
+
+        assert await allm_reduce([None, None], "gpt-4o-mini", allm, sample_query) is None
+        allm.chat.completions.create.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_allm_map_reduce_empty_pages(self, sample_query):
+        """Test allm_map_reduce with empty pages."""
+        assert await allm_map_reduce(sample_query, "gpt-4o-mini", Mock(), 4, []) is None
+
+    @pytest.mark.asyncio
+    async def test_allm_map_reduce_matches_threaded_engine(self, sample_query):
+        """Test that both engines send the same requests and return the same answer."""
+        pages = [f"Content of page {i+1}" for i in range(37)]
+
+        llm = Mock()
+        llm.chat.completions.create = Mock(side_effect=_echo_completion)
+        allm = Mock()
+        allm.chat.completions.create = AsyncMock(side_effect=_echo_completion)
+
+        expected = llm_map_reduce(sample_query, "gpt-4o-mini", llm, 3, pages)
+        result = await allm_map_reduce(sample_query, "gpt-4o-mini", allm, 3, pages, asyncio.Semaphore(4))
+
+        assert result == expected
+        assert allm.chat.completions.create.call_count == llm.chat.completions.create.call_count
+
+    @pytest.mark.asyncio
+    async def test_allm_map_reduce_respects_semaphore(self, sample_query):
+        """Test that the number of in-flight completions never exceeds the semaphore."""
+        in_flight = 0
+        peak = 0
+
+        async def create(**kwargs):
+            nonlocal in_flight, peak
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0.001)
+            in_flight -= 1
+            return _echo_completion(**kwargs)
+
+        allm = Mock()
+        allm.chat.completions.create = create
+
+        pages = [f"page{i}" for i in range(100)]
+        await allm_map_reduce(sample_query, "gpt-4o-mini", allm, 2, pages, asyncio.Semaphore(5))
+
+        assert 1 <= peak <= 5
+
+
+class TestWithFakeBackend:
+    """Test cases running the strategies end to end on the in-process fake."""
+
+    def test_concurrency_is_bounded_by_the_scheduler(self, sample_query):
+        """Test that the fake never sees more calls in flight than workers."""
+        llm = FakeLLM(latency=0.005)
+        pages = [f"page {i}" for i in range(40)]
+
+        with Scheduler(max_workers=4) as scheduler:
+            answer = llm_map_reduce(sample_query, "gpt-4o-mini", llm, 2, pages, scheduler=scheduler)
+
+        assert answer.startswith("reduce answer")
+        assert 1 < llm.stats()['peak_in_flight'] <= 4
+        assert llm.stats()['nb_calls_per_kind']['map'] == len(plan_leaves(pages, "gpt-4o-mini", 2))
+
+    def test_answers_are_reproducible(self, sample_query):
+        """Test that two runs on fresh fakes give the same answer."""
+        pages = [f"page {i}" for i in range(12)]
+
+        first = llm_map_reduce(sample_query, "gpt-4o-mini", FakeLLM(), 3, pages)
+        second = llm_map_reduce(sample_query, "gpt-4o-mini", FakeLLM(), 3, pages)
+
+        assert first == second
+
+    def test_cached_run_costs_no_call(self, sample_query):
+        """Test that a repeated run is answered by the cache."""
+        llm = FakeLLM()
+        pages = [f"page {i}" for i in range(12)]
+
+        with Cache(':memory:') as cache:
+            expected = llm_map_reduce(sample_query, "gpt-4o-mini", llm, 3, pages, cache=cache)
+            nb_calls = llm.stats()['nb_calls']
+            answer = llm_map_reduce(sample_query, "gpt-4o-mini", llm, 3, pages, cache=cache)
+
+        assert answer == expected
+        assert llm.stats()['nb_calls'] == nb_calls
+
+    def test_failure_tolerance(self, sample_query):
+        """Test that failed map calls are dropped within the tolerance."""
+        llm = FakeLLM(fail_when=lambda messages: "page 3" in messages[-1]['content'])
+        pages = [f"page {i}" for i in range(8)]
+
+        answer = llm_map_reduce(sample_query, "gpt-4o-mini", llm, 1, pages, failure_tolerance=0.2)
+
+        assert answer.startswith("reduce answer")
+        assert llm.stats()['nb_failures'] == 1
+        with pytest.raises(Exception):
+            llm_map_reduce(sample_query, "gpt-4o-mini", llm, 1, pages)
+
+    @pytest.mark.asyncio
+    async def test_engines_agree(self, sample_query):
+        """Test that the thread and asyncio engines give the same answer."""
+        pages = [f"page {i}" for i in range(25)]
+
+        expected = llm_map_reduce(sample_query, "gpt-4o-mini", FakeLLM(), 2, pages, fan_in=3)
+        answer = await allm_map_reduce(sample_query, "gpt-4o-mini", AsyncFakeLLM(), 2, pages, asyncio.Semaphore(4), fan_in=3)
+
+        assert answer == expected
+
+    def test_streamed_root_matches_the_answer(self, sample_query):
+        """Test that the streamed tokens join to the returned answer."""
+        tokens = []
+
+        answer = llm_map_reduce(sample_query, "gpt-4o-mini", FakeLLM(), 2, [f"page {i}" for i in range(6)], on_token=tokens.append)
+
+        assert "".join(tokens) == answer
+
+
+def _record_calls(llm, calls, is_async=False):
+    """Record the kind, model and max_tokens of every call sent to a fake."""
+    create = llm.chat.completions.create
+
+    def record(kwargs):
+        calls.append((message_kind(kwargs['messages']), kwargs['model'], kwargs['max_tokens']))
+
+    def recorded(**kwargs):
+        record(kwargs)
+        return create(**kwargs)
+
+    async def arecorded(**kwargs):
+        record(kwargs)
+        return await create(**kwargs)
+
+    llm.chat.completions.create = arecorded if is_async else recorded
+    return llm
+
+
+class TestModelCascade:
+    """Test cases for the per-stage models and max_tokens."""
+
+    def test_map_and_reduce_models(self, sample_query):
+        """Test that the map calls run on the map model and the reduce calls on the main one."""
+        calls = []
+        llm = _record_calls(FakeLLM(), calls)
+
+        answer = llm_map_reduce(sample_query, "gpt-4o", llm, 2, [f"page {i}" for i in range(8)], map_model="gpt-4o-mini", map_max_tokens=256, reduce_max_tokens=2048)
+
+        assert answer.startswith("reduce answer")
+        assert {call for call in calls if call[0] == "map"} == {("map", "gpt-4o-mini", 256)}
+        assert {call for call in calls if call[0] == "reduce"} == {("reduce", "gpt-4o", 2048)}
+
+    def test_map_max_tokens_from_the_partition(self):
+        """Test that the map answer is sized from the partition when not set."""
+        assert map_max_tokens_of("short page", 512, estimate_tokens) == 512
+        assert map_max_tokens_of("short page", None, estimate_tokens) == MIN_MAP_MAX_TOKENS
+        assert map_max_tokens_of("x" * 8000, None, estimate_tokens) == 500
+        assert map_max_tokens_of("x" * 80000, None, estimate_tokens) == 1024
+
+    def test_scaled_map_calls(self, sample_query):
+        """Test that every map call gets the max_tokens of its own partition."""
+        calls = []
+        pages = ["x" * 8000, "short page", "x" * 80000]
+
+        llm_map_reduce(sample_query, "gpt-4o-mini", _record_calls(FakeLLM(), calls), 1, pages, map_max_tokens=None)
+
+        assert sorted(call[2] for call in calls if call[0] == "map") == [MIN_MAP_MAX_TOKENS, 500, 1024]
+
+    def test_max_tokens_is_part_of_the_cache_key(self, sample_query):
+        """Test that answers cached under another max_tokens are not reused."""
+        llm = FakeLLM()
+        pages = [f"page {i}" for i in range(4)]
+
+        with Cache(':memory:') as cache:
+            llm_map_reduce(sample_query, "gpt-4o-mini", llm, 1, pages, cache=cache)
+            nb_reduce_calls = llm.stats()['nb_calls_per_kind']['reduce']
+            llm_map_reduce(sample_query, "gpt-4o-mini", llm, 1, pages, cache=cache, map_max_tokens=256)
+
+        assert llm.stats()['nb_calls_per_kind']['map'] == 8
+        # the fake answers do not depend on max_tokens, the reduce calls merge the same segments
+        assert llm.stats()['nb_calls_per_kind']['reduce'] == nb_reduce_calls
+
+    @pytest.mark.parametrize("strategy", [llm_map_reduce_stream, llm_map_reduce_incremental])
+    def test_streamed_and_incremental_strategies(self, sample_query, strategy):
+        """Test that the other thread strategies honour the stages."""
+        calls = []
+        llm = _record_calls(FakeLLM(), calls)
+
+        strategy(sample_query, "gpt-4o", llm, 2, iter([f"page {i}" for i in range(8)]), map_model="gpt-4o-mini", map_max_tokens=256, reduce_max_tokens=2048)
+
+        assert {call[1:] for call in calls if call[0] == "map"} == {("gpt-4o-mini", 256)}
+        assert {call[1:] for call in calls if call[0] == "reduce"} == {("gpt-4o", 2048)}
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("strategy", [allm_map_reduce, allm_map_reduce_incremental])
+    async def test_async_strategies(self, sample_query, strategy):
+        """Test that the asyncio engine honours the stages."""
+        calls = []
+        llm = _record_calls(AsyncFakeLLM(), calls, is_async=True)
+
+        await strategy(sample_query, "gpt-4o", llm, 2, [f"page {i}" for i in range(8)], asyncio.Semaphore(4), map_model="gpt-4o-mini", map_max_tokens=256, reduce_max_tokens=2048)
+
+        assert {call[1:] for call in calls if call[0] == "map"} == {("gpt-4o-mini", 256)}
+        assert {call[1:] for call in calls if call[0] == "reduce"} == {("gpt-4o", 2048)}
+
+
+def _relevance_answer(messages):
+    """Map answers in json, only the pages about the battery are relevant."""
+    if message_kind(messages) != "map":
+        return fake_answer(messages)
+    if "battery" not in messages[-1]['content'].split("Page content:")[1].split("Extract")[0]:
+        return json.dumps({"relevant": False, "content": ""})
+    return json.dumps({"relevant": True, "content": fake_answer(messages)})
+
+
+class TestIrrelevantPartitions:
+    """Test cases for the map results flagged as irrelevant."""
+
+    def test_parse_map_result(self):
+        """Test the structured answer of a map call."""
+        assert parse_map_result('{"relevant": true, "content": "facts"}') == "facts"
+        assert parse_map_result('{"relevant": false, "content": ""}') is None
+        assert parse_map_result('{"relevant": false}') is None
+        assert parse_map_result('{"relevant": true, "content": ""}') is None
+        assert parse_map_result('{"relevant": true}') is None
+        assert parse_map_result('{"foo": 1}') == '{"foo": 1}'
+        assert parse_map_result('{"relevant": "maybe", "content": "facts"}') == '{"relevant": "maybe", "content": "facts"}'
+        assert parse_map_result('["facts"]') == '["facts"]'
+        assert parse_map_result("plain text answer") == "plain text answer"
+        assert parse_map_result(None) is None
+
+    def test_json_mode_is_requested(self, mock_openai_client, mock_chat_completion, sample_query):
+        """Test that the map call asks for a json object."""
+        mock_openai_client.chat.completions.create.return_value = mock_chat_completion
+
+        llm_map("page", sample_query, "gpt-4o-mini", mock_openai_client)
+
+        assert mock_openai_client.chat.completions.create.call_args[1]['response_format'] == {'type': 'json_object'}
+
+    def test_irrelevant_partitions_cost_no_reduce(self, sample_query):
+        """Test that irrelevant partitions are dropped and their subtrees pruned."""
+        llm = FakeLLM(respond=_relevance_answer)
+        pages = [f"page {i}" for i in range(16)]
+        pages[3] = "the battery lasts ten hours"
+        pages[12] = "charge the battery overnight"
+
+        answer = llm_map_reduce(sample_query, "gpt-4o-mini", llm, 1, pages, fan_in=2)
+
+        assert answer.startswith("reduce answer")
+        assert llm.stats()['nb_calls_per_kind'] == {'map': 16, 'reduce': 1}
+
+    def test_nothing_relevant(self, sample_query):
+        """Test that a document without any relevant partition has no answer."""
+        llm = FakeLLM(respond=_relevance_answer)
+
+        assert llm_map_reduce(sample_query, "gpt-4o-mini", llm, 1, [f"page {i}" for i in range(4)]) is None
+        assert 'reduce' not in llm.stats()['nb_calls_per_kind']
+
+    def test_irrelevant_answers_are_cached(self, sample_query):
+        """Test that a cached irrelevant partition is skipped without a call."""
+        llm = FakeLLM(respond=_relevance_answer)
+        pages = [f"page {i}" for i in range(4)] + ["the battery lasts ten hours"]
+
+        with Cache(':memory:') as cache:
+            expected = llm_map_reduce(sample_query, "gpt-4o-mini", llm, 1, pages, cache=cache)
+            nb_calls = llm.stats()['nb_calls']
+            answer = llm_map_reduce(sample_query, "gpt-4o-mini", llm, 1, pages, cache=cache)
+
+        assert answer == expected
+        assert llm.stats()['nb_calls'] == nb_calls
+
+    @pytest.mark.asyncio
+    async def test_async_engine(self, sample_query):
+        """Test that the asyncio engine drops the irrelevant partitions."""
+        llm = AsyncFakeLLM(respond=_relevance_answer)
+        pages = [f"page {i}" for i in range(8)]
+        pages[1] = "the battery lasts ten hours"
+        pages[6] = "charge the battery overnight"
+
+        answer = await allm_map_reduce(sample_query, "gpt-4o-mini", llm, 1, pages, asyncio.Semaphore(4), fan_in=2)
+
+        assert answer.startswith("reduce answer")
+        assert llm.stats()['nb_calls_per_kind'] == {'map': 8, 'reduce': 1}
+
+
+def _multi_query_answer(messages):
+    """Multi-query map answers in json, a query is relevant to the pages containing its first word."""
+    if message_kind(messages) != "map":
+        return fake_answer(messages)
+    content = messages[-1]['content']
+    page, numbered_queries = content.split("Page content:")[1].split("queries:")
+    queries = [line.strip().split(": ", 1)[1] for line in numbered_queries.splitlines() if ": " in line]
+    return json.dumps({
+        str(index): {"relevant": query.split()[0] in page, "content": f"{query.split()[0]} facts from {page.split()[0]}"}
+        for index, query in enumerate(queries)
+    })
+
+
+class TestMultiQueryMapReduce:
+    """Test cases answering several queries with one map pass."""
+
+    QUERIES = ["battery life?", "screen size?", "warranty terms?"]
+
+    def _pages(self):
+        pages = [f"page{i} about the frame" for i in range(12)]
+        pages[2] = "page2 the battery lasts ten hours"
+        pages[7] = "page7 the battery charges in two hours"
+        pages[9] = "page9 the screen measures 13 inches"
+        return pages
+
+    def test_parse_multi_map_result(self):
+        """Test the answer of a map call keyed by query."""
+        data = json.dumps({"0": {"relevant": True, "content": "a"}, "2": {"relevant": False, "content": ""}})
+
+        assert parse_multi_map_result(data, 3) == ["a", None, None]
+        assert parse_multi_map_result("plain text", 2) == [None, None]
+        assert parse_multi_map_result(json.dumps(["a", "b"]), 2) == [None, None]
+        assert parse_multi_map_result(json.dumps({"0": "a", "1": {"relevant": True, "content": "b"}}), 2) == [None, "b"]
+        assert parse_multi_map_result(json.dumps({"0": {"foo": 1}, "1": {"relevant": True, "content": "b"}}), 2) == [None, "b"]
+        assert parse_multi_map_result(None, 2) == [None, None]
+
+    def test_map_calls_scale_with_pages(self):
+        """Test that one map call per leaf serves every query and each query gets its own reduce."""
+        llm = FakeLLM(respond=_multi_query_answer)
+
+        answers = llm_multi_map_reduce(self.QUERIES, "gpt-4o-mini", llm, 1, self._pages(), fan_in=2)
+
+        assert answers[0].startswith("reduce answer")
+        assert answers[1] == "screen facts from page9"
+        assert answers[2] is None
+        assert llm.stats()['nb_calls_per_kind'] == {'map': 12, 'reduce': 1}
+
+    def test_plain_text_answers_are_skipped(self, sample_query):
+        """Test that a map answer that can not be split per query reaches no reduce."""
+        llm = FakeLLM()
+
+        answers = llm_multi_map_reduce([sample_query, "another query"], "gpt-4o-mini", llm, 2, [f"page {i}" for i in range(8)])
+
+        assert answers == [None, None]
+        assert llm.stats()['nb_calls_per_kind'] == {'map': len(plan_leaves([f"page {i}" for i in range(8)], "gpt-4o-mini", 2))}
+
+    def test_cached_run_costs_no_call(self):
+        """Test that the same queries on the same pages are answered by the cache."""
+        llm = FakeLLM(respond=_multi_query_answer)
+
+        with Cache(':memory:') as cache:
+            expected = llm_multi_map_reduce(self.QUERIES, "gpt-4o-mini", llm, 2, self._pages(), cache=cache)
+            nb_calls = llm.stats()['nb_calls']
+            answers = llm_multi_map_reduce(self.QUERIES, "gpt-4o-mini", llm, 2, self._pages(), cache=cache)
+
+        assert answers == expected
+        assert llm.stats()['nb_calls'] == nb_calls
+
+    def test_no_pages(self):
+        """Test that every query is unanswered without pages."""
+        assert llm_multi_map_reduce(self.QUERIES, "gpt-4o-mini", FakeLLM(), 2, []) == [None, None, None]
+
+    @pytest.mark.asyncio
+    async def test_engines_agree(self):
+        """Test that the asyncio engine gives the same answers."""
+        expected = llm_multi_map_reduce(self.QUERIES, "gpt-4o-mini", FakeLLM(respond=_multi_query_answer), 1, self._pages(), fan_in=2)
+        llm = AsyncFakeLLM(respond=_multi_query_answer)
+
+        answers = await allm_multi_map_reduce(self.QUERIES, "gpt-4o-mini", llm, 1, self._pages(), asyncio.Semaphore(4), fan_in=2)
+
+        assert answers == expected
+        assert llm.stats()['nb_calls_per_kind'] == {'map': 12, 'reduce': 1}
+
+
+class TestPromptPrefixCaching:
+    """Test cases for the message layout reused by the provider prompt cache."""
+
+    def test_query_comes_last(self, sample_query):
+        """Test that the messages of two queries share everything up to the query."""
+        for build in [build_map_messages, build_reduce_messages]:
+            argument = "Sample page content" if build is build_map_messages else ["First segment", "Second segment"]
+            first = build(argument, sample_query)
+            second = build(argument, "Another question")
+
+            assert first[0] == second[0]
+            prefix = first[1]['content'].split(sample_query)[0]
+            assert second[1]['content'].startswith(prefix)
+            assert first[1]['content'].rstrip().endswith(sample_query)
+
+        assert build_multi_map_messages("Sample page content", ["q0", "q1"])[1]['content'].rstrip().endswith("1: q1")
+
+    def test_second_query_reuses_the_pages(self, sample_query):
+        """Test that the map calls of a second query over long pages hit the prompt cache."""
+        llm = FakeLLM()
+        pages = [f"page {i} " + "x" * 8000 for i in range(4)]
+
+        llm_map_reduce(sample_query, "gpt-4o-mini", llm, 1, pages)
+        assert llm.stats()['cached_tokens'] == 0
+        llm_map_reduce("Another question about the pages", "gpt-4o-mini", llm, 1, pages)
+
+        assert llm.stats()['cached_tokens'] >= 4 * 1024
@@ -0,0 +1,140 @@
+"""Tests for src.algorithms.tracing module."""
+
+import json
+import asyncio
+
+import pytest
+
+from src.algorithms.cache import Cache
+from src.algorithms.scheduler import Scheduler
+from src.algorithms.backends import FakeLLM, AsyncFakeLLM
+from src.algorithms.strategies import llm_map_reduce, allm_map_reduce, llm_map_reduce_stream
+from src.algorithms.tracing import Tracer, span, annotate, summarize, format_summary
+
+
+def _calls(root, name=None):
+    """Every llm call span of a trace, optionally of one kind."""
+    return [item for item in root.walk() if item.name in ("map", "reduce", "digest") and (name is None or item.name == name)]
+
+
+class TestSpans:
+    """Test cases for the span helpers."""
+
+    def test_spans_are_noops_outside_a_trace(self):
+        """Test that nothing is recorded without a tracer."""
+        with span("map") as current:
+            annotate(cache_hit=True)
+        assert current is None
+
+    def test_nested_spans(self):
+        """Test that spans nest and record their errors."""
+        tracer = Tracer()
+        with tracer.trace("query") as root:
+            with span("level", level=0):
+                with pytest.raises(ValueError):
+                    with span("map"):
+                        raise ValueError("bad page")
+
+        level = root.children[0]
+        assert level.children[0].error == "ValueError: bad page"
+        assert root.duration >= level.duration >= level.children[0].duration
+
+
+class TestTracedMapReduce:
+    """Test cases tracing the strategies on the fake backend."""
+
+    def test_span_tree_mirrors_the_levels(self, sample_query):
+        """Test that every call is traced under its level with its usage."""
+        llm = FakeLLM()
+        tracer = Tracer()
+        with tracer.trace("query", query=sample_query) as root:
+            llm_map_reduce(sample_query, "gpt-4o-mini", llm, 1, [f"page {i}" for i in range(9)], fan_in=3)
+
+        levels = [child for child in root.children if child.name == "level"]
+        assert [level.attributes["level"] for level in levels] == [0, 1, 2]
+        assert sorted(call.attributes["leaf"] for call in levels[0].children) == list(range(9))
+        assert all("queue_wait" in call.attributes for call in _calls(root))
+
+        summary = summarize(root)
+        assert summary["nb_calls"] == llm.stats()["nb_calls"] == 13
+        assert summary["prompt_tokens"] == llm.stats()["prompt_tokens"]
+        assert summary["completion_tokens"] == llm.stats()["completion_tokens"]
+        assert {level: stats["nb_calls"] for level, stats in summary["levels"].items()} == {0: 9, 1: 3, 2: 1}
+
+    def test_queue_wait(self, sample_query):
+        """Test that calls waiting for a worker report the wait."""
+        tracer = Tracer()
+        with Scheduler(max_workers=1) as scheduler, tracer.trace("query") as root:
+            llm_map_reduce(sample_query, "gpt-4o-mini", FakeLLM(latency=0.01), 1, ["p0", "p1", "p2"], scheduler=scheduler)
+
+        waits = sorted(call.attributes["queue_wait"] for call in _calls(root, "map"))
+        assert waits[-1] >= 0.02
+
+    def test_cache_hits(self, sample_query):
+        """Test that cached calls are traced as cache hits."""
+        llm = FakeLLM()
+        pages = [f"page {i}" for i in range(6)]
+        tracer = Tracer()
+        with Cache(':memory:') as cache:
+            llm_map_reduce(sample_query, "gpt-4o-mini", llm, 2, pages, cache=cache)
+            with tracer.trace("query") as root:
+                llm_map_reduce(sample_query, "gpt-4o-mini", llm, 2, pages, cache=cache)
+
+        summary = summarize(root)
+        assert summary["nb_calls"] == summary["nb_cache_hits"] == llm.stats()["nb_calls"]
+        assert summary["prompt_tokens"] == 0
+
+    def test_cached_prompt_tokens(self, sample_query):
+        """Test that the prompt tokens served from the provider cache are summed per level."""
+        llm = FakeLLM()
+        pages = [f"page {i} " + "x" * 8000 for i in range(3)]
+        llm_map_reduce(sample_query, "gpt-4o-mini", llm, 1, pages)
+        tracer = Tracer()
+        with tracer.trace("query") as root:
+            llm_map_reduce("Another question about the pages", "gpt-4o-mini", llm, 1, pages)
+
+        summary = summarize(root)
+        assert summary["cached_tokens"] == summary["levels"][0]["cached_tokens"] > 0
+        assert f"({summary['cached_tokens']} cached)" in format_summary(summary)
+
+    def test_failed_calls(self, sample_query):
+        """Test that failed map calls are counted per level."""
+        llm = FakeLLM(fail_when=lambda messages: "p1" in messages[-1]["content"])
+        tracer = Tracer()
+        with tracer.trace("query") as root:
+            llm_map_reduce(sample_query, "gpt-4o-mini", llm, 1, ["p0", "p1", "p2", "p3"], failure_tolerance=0.5)
+
+        assert summarize(root)["levels"][0]["nb_errors"] == 1
+
+    def test_streamed_pages(self, sample_query):
+        """Test that the leaves of a page stream are numbered in order."""
+        tracer = Tracer()
+        with tracer.trace("query") as root:
+            llm_map_reduce_stream(sample_query, "gpt-4o-mini", FakeLLM(), 2, iter([f"page {i}" for i in range(6)]), nb_pages=6)
+
+        assert sorted(call.attributes["leaf"] for call in _calls(root, "map")) == [0, 1, 2, 3, 4, 5]
+
+    @pytest.mark.asyncio
+    async def test_async_engine(self, sample_query):
+        """Test that the asyncio engine produces the same span tree."""
+        tracer = Tracer()
+        with tracer.trace("query") as root:
+            await allm_map_reduce(sample_query, "gpt-4o-mini", AsyncFakeLLM(), 1, [f"page {i}" for i in range(9)], asyncio.Semaphore(2), fan_in=3)
+
+        summary = summarize(root)
+        assert {level: stats["nb_calls"] for level, stats in summary["levels"].items()} == {0: 9, 1: 3, 2: 1}
+        assert all("queue_wait" in call.attributes for call in _calls(root))
+
+    def test_export(self, sample_query, tmp_path):
+        """Test the json export and the summary line."""
+        tracer = Tracer()
+        with tracer.trace("query", query=sample_query) as root:
+            llm_map_reduce(sample_query, "gpt-4o-mini", FakeLLM(), 2, [f"page {i}" for i in range(4)])
+        tracer.write(tmp_path / "trace.json")
+
+        with open(tmp_path / "trace.json") as fp:
+            traces = json.load(fp)["traces"]
+        assert traces[0]["attributes"]["query"] == sample_query
+        assert [child["name"] for child in traces[0]["children"]] == ["level", "level"]
+        assert "3 calls (0 cached)" in format_summary(summarize(root))
+        assert "slowest: " in format_summary(summarize(root))
@@ -88,4 +88,40 @@ def single_page():
 @pytest.fixture
 def large_pages_list():
     """Large list of pages for testing pagination."""
-    return [f"This is page {i+1} content" for i in range(20)]
\ No newline at end of file
+    return [f"This is page {i+1} content" for i in range(20)]
+
+def make_pdf(path, texts):
+    """Write a minimal PDF with one line of Helvetica text per page."""
+    objects = []
+    kids = " ".join(f"{4 + 2 * index} 0 R" for index in range(len(texts)))
+    objects.append("<< /Type /Catalog /Pages 2 0 R >>")
+    objects.append(f"<< /Type /Pages /Kids [{kids}] /Count {len(texts)} >>")
+    objects.append("<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    for index, text in enumerate(texts):
+        stream = f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET" if text else ""
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R >> >> /Contents {5 + 2 * index} 0 R >>")
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+
+    out = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n{body}\nendobj\n".encode("latin-1")
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("latin-1")
+    for offset in offsets:
+        out += f"{offset:010d} 00000 n \n".encode("latin-1")
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode("latin-1")
+
+    with open(path, "wb") as fp:
+        fp.write(out)
+    return str(path)
+
+
+@pytest.fixture
+def sample_pdf(tmp_path):
+    """Real PDF file with 10 text pages and 2 empty pages."""
+    texts = [f"Content of page {i+1}" for i in range(10)]
+    texts.insert(3, "")
+    texts.insert(7, "")
+    return make_pdf(tmp_path / "sample.pdf", texts)
@@ -0,0 +1,127 @@
+"""Tests for src.extraction module."""
+
+import pytest
+from unittest.mock import patch
+
+from src.algorithms.cache import Cache
+from src.extraction import PageStream, file_hash, count_pages, extract_batch, iter_pages, parse_page_ranges
+
+
+class TestExtraction:
+    """Test cases for the page extraction functions."""
+
+    def test_file_hash_is_stable(self, sample_pdf):
+        """Test that the file hash only depends on the content."""
+        assert file_hash(sample_pdf) == file_hash(sample_pdf)
+        assert len(file_hash(sample_pdf)) == 64
+
+    def test_count_pages(self, sample_pdf):
+        """Test that every page is counted, including the empty ones."""
+        assert count_pages(sample_pdf) == 12
+
+    def test_extract_batch(self, sample_pdf):
+        """Test extraction of a subset of pages."""
+        assert extract_batch(sample_pdf, [0, 3]) == [(0, "Content of page 1"), (3, "")]
+
+    def test_iter_pages_in_order(self, sample_pdf):
+        """Test that the process pool yields every page in order."""
+        pages = list(iter_pages(sample_pdf, max_workers=2, batch_size=3))
+
+        assert [page_number for page_number, _ in pages] == list(range(12))
+        assert pages[0] == (0, "Content of page 1")
+        assert pages[3] == (3, "")
+
+    def test_iter_pages_uses_cache(self, sample_pdf):
+        """Test that a relaunch on the same file does not extract again."""
+        with Cache(path2cache=':memory:') as cache:
+            first = list(iter_pages(sample_pdf, max_workers=2, cache=cache))
+            with patch('src.extraction.ProcessPoolExecutor') as mock_executor:
+                second = list(iter_pages(sample_pdf, max_workers=2, cache=cache))
+
+        assert first == second
+        mock_executor.assert_not_called()
+
+
+    def test_iter_pages_selected_pages(self, sample_pdf):
+        """Test that only the requested pages are read."""
+        pages = list(iter_pages(sample_pdf, max_workers=2, page_numbers=[5, 0, 11]))
+
+        assert [page_number for page_number, _ in pages] == [5, 0, 11]
+        assert pages[1] == (0, "Content of page 1")
+
+    def test_iter_pages_stops_early(self, sample_pdf):
+        """Test that closing the iterator leaves the remaining pages unextracted."""
+        with Cache(path2cache=':memory:') as cache:
+            pages = iter_pages(sample_pdf, max_workers=1, batch_size=1, cache=cache)
+            assert next(pages) == (0, "Content of page 1")
+            pages.close()
+            # the first page and at most a look-ahead window of 2 batches were extracted
+            assert cache.stats()['nb_entries'] <= 3
+
+
+class TestParsePageRanges:
+    """Test cases for parse_page_ranges."""
+
+    def test_ranges(self):
+        """Test closed, open and single page ranges."""
+        assert parse_page_ranges("2-4,7,9-", 10) == [1, 2, 3, 6, 8, 9]
+
+    def test_ranges_are_clipped_and_deduplicated(self):
+        """Test that pages past the end and repeated pages are ignored."""
+        assert parse_page_ranges("1-3,2-5,8-20", 9) == [0, 1, 2, 3, 4, 7, 8]
+
+    def test_open_start(self):
+        """Test a range without a start page."""
+        assert parse_page_ranges("-3", 10) == [0, 1, 2]
+
+    @pytest.mark.parametrize("page_ranges", ["0-3", "5-2", "a-b", "3-x"])
+    def test_invalid_ranges(self, page_ranges):
+        """Test that malformed ranges are rejected."""
+        with pytest.raises(ValueError):
+            parse_page_ranges(page_ranges, 10)
+
+
+class TestPageStream:
+    """Test cases for the PageStream class."""
+
+    def test_skips_empty_pages(self, sample_pdf):
+        """Test that empty pages are dropped."""
+        stream = PageStream(iter_pages(sample_pdf, max_workers=2))
+
+        assert stream.wait() == [f"Content of page {i+1}" for i in range(10)]
+        assert stream.is_complete()
+
+    def test_limit(self, sample_pdf):
+        """Test that the stream stops after limit non empty pages."""
+        stream = PageStream(iter_pages(sample_pdf, max_workers=2), limit=4)
+
+        assert stream.wait() == [f"Content of page {i+1}" for i in range(4)]
+
+    def test_limit_stops_the_extraction(self, sample_pdf):
+        """Test that pages past the limit are not extracted."""
+        with Cache(path2cache=':memory:') as cache:
+            stream = PageStream(iter_pages(sample_pdf, max_workers=1, batch_size=1, cache=cache), limit=2)
+            assert len(stream.wait()) == 2
+            assert cache.stats()['nb_entries'] < 12
+
+    def test_iteration_while_producing(self):
+        """Test that consumers can iterate the stream several times."""
+        stream = PageStream(iter([(0, "a"), (1, ""), (2, "b")]))
+
+        assert list(stream) == ["a", "b"]
+        assert list(stream) == ["a", "b"]
+
+    def test_is_empty(self):
+        """Test is_empty on a stream without text."""
+        assert PageStream(iter([(0, ""), (1, "")])).is_empty()
+        assert not PageStream(iter([(0, "text")])).is_empty()
+
+    def test_errors_are_propagated(self):
+        """Test that an extraction error surfaces to the consumer."""
+        def failing():
+            yield 0, "a"
+            raise RuntimeError("broken pdf")
+
+        stream = PageStream(failing())
+        with pytest.raises(RuntimeError):
+            stream.wait()
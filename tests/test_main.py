@@ -50,7 +50,7 @@ class TestMapReduceCommand:
 
     @patch('src.__main__.llm_map_reduce')
     @patch('src.__main__.PdfReader')
-    @patch('src.__main__.OpenAI')
+    @patch('src.algorithms.backends.OpenAI')
     @patch('src.__main__.Credentials')
     def test_map_reduce_command_success(self, mock_credentials, mock_openai, mock_pdf_reader, mock_llm_map_reduce):
         """Test successful execution of map_reduce command."""
@@ -101,7 +101,7 @@ class TestMapReduceCommand:
             os.unlink(temp_pdf)
 
     @patch('src.__main__.PdfReader')
-    @patch('src.__main__.OpenAI')
+    @patch('src.algorithms.backends.OpenAI')
     @patch('src.__main__.Credentials')
     def test_map_reduce_command_empty_pdf(self, mock_credentials, mock_openai, mock_pdf_reader):
         """Test map_reduce command with empty PDF."""
@@ -166,7 +166,7 @@ class TestMapReduceCommand:
 
     @patch('src.__main__.llm_map_reduce')
     @patch('src.__main__.PdfReader')
-    @patch('src.__main__.OpenAI')
+    @patch('src.algorithms.backends.OpenAI')
     @patch('src.__main__.Credentials')
     def test_map_reduce_command_limit_parameter(self, mock_credentials, mock_openai, mock_pdf_reader, mock_llm_map_reduce):
         """Test that limit parameter correctly limits pages."""
@@ -213,7 +213,7 @@ class TestMapReduceCommand:
 
     @patch('src.__main__.llm_map_reduce')
     @patch('src.__main__.PdfReader')
-    @patch('src.__main__.OpenAI')
+    @patch('src.algorithms.backends.OpenAI')
     @patch('src.__main__.Credentials')
     def test_map_reduce_command_exception_handling(self, mock_credentials, mock_openai, mock_pdf_reader, mock_llm_map_reduce):
         """Test exception handling in map_reduce command."""
@@ -253,7 +253,7 @@ class TestMapReduceCommand:
 
     @patch('src.__main__.llm_map_reduce')
     @patch('src.__main__.PdfReader')
-    @patch('src.__main__.OpenAI')
+    @patch('src.algorithms.backends.OpenAI')
     @patch('src.__main__.Credentials')
     def test_map_reduce_command_none_response(self, mock_credentials, mock_openai, mock_pdf_reader, mock_llm_map_reduce):
         """Test handling of None response from llm_map_reduce."""
@@ -290,6 +290,18 @@ class TestMapReduceCommand:
         finally:
             os.unlink(temp_pdf)
 
+    def test_map_reduce_command_budget_rejects_hedging(self):
+        """Test that a query budget is not combined with hedged duplicates, which it would not charge."""
+        temp_pdf = self.create_temp_pdf()
+
+        try:
+            result = self.runner.invoke(map_reduce, ['--path2file', temp_pdf, '--max_cost_per_query', '0.01', '--hedge'])
+
+            assert result.exit_code == 2
+            assert "--hedge" in result.output
+        finally:
+            os.unlink(temp_pdf)
+
 
 class TestMainModule:
     """Test cases for the main module entry point."""
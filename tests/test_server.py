@@ -0,0 +1,187 @@
+"""Tests for src.server module."""
+
+import asyncio
+import json
+import threading
+
+import httpx
+import pytest
+from unittest.mock import patch
+from starlette.testclient import TestClient
+
+from src.algorithms.scheduler import Scheduler
+from src.extraction import file_hash, iter_pages
+from src.server import Flight, create_app, document_id_of
+
+
+def _parse_sse(text):
+    """Split an event stream into (event, data) pairs."""
+    events = []
+    for block in text.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.split("\n"))
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+@pytest.fixture
+def scheduler():
+    """Scheduler shared by the queries of the app."""
+    with Scheduler(max_workers=2) as scheduler:
+        yield scheduler
+
+
+@pytest.fixture
+def app(mock_openai_client, scheduler, sample_pdf, tmp_path):
+    """App with the sample pdf preloaded."""
+    return create_app(mock_openai_client, "gpt-4o-mini", 4, scheduler, path2files=[str(sample_pdf)], path2upload_dir=str(tmp_path / "uploads"), extraction_workers=1)
+
+
+class TestDocuments:
+    """Test cases for the document endpoints."""
+
+    def test_preloaded_document(self, app, sample_pdf):
+        """Test that the startup documents are listed with their non empty pages."""
+        with TestClient(app) as client:
+            documents = client.get("/documents").json()
+
+        assert documents == [{'document_id': file_hash(str(sample_pdf))[:16], 'filename': "sample.pdf", 'nb_pages': 10}]
+
+    def test_upload_reuses_the_preloaded_id(self, app, sample_pdf):
+        """Test that uploading the same bytes does not extract the document again."""
+        content = open(sample_pdf, "rb").read()
+        with TestClient(app) as client:
+            response = client.post("/documents", content=content, params={'filename': "copy.pdf"})
+            documents = client.get("/documents").json()
+
+        assert response.json()['document_id'] == document_id_of(content)
+        assert len(documents) == 1
+
+    @pytest.mark.asyncio
+    async def test_concurrent_uploads_share_the_extraction(self, mock_openai_client, scheduler, sample_pdf, tmp_path):
+        """Test that a second upload of bytes being extracted waits for the first extraction."""
+        started, release = threading.Event(), threading.Event()
+
+        def blocking_iter_pages(*args, **kwargs):
+            started.set()
+            release.wait(timeout=5)
+            return iter_pages(*args, **kwargs)
+
+        app = create_app(mock_openai_client, "gpt-4o-mini", 4, scheduler, path2upload_dir=str(tmp_path / "uploads"), extraction_workers=1)
+        content = open(sample_pdf, "rb").read()
+        with patch('src.server.iter_pages', side_effect=blocking_iter_pages) as mock_iter_pages:
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://testserver") as client:
+                first = asyncio.ensure_future(client.post("/documents", content=content))
+                while not started.is_set():
+                    await asyncio.sleep(0.01)
+                second = asyncio.ensure_future(client.post("/documents", content=content))
+                await asyncio.sleep(0.05)
+                release.set()
+                responses = await asyncio.gather(first, second)
+
+        assert [response.json()['nb_pages'] for response in responses] == [10, 10]
+        assert mock_iter_pages.call_count == 1
+
+    def test_invalid_uploads(self, app):
+        """Test that empty bodies and unknown documents are rejected."""
+        with TestClient(app) as client:
+            assert client.post("/documents", content=b"").status_code == 400
+            assert client.get("/documents/unknown").status_code == 404
+            assert client.post("/documents/unknown/queries", json={'query': "q"}).status_code == 404
+
+
+class TestQueries:
+    """Test cases for the query endpoint."""
+
+    @patch('src.server.llm_map_reduce')
+    def test_answer_is_streamed(self, mock_llm_map_reduce, app, sample_pdf):
+        """Test that the tokens of the final reduce are sent as server sent events."""
+        def llm_map_reduce(**kwargs):
+            for token in ["Final ", "answer"]:
+                kwargs['on_token'](token)
+            return "Final answer"
+
+        mock_llm_map_reduce.side_effect = llm_map_reduce
+        document_id = file_hash(str(sample_pdf))[:16]
+        with TestClient(app) as client:
+            response = client.post(f"/documents/{document_id}/queries", json={'query': "q"})
+
+        assert response.headers['content-type'].startswith("text/event-stream")
+        assert _parse_sse(response.text) == [
+            ("token", {'token': "Final "}), ("token", {'token': "answer"}), ("answer", {'answer': "Final answer"})
+        ]
+        assert len(mock_llm_map_reduce.call_args[1]['pages']) == 10
+
+    @patch('src.server.llm_map_reduce')
+    def test_failure_is_reported(self, mock_llm_map_reduce, app, sample_pdf):
+        """Test that a failed computation ends the stream with an error event."""
+        mock_llm_map_reduce.side_effect = RuntimeError("map failed")
+        document_id = file_hash(str(sample_pdf))[:16]
+        with TestClient(app) as client:
+            streamed = client.post(f"/documents/{document_id}/queries", json={'query': "q"})
+            response = client.post(f"/documents/{document_id}/queries", json={'query': "q", 'stream': False})
+
+        assert _parse_sse(streamed.text) == [("error", {'detail': "map failed"})]
+        assert response.status_code == 502
+
+    @pytest.mark.asyncio
+    @patch('src.server.llm_map_reduce')
+    async def test_identical_queries_are_coalesced(self, mock_llm_map_reduce, app, sample_pdf):
+        """Test that concurrent identical queries share one computation."""
+        release = threading.Event()
+
+        def llm_map_reduce(**kwargs):
+            release.wait(timeout=5)
+            return f"answer to {kwargs['query']}"
+
+        mock_llm_map_reduce.side_effect = llm_map_reduce
+        document_id = file_hash(str(sample_pdf))[:16]
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://testserver") as client:
+            requests = [
+                asyncio.ensure_future(client.post(f"/documents/{document_id}/queries", json={'query': query, 'stream': False}))
+                for query in ["q", "q", "q", "other"]
+            ]
+            while (await client.get("/stats")).json()['nb_queries'] < 4:
+                await asyncio.sleep(0.01)
+            release.set()
+            responses = await asyncio.gather(*requests)
+            stats = (await client.get("/stats")).json()
+
+        assert [response.json()['answer'] for response in responses] == ["answer to q"] * 3 + ["answer to other"]
+        assert mock_llm_map_reduce.call_count == 2
+        assert stats['nb_coalesced'] == 2
+        assert stats['nb_in_flight'] == 0
+
+
+class TestFlight:
+    """Test cases for Flight."""
+
+    @pytest.mark.asyncio
+    async def test_late_subscriber_replays_the_tokens(self):
+        """Test that a request joining a running flight receives the tokens it missed."""
+        flight = Flight(asyncio.get_running_loop())
+        early = flight.subscribe()
+        flight.publish('token', "a")
+        flight.publish('token', "b")
+        await asyncio.sleep(0)
+        late = flight.subscribe()
+        flight.publish('answer', "ab")
+        await asyncio.sleep(0)
+
+        for subscriber in [early, late]:
+            events = [subscriber.get_nowait() for _ in range(subscriber.qsize())]
+            assert events == [('token', "a"), ('token', "b"), ('answer', "ab")]
+
+    @pytest.mark.asyncio
+    async def test_unsubscribed_client_receives_nothing(self):
+        """Test that the queue of a disconnected client is dropped from the flight."""
+        flight = Flight(asyncio.get_running_loop())
+        gone = flight.subscribe()
+        staying = flight.subscribe()
+        flight.unsubscribe(gone)
+        flight.unsubscribe(gone)
+        flight.publish('token', "a")
+        await asyncio.sleep(0)
+
+        assert gone.empty()
+        assert staying.get_nowait() == ('token', "a")
+        assert flight.subscribers == [staying]